@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""fake_api.py
+Local stand-in for the Brawl Stars API serving synthetic clubs, players and battle logs.
+
+Run standalone with `python benchmarks/fake_api.py --members 100` and point the bot at it
+with BRAWLSTARS_API_URL=http://127.0.0.1:8080/v1.
+"""
+import argparse
+import asyncio
+import random
+import urllib.parse
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+
+TAG_ALPHABET = '0289PYLQGRJCUV'
+BRAWLERS = [(16000000 + i, name) for i, name in enumerate(
+    ['SHELLY', 'COLT', 'BULL', 'BROCK', 'RICO', 'SPIKE', 'BARLEY', 'JESSIE', 'NITA', 'DYNAMIKE', 'EL PRIMO',
+     'MORTIS', 'CROW', 'POCO', 'BO', 'PIPER', 'PAM', 'TARA', 'DARRYL', 'PENNY', 'FRANK', 'GENE', 'TICK', 'LEON'])]
+TEAM_EVENTS = [('gemGrab', 'Hard Rock Mine'), ('brawlBall', 'Backyard Bowl'), ('heist', 'Safe Zone'),
+               ('bounty', 'Shooting Star'), ('hotZone', 'Ring of Fire'), ('knockout', 'Goldarm Gulch')]
+SHOWDOWN_EVENTS = [('soloShowdown', 'Skull Creek'), ('duoShowdown', 'Cavern Churn')]
+BATTLE_LOG_SIZE = 25
+
+
+def make_tag(number):
+    tag = ''
+    while True:
+        number, remainder = divmod(number, len(TAG_ALPHABET))
+        tag = f'{TAG_ALPHABET[remainder]}{tag}'
+        if number == 0:
+            break
+    return f'#{tag.rjust(8, "0")}'
+
+
+def format_battle_time(dt):
+    return dt.strftime('%Y%m%dT%H%M%S.000Z')
+
+
+class FakeBrawlStarsApi:
+    def __init__(self, members=30, battles_per_member=BATTLE_LOG_SIZE, latency=0.0, jitter=0.0, error_rate=0.0,
+                 rate_limit_rate=0.0, club_share=0.5, seed=0):
+        """Synthetic Brawl Stars API
+
+        Args:
+            members (int): Number of club members
+            battles_per_member (int): Battles generated per member at startup
+            latency (float): Seconds added to every response
+            jitter (float): Random extra latency in seconds
+            error_rate (float): Share of requests answered with 500
+            rate_limit_rate (float): Share of requests answered with 429
+            club_share (float): Share of team slots filled with other club members
+            seed (int): Random seed, equal seeds give equal data
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.club_share = club_share
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self.responses = Counter()
+        self._runner = None
+
+        self.club_tag = make_tag(10 ** 9)
+        self.now = datetime.now(timezone.utc).replace(microsecond=0)
+        self.players = {}
+        self.battle_logs = {}
+        for i in range(members):
+            tag = make_tag(i + 1)
+            self.players[tag] = self._player(tag, f'Member {i + 1}')
+            self.battle_logs[tag] = []
+        self._tags = list(self.players)
+        self._outsider = members + 10 ** 6
+        initial_battles = members * battles_per_member // 2
+        self._last_battle_time = self.now - timedelta(seconds=initial_battles * 61)
+        self.play(initial_battles)
+
+    def _player(self, tag, name):
+        trophies = self.random.randint(1000, 40000)
+        return {
+            'tag': tag,
+            'name': name,
+            'nameColor': '0xffffffff',
+            'icon': {'id': 28000000},
+            'trophies': trophies,
+            'highestTrophies': trophies + self.random.randint(0, 2000),
+            'expLevel': self.random.randint(20, 250),
+            'expPoints': self.random.randint(1000, 200000),
+            'isQualifiedFromChampionshipChallenge': False,
+            '3vs3Victories': self.random.randint(0, 20000),
+            'soloVictories': self.random.randint(0, 3000),
+            'duoVictories': self.random.randint(0, 3000),
+            'bestRoboRumbleTime': self.random.randint(0, 20),
+            'bestTimeAsBigBrawler': 0,
+            'club': {'tag': self.club_tag, 'name': 'Bench Club'},
+            'brawlers': [self._brawler_profile(brawler_id, brawler_name)
+                         for brawler_id, brawler_name in self.random.sample(BRAWLERS, 10)],
+        }
+
+    def _brawler_profile(self, brawler_id, name):
+        trophies = self.random.randint(0, 1000)
+        return {'id': brawler_id, 'name': name, 'power': self.random.randint(1, 11),
+                'rank': self.random.randint(1, 35), 'trophies': trophies,
+                'highestTrophies': trophies + self.random.randint(0, 200),
+                'gears': [], 'starPowers': [], 'gadgets': []}
+
+    def _participant(self, tag):
+        player = self.players.get(tag)
+        name = player['name'] if player else f'Outsider {tag}'
+        brawler_id, brawler_name = self.random.choice(BRAWLERS)
+        return {'tag': tag, 'name': name,
+                'brawler': {'id': brawler_id, 'name': brawler_name, 'power': self.random.randint(1, 11),
+                            'trophies': self.random.randint(0, 1000)}}
+
+    def _other_tag(self, exclude):
+        if self.random.random() < self.club_share and len(self.players) > len(exclude):
+            tag = self.random.choice(self._tags)
+            if tag not in exclude:
+                return tag
+        self._outsider += 1
+        return make_tag(self._outsider)
+
+    def battle(self, tag, battle_time):
+        """Generate a battle log item played by tag at battle_time
+
+        Returns:
+            tuple: (participant tags, battle log item)
+        """
+        participants = [tag]
+        if self.random.random() < 0.8:
+            event_id = self.random.randrange(len(TEAM_EVENTS))
+            mode, map_name = TEAM_EVENTS[event_id]
+            while len(participants) < 6:
+                participants.append(self._other_tag(participants))
+            teams = [[self._participant(t) for t in participants[:3]],
+                     [self._participant(t) for t in participants[3:]]]
+            result = self.random.choice(['victory', 'defeat', 'defeat', 'victory', 'draw'])
+            star = teams[0][0] if result == 'victory' else self.random.choice(teams[1])
+            battle = {'mode': mode, 'type': 'ranked', 'result': result,
+                      'duration': self.random.randint(60, 240),
+                      'trophyChange': {'victory': 8, 'defeat': -6, 'draw': 0}[result],
+                      'starPlayer': star, 'teams': teams}
+        else:
+            event_id = 100 + self.random.randrange(len(SHOWDOWN_EVENTS))
+            mode, map_name = SHOWDOWN_EVENTS[event_id - 100]
+            while len(participants) < 10:
+                participants.append(self._other_tag(participants))
+            self.random.shuffle(participants)
+            rank = participants.index(tag) + 1
+            battle = {'mode': mode, 'type': 'ranked', 'rank': rank, 'trophyChange': 10 - rank * 2,
+                      'players': [self._participant(t) for t in participants]}
+
+        return participants, {
+            'battleTime': format_battle_time(battle_time),
+            'event': {'id': 15000000 + event_id, 'mode': mode, 'map': map_name},
+            'battle': battle,
+        }
+
+    def play(self, count):
+        """Let randomly chosen members play count new battles, each at a distinct second
+
+        Returns:
+            int: Number of battles added
+        """
+        if not self._tags:
+            return 0
+        for _ in range(count):
+            self._last_battle_time += timedelta(seconds=self.random.randint(1, 120))
+            participants, battle = self.battle(self.random.choice(self._tags), self._last_battle_time)
+            for tag in participants:
+                log = self.battle_logs.get(tag)
+                if log is not None:
+                    log.insert(0, battle)
+                    del log[BATTLE_LOG_SIZE:]
+        return count
+
+    async def _respond(self, endpoint, payload):
+        self.requests[endpoint] += 1
+        delay = self.latency + (self.random.random() * self.jitter if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            self.responses[429] += 1
+            return web.json_response({'reason': 'requestThrottled'}, status=429, headers={'Retry-After': '0'})
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.responses[500] += 1
+            return web.json_response({'reason': 'unknownException'}, status=500)
+        if payload is None:
+            self.responses[404] += 1
+            return web.json_response({'reason': 'notFound'}, status=404)
+        self.responses[200] += 1
+        return web.json_response(payload)
+
+    @staticmethod
+    def _tag(request):
+        return urllib.parse.unquote_plus(request.match_info['tag'])
+
+    async def club(self, request):
+        payload = None
+        if self._tag(request) == self.club_tag:
+            members = [{'tag': p['tag'], 'name': p['name'], 'nameColor': p['nameColor'], 'role': 'member',
+                        'trophies': p['trophies'], 'icon': p['icon']} for p in self.players.values()]
+            payload = {'tag': self.club_tag, 'name': 'Bench Club', 'description': 'Synthetic club',
+                       'type': 'open', 'badgeId': 8000000, 'requiredTrophies': 0,
+                       'trophies': sum(m['trophies'] for m in members), 'members': members}
+        return await self._respond('clubs', payload)
+
+    async def club_members(self, request):
+        payload = None
+        if self._tag(request) == self.club_tag:
+            payload = {'items': [{'tag': p['tag'], 'name': p['name'], 'role': 'member', 'trophies': p['trophies']}
+                                 for p in self.players.values()]}
+        return await self._respond('clubs_members', payload)
+
+    async def player(self, request):
+        return await self._respond('players', self.players.get(self._tag(request)))
+
+    async def battle_log(self, request):
+        log = self.battle_logs.get(self._tag(request))
+        payload = None if log is None else {'items': log, 'paging': {'cursors': {}}}
+        return await self._respond('players_battle_log', payload)
+
+    async def events(self, request):
+        start = self.now.replace(minute=0, second=0)
+        payload = [{'startTime': format_battle_time(start),
+                    'endTime': format_battle_time(start + timedelta(hours=i + 1)),
+                    'slotId': i + 1,
+                    'event': {'id': 15000000 + i, 'mode': mode, 'map': map_name}}
+                   for i, (mode, map_name) in enumerate(TEAM_EVENTS + SHOWDOWN_EVENTS)]
+        return await self._respond('events', payload)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/v1/clubs/{tag}', self.club)
+        app.router.add_get('/v1/clubs/{tag}/members', self.club_members)
+        app.router.add_get('/v1/players/{tag}', self.player)
+        app.router.add_get('/v1/players/{tag}/battlelog', self.battle_log)
+        app.router.add_get('/v1/events/rotation', self.events)
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Serve the fake api on the running loop
+
+        Returns:
+            str: Base url to use as BRAWLSTARS_API_URL
+        """
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        return f'http://{host}:{port}/v1'
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a synthetic Brawl Stars API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--members', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of 500 responses')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Share of 429 responses')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fake = FakeBrawlStarsApi(members=args.members, latency=args.latency, jitter=args.jitter,
+                             error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, seed=args.seed)
+    print(f'Club tag: {fake.club_tag}')
+    print(f'BRAWLSTARS_API_URL=http://{args.host}:{args.port}/v1')
+    web.run_app(fake.app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
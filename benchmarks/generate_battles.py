@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""generate_battles.py
+Write synthetic battle history into a local mongod, in the exact shape ingestion stores it.
+
+Battles come from the fake api generator (3v3 teams with a star player and trophy change,
+showdown players with a rank) and go through database.battle_document like upsert_battle.
+The club and its members are written too so club level queries have something to join on.
+
+    python benchmarks/generate_battles.py --battles 1000000 --database brawlboss_bench_battles_1000000
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import timedelta
+
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'brawlboss'))
+
+import database  # noqa: E402
+from fake_api import FakeBrawlStarsApi  # noqa: E402
+
+
+def generate(database_name, battles, members=30, days=90, batch_size=10000, seed=0, quiet=False):
+    """Write battles spread evenly over the last days into database_name
+
+    Args:
+        database_name (str): Target database
+        battles (int): Number of battle documents to write
+        members (int): Club size, every battle has at least one member in it
+        days (int): Length of the history, battles get distinct seconds so it is stretched if too short
+        batch_size (int): Documents per insert_many
+        seed (int): Random seed
+        quiet (bool): Do not print progress
+
+    Returns:
+        str: Club tag of the generated club
+    """
+    client = MongoClient(database.mongodb_uri())
+    client.drop_database(database_name)
+    db = client[database_name]
+
+    fake = FakeBrawlStarsApi(members=members, battles_per_member=0, seed=seed)
+    club = {'_id': fake.club_tag, 'tag': fake.club_tag, 'name': 'Bench Club',
+            'members': [{'tag': p['tag'], 'name': p['name'], 'role': 'member', 'trophies': p['trophies']}
+                        for p in fake.players.values()]}
+    db.club.replace_one({'_id': club['_id']}, club, upsert=True)
+    for i, player in enumerate(fake.players.values()):
+        db.player.replace_one({'_id': player['tag']}, {'_id': player['tag'], **player}, upsert=True)
+        db.discord.replace_one({'_id': i + 1}, {'_id': i + 1, 'tag': player['tag']}, upsert=True)
+
+    step = max(timedelta(days=days) / max(battles, 1), timedelta(seconds=1))
+    step = timedelta(seconds=round(step.total_seconds()))
+    battle_time = fake.now - step * battles
+    tags = list(fake.players)
+
+    start = time.perf_counter()
+    written = 0
+    while written < battles:
+        documents = []
+        for _ in range(min(batch_size, battles - written)):
+            battle_time += step
+            participants, battle = fake.battle(fake.random.choice(tags), battle_time)
+            documents.append(database.battle_document(battle))
+        db.battle.insert_many(documents, ordered=False)
+        written += len(documents)
+        if not quiet:
+            rate = written / (time.perf_counter() - start)
+            print(f'\r{written}/{battles} battles ({rate:.0f}/s)', end='', flush=True)
+    if not quiet:
+        print()
+
+    client.close()
+    return fake.club_tag
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic battle history in a local mongod')
+    parser.add_argument('--battles', type=int, default=10000)
+    parser.add_argument('--database', help='Database name, defaults to brawlboss_bench_battles_<battles>')
+    parser.add_argument('--members', type=int, default=30)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    database_name = args.database or f'brawlboss_bench_battles_{args.battles}'
+    club_tag = generate(database_name, args.battles, members=args.members, days=args.days,
+                        batch_size=args.batch_size, seed=args.seed)
+    print(f'Wrote {args.battles} battles for club {club_tag} to {database_name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""queries.py
+Time the BrawlBossDatabase read methods against synthetic battle histories of growing size.
+
+Databases are generated with generate_battles.py when missing or of the wrong size. Results
+are written as JSON tagged with the current commit, pass --compare to diff against an older run.
+
+    python benchmarks/queries.py --sizes 10000 1000000 10000000
+    python benchmarks/queries.py --sizes 10000 --compare benchmarks/results/queries-<commit>.json
+
+Methods that are not runnable as written (get_battles_since, wins_last_seven_days,
+get_club_battles, get_player_from_discord_name) are left out. player_of_the_week is timed both
+as the stored award lookup and as the weekly computation of analytics.player_of_the_week.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'brawlboss'))
+
+import analytics  # noqa: E402
+import database  # noqa: E402
+import helper  # noqa: E402
+from generate_battles import generate  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def read_cases(db, club_tag, tag):
+    """Read methods to time, each a coroutine function that runs the query to completion"""
+    week = helper.get_since_date(weeks=1)
+    week_start = helper.week_start(datetime.utcnow())
+
+    async def cursor(method, *args):
+        return await (await method(*args)).to_list(length=None)
+
+    async def award():
+        return await analytics.player_of_the_week(db, await db.get_club(club_tag), week_start)
+
+    return {
+        'test_connection': lambda: db.test_connection(),
+        'first_battle': lambda: cursor(db.first_battle),
+        'first_battle(tag)': lambda: cursor(db.first_battle, tag),
+        'last_battle': lambda: cursor(db.last_battle),
+        'last_battle(tag)': lambda: cursor(db.last_battle, tag),
+        'last_club_league_battle': lambda: cursor(db.last_club_league_battle, tag),
+        'first_battle_date': lambda: db.first_battle_date(),
+        'get_club': lambda: db.get_club(club_tag),
+        'player_from_discord_id': lambda: db.player_from_discord_id(1),
+        'battle_duration': lambda: db.battle_duration(tag),
+        'battle_count': lambda: db.battle_count(tag),
+        'battle_count(week)': lambda: db.battle_count(tag, since_date=week),
+        'star_player_count': lambda: db.star_player_count(tag),
+        'win_rate(week)': lambda: db.win_rate(tag, week),
+        'club_score': lambda: db.club_score(tag),
+        'club_rankings': lambda: db.club_rankings(club_tag),
+        'player_of_the_week': lambda: db.player_of_the_week(club_tag),
+        'player_of_the_week(compute)': award,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+async def prepare(size, args):
+    database_name = f'brawlboss_bench_battles_{size}'
+    db = database.BrawlBossDatabase(database_name=database_name)
+    count = await db.db.battle.estimated_document_count()
+    if count != size or args.regenerate:
+        print(f'Generating {size} battles into {database_name}')
+        await asyncio.to_thread(generate, database_name, size, members=args.members, seed=args.seed)
+    club = await db.db.club.find_one({})
+    return db, club['_id'], club['members'][0]['tag']
+
+
+async def run_size(size, args):
+    db, club_tag, tag = await prepare(size, args)
+    results = []
+    try:
+        for name, case in read_cases(db, club_tag, tag).items():
+            if args.only and name.split('(')[0] not in args.only:
+                continue
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                await case()
+                timings.append(time.perf_counter() - start)
+                # Every method of the larger sizes can take minutes, stop repeating once over budget
+                if sum(timings) > args.budget:
+                    break
+            results.append({'size': size, 'method': name, 'runs': len(timings),
+                            'min': min(timings), 'median': statistics.median(timings), 'max': max(timings)})
+            print(f'{size:>10} {name:<26} {results[-1]["median"] * 1000:>12.1f} ms  ({len(timings)} runs)')
+    finally:
+        db.client.close()
+    return results
+
+
+def compare(results, path):
+    with open(path) as f:
+        previous = json.load(f)
+    baseline = {(r['size'], r['method']): r['median'] for r in previous['results']}
+    print(f'\nCompared to {previous.get("commit")} ({path}):')
+    for r in results:
+        before = baseline.get((r['size'], r['method']))
+        if before:
+            print(f'{r["size"]:>10} {r["method"]:<26} {before * 1000:>10.1f} ms -> {r["median"] * 1000:>10.1f} ms '
+                  f'({r["median"] / before:.2f}x)')
+
+
+async def run(args):
+    results = []
+    for size in args.sizes:
+        results.extend(await run_size(size, args))
+
+    commit = git_commit()
+    path = args.json or os.path.join(RESULTS_DIR, f'queries-{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'commit': commit, 'date': datetime.utcnow().isoformat(), 'args': vars(args),
+                   'results': results}, f, indent=2)
+    print(f'Wrote {path}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark BrawlBossDatabase read methods')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 1000000, 10000000])
+    parser.add_argument('--members', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=60.0, help='Seconds spent per method and size at most')
+    parser.add_argument('--only', nargs='+', help='Only time these methods')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--regenerate', action='store_true', help='Regenerate the databases')
+    parser.add_argument('--json', help='Result file, defaults to benchmarks/results/queries-<commit>.json')
+    parser.add_argument('--compare', help='Earlier result file to compare with')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""refresh.py
+Benchmark a full database refresh cycle against the local fake Brawl Stars API.
+
+Needs a local mongod (MONGODB_URI or MONGODB_HOST/MONGODB_PORT). Every club size gets its own
+throwaway database named brawlboss_bench_<size>.
+
+    python benchmarks/refresh.py --sizes 30 100 1000 --latency 0.05 --json refresh.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+
+from pymongo import monitoring
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'brawlboss'))
+
+import database  # noqa: E402
+import ingest  # noqa: E402
+import metrics  # noqa: E402
+from fake_api import FakeBrawlStarsApi  # noqa: E402
+
+
+class MongoOpCounter(monitoring.CommandListener):
+    """Counts the commands sent to mongod by every client created after registration"""
+
+    def __init__(self):
+        self.commands = Counter()
+
+    def started(self, event):
+        self.commands[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def reset(self):
+        self.commands = Counter()
+
+
+async def run_size(size, args, op_counter):
+    fake = FakeBrawlStarsApi(members=size, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                             rate_limit_rate=args.rate_limit_rate, seed=args.seed)
+    os.environ['BRAWLSTARS_API_URL'] = await fake.start()
+
+    database_name = f'brawlboss_bench_{size}'
+    db = database.BrawlBossDatabase(database_name=database_name)
+    await db.client.drop_database(database_name)
+
+    cycles = []
+    try:
+        for cycle in range(args.cycles):
+            if cycle:
+                fake.play(args.battles_between_cycles)
+            fake.requests.clear()
+            op_counter.reset()
+            errors = metrics.REFRESH_ERRORS.value()
+
+            start = time.perf_counter()
+            await ingest.update(db, fake.club_tag)
+            wall_time = time.perf_counter() - start
+
+            cycles.append({
+                'members': size,
+                'cycle': cycle + 1,
+                'wall_time': round(wall_time, 3),
+                'api_calls': sum(fake.requests.values()),
+                'mongo_ops': sum(op_counter.commands.values()),
+                'mongo_ops_by_command': dict(op_counter.commands),
+                'errors': metrics.REFRESH_ERRORS.value() - errors,
+            })
+    finally:
+        await fake.stop()
+        if not args.keep:
+            await db.client.drop_database(database_name)
+        db.client.close()
+    return cycles
+
+
+async def run(args):
+    op_counter = MongoOpCounter()
+    monitoring.register(op_counter)
+
+    results = []
+    for size in args.sizes:
+        results.extend(await run_size(size, args, op_counter))
+
+    print(f'{"members":>8} {"cycle":>5} {"wall time":>10} {"api calls":>10} {"mongo ops":>10} {"errors":>6}')
+    for r in results:
+        print(f'{r["members"]:>8} {r["cycle"]:>5} {r["wall_time"]:>9.2f}s {r["api_calls"]:>10} '
+              f'{r["mongo_ops"]:>10} {r["errors"]:>6}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark refresh cycles against a fake Brawl Stars API')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[30, 100, 1000], help='Club sizes to run')
+    parser.add_argument('--cycles', type=int, default=2, help='Refresh cycles per size, the first is a cold start')
+    parser.add_argument('--battles-between-cycles', type=int, default=100,
+                        help='Battles played on the fake api between cycles')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each api response')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help='Keep the benchmark databases')
+    parser.add_argument('--json', help='Write results to this file')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
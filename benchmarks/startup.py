@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""startup.py
+Measure bot startup: import time of main.py from `python -X importtime`, and time-to-ready.
+
+Time-to-ready needs DISCORD_TOKEN and DISCORD_GUILD_ID; the bot is started, the
+"Ready after" log line is read and the process is stopped again.
+
+    python benchmarks/startup.py --top 15
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'brawlboss')
+IMPORT_LINE = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+READY_LINE = re.compile(r'Ready after ([\d.]+) seconds')
+
+
+def bot_env():
+    env = dict(os.environ)
+    env.setdefault('DISCORD_GUILD_ID', '0')
+    env['PYTHONUNBUFFERED'] = '1'
+    return env
+
+
+def import_times(repeat=3):
+    """Import main.py in fresh interpreters
+
+    Returns:
+        tuple: (median wall seconds, list of (cumulative us, self us, module) of the last run)
+    """
+    walls = []
+    modules = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=BOT_DIR,
+                                env=bot_env(), capture_output=True, text=True)
+        walls.append(time.perf_counter() - start)
+        if result.returncode:
+            raise RuntimeError(result.stderr[-2000:])
+
+        modules = []
+        for line in result.stderr.splitlines():
+            match = IMPORT_LINE.match(line)
+            if match:
+                self_us, cumulative_us, indent, module = match.groups()
+                modules.append((int(cumulative_us), int(self_us), module, len(indent) // 2))
+    walls.sort()
+    return walls[len(walls) // 2], modules
+
+
+def time_to_ready(timeout=120):
+    """Start the bot and return the seconds it reports in its "Ready after" log line"""
+    process = subprocess.Popen([sys.executable, 'main.py'], cwd=BOT_DIR, env=bot_env(), stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, text=True)
+    deadline = time.monotonic() + timeout
+    try:
+        for line in process.stdout:
+            match = READY_LINE.search(line)
+            if match:
+                return float(match.group(1))
+            if time.monotonic() > deadline:
+                break
+    finally:
+        process.terminate()
+        process.wait(10)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure bot import time and time-to-ready')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest top level imports to list')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help='Write results to this file')
+    args = parser.parse_args()
+
+    wall, modules = import_times(args.repeat)
+    top_level = sorted((m for m in modules if m[3] <= 1), reverse=True)[:args.top]
+    total_us = sum(m[0] for m in modules if m[3] == 0)
+    print(f'import main: {wall * 1000:.0f} ms wall, {total_us / 1000:.0f} ms in imports')
+    for cumulative_us, self_us, module, level in top_level:
+        print(f'{cumulative_us / 1000:>10.1f} ms  {module}')
+
+    ready = None
+    if os.getenv('DISCORD_TOKEN'):
+        ready = time_to_ready()
+        print(f'time to ready: {ready:.2f} s' if ready is not None else 'time to ready: bot did not get ready')
+    else:
+        print('time to ready: skipped, DISCORD_TOKEN is not set')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'import_wall': wall, 'import_total': total_us / 1e6, 'time_to_ready': ready,
+                       'imports': [{'module': m[2], 'cumulative': m[0] / 1e6, 'self': m[1] / 1e6}
+                                   for m in top_level]}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""analytics.py
+Club statistics computed for every member at once.
+
+The battles of a club are fetched with one projected query and packed into NumPy arrays
+with one entry per member per battle. Win rates, star player rates, playtime and scores are
+then per-member sums over those arrays, for any window, mode or weighting, without going
+back to the database.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import helper
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_seconds(value):
+    """Seconds since the epoch of a naive UTC datetime"""
+    return (value - EPOCH).total_seconds()
+
+
+def decay_weights(times, half_life, now=None):
+    """Weights that halve every half_life going back from now
+
+    Args:
+        times (numpy.ndarray): Battle times in seconds since the epoch
+        half_life (timedelta): Age at which a battle counts half
+        now (datetime): Reference time, defaults to now
+
+    Returns:
+        numpy.ndarray: One weight per entry in times
+    """
+    age = to_seconds(now or datetime.utcnow()) - times
+    return np.power(0.5, np.maximum(age, 0) / half_life.total_seconds())
+
+
+class ClubStats:
+    def __init__(self, tags, member, victory, rank, star, duration, mode, time, modes, star_counts=None):
+        """Battles of club members as parallel arrays, one entry per member per battle
+
+        Args:
+            tags (list): Member tags, member holds indexes into this list
+            member (numpy.ndarray): Index of the member
+            victory (numpy.ndarray): Battle counts as a victory, see helper.is_victory
+            rank (numpy.ndarray): Showdown rank, 0 for team battles
+            star (numpy.ndarray): The member was star player
+            duration (numpy.ndarray): Battle duration in seconds, 0 if unknown
+            mode (numpy.ndarray): Index into modes
+            time (numpy.ndarray): Battle time in seconds since the epoch
+            modes (list): Mode names
+            star_counts (dict): All-time star player count per tag, used by score
+        """
+        self.tags = list(tags)
+        self.member = member
+        self.victory = victory
+        self.rank = rank
+        self.star = star
+        self.duration = duration
+        self.mode = mode
+        self.time = time
+        self.modes = list(modes)
+        self.star_counts = star_counts
+
+    def __len__(self):
+        return len(self.member)
+
+    @classmethod
+    def from_battles(cls, tags, battles, star_counts=None):
+        """Pack stored battles into arrays, battles without any of tags are ignored"""
+        index = {tag: i for i, tag in enumerate(tags)}
+        modes = {}
+        columns = ([], [], [], [], [], [], [])
+        for battle_log in battles:
+            battle = battle_log.get('battle', {})
+            star_player = (battle.get('starPlayer') or {}).get('tag')
+            victory = helper.is_victory(battle_log)
+            mode = modes.setdefault(battle.get('mode') or battle_log.get('event', {}).get('mode'), len(modes))
+            row = (victory, battle.get('rank') or 0, battle.get('duration') or 0, mode,
+                   to_seconds(battle_log['battleTime']))
+            # A member counts once per battle, like the participation queries
+            for tag in set(helper.battle_participant_tags(battle_log)):
+                i = index.get(tag)
+                if i is None:
+                    continue
+                columns[0].append(i)
+                columns[1].append(tag == star_player)
+                for column, value in zip(columns[2:], row):
+                    column.append(value)
+
+        member, star, victory, rank, duration, mode, time = columns
+        return cls(tags, np.array(member, dtype=np.int64), np.array(victory, dtype=bool),
+                   np.array(rank, dtype=np.int16), np.array(star, dtype=bool),
+                   np.array(duration, dtype=np.float64), np.array(mode, dtype=np.int64),
+                   np.array(time, dtype=np.float64), list(modes), star_counts)
+
+    def mask(self, since=None, until=None, mode=None):
+        """Boolean selection of the entries in a window and, optionally, one mode"""
+        selected = np.ones(len(self), dtype=bool)
+        if since is not None:
+            selected &= self.time >= to_seconds(since)
+        if until is not None:
+            selected &= self.time < to_seconds(until)
+        if mode is not None:
+            selected &= self.mode == (self.modes.index(mode) if mode in self.modes else -1)
+        return selected
+
+    def _sum(self, values, selected, weights):
+        if weights is not None:
+            values = values * weights
+        return np.bincount(self.member[selected], weights=values[selected], minlength=len(self.tags))
+
+    def totals(self, since=None, until=None, mode=None, weights=None):
+        """Per-member sums over a window
+
+        Args:
+            since (datetime): Start of the window, inclusive
+            until (datetime): End of the window, exclusive
+            mode (str): Only count battles of this mode
+            weights (numpy.ndarray): Weight of every entry, e.g. from decay_weights
+
+        Returns:
+            dict: 'battles', 'victories', 'star_player' and 'playtime' arrays indexed like tags
+        """
+        selected = self.mask(since, until, mode)
+        ones = np.ones(len(self))
+        return {
+            'battles': self._sum(ones, selected, weights),
+            'victories': self._sum(self.victory.astype(np.float64), selected, weights),
+            'star_player': self._sum(self.star.astype(np.float64), selected, weights),
+            'playtime': self._sum(self.duration, selected, weights),
+        }
+
+    def rates(self, since=None, until=None, mode=None, weights=None):
+        """Per-member win rate, star player rate and playtime over a window"""
+        totals = self.totals(since, until, mode, weights)
+        battles = totals['battles']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            win_rate = np.where(battles > 0, totals['victories'] / battles, 0.0)
+            star_rate = np.where(battles > 0, totals['star_player'] / battles, 0.0)
+        return {'battles': battles, 'win_rate': win_rate, 'star_rate': star_rate, 'playtime': totals['playtime']}
+
+    def scores(self, since=None, until=None, weights=None, star_floor=1):
+        """Club score of every member, BrawlBossDatabase.club_score for all members at once
+
+        The win rate over the window times the all-time star player count, at least
+        star_floor. Without star_counts the star player count of the loaded battles is used.
+        """
+        win_rate = self.rates(since, until, weights=weights)['win_rate']
+        if self.star_counts is not None:
+            stars = np.array([self.star_counts.get(tag, 0) for tag in self.tags], dtype=np.float64)
+        else:
+            stars = self.totals()['star_player']
+        return win_rate * np.maximum(stars, star_floor)
+
+    def composite(self, since=None, until=None, weights=None, win_rate=1.0, star_rate=0.0, playtime=0.0):
+        """Weighted sum of the member metrics, each scaled to 0-1 within the club"""
+        rates = self.rates(since, until, weights=weights)
+        score = np.zeros(len(self.tags))
+        for metric, factor in (('win_rate', win_rate), ('star_rate', star_rate), ('playtime', playtime)):
+            if factor:
+                values = rates[metric]
+                top = values.max() if len(values) else 0
+                score += factor * (values / top if top > 0 else values)
+        return score
+
+    def rankings(self, members, scores):
+        """Members with their score, best first, ties keep the roster order"""
+        by_tag = dict(zip(self.tags, scores.tolist()))
+        ranked = [dict(member, score=by_tag.get(member['tag'], 0)) for member in members]
+        return sorted(ranked, key=lambda x: x['score'], reverse=True)
+
+
+async def club_stats(db, club, since=None, all_time_stars=True):
+    """Load ClubStats for the members of a stored club
+
+    Args:
+        db (database.BrawlBossDatabase): Database to read from
+        club (dict): Stored club document
+        since (datetime): Oldest battle to load, defaults to seven days ago
+        all_time_stars (bool): Also load the all-time star player counts used by the club score
+
+    Returns:
+        ClubStats:
+    """
+    tags = [member['tag'] for member in club.get('members', [])]
+    since = since or helper.get_since_date(weeks=1)
+    battles = await db.member_battles(tags, since)
+    star_counts = await db.star_player_counts(tags) if all_time_stars else None
+    return ClubStats.from_battles(tags, battles, star_counts)
+
+
+async def player_of_the_week(db, club, week_start, runners_up=2):
+    """Rank the members of a club by their week
+
+    The score follows the club score: the win rate of the week times the star player count
+    of the week, at least 1. Ties go to more victories and then more battles.
+
+    Args:
+        db (database.BrawlBossDatabase): Database to read from
+        club (dict): Stored club document
+        week_start (datetime): Monday 00:00 UTC of the week
+        runners_up (int): Number of members to keep after the winner
+
+    Returns:
+        dict: The award document, with no rankings if nobody played
+    """
+    week_end = week_start + timedelta(weeks=1)
+    members = club.get('members', [])
+    tags = [member['tag'] for member in members]
+    stats = ClubStats.from_battles(tags, await db.member_battles(tags, week_start, week_end))
+
+    totals = stats.totals(week_start, week_end)
+    battles = totals['battles']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        win_rate = np.where(battles > 0, totals['victories'] / battles, 0.0)
+    score = win_rate * np.maximum(totals['star_player'], 1)
+
+    # lexsort sorts by the last key first
+    order = np.lexsort((-battles, -totals['victories'], -score))
+    rankings = [{'tag': tags[i], 'name': members[i].get('name'), 'score': float(score[i]),
+                 'win_rate': float(win_rate[i]), 'victories': int(totals['victories'][i]),
+                 'battles': int(battles[i]), 'star_player': int(totals['star_player'][i])}
+                for i in order[:runners_up + 1] if battles[i] > 0]
+    return {'_id': f"{club['_id']}/{week_start:%G-W%V}", 'club': club['_id'], 'week_start': week_start,
+            'week_end': week_end, 'rankings': rankings, 'computed': datetime.utcnow()}
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""archive.py
+Append-only archive of raw Brawl Stars API responses.
+
+With BRAWLSTARS_ARCHIVE_DIR set, every successful api response is kept as one json line in
+<dir>/date=YYYY-MM-DD/<endpoint>-<host>-<pid>.jsonl.gz. Lines are serialized on the event loop,
+compressed and written by a background thread. Batches are appended as separate gzip members,
+and gzip reads them back as one stream. replay.py feeds an archive back through ingestion.
+"""
+import asyncio
+import gzip
+import heapq
+import json
+import logging
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger('brawlboss')
+
+
+class ResponseArchive:
+    def __init__(self, root, batch_size=None, max_delay=None):
+        """Collect api responses and write them in batches
+
+        Args:
+            root (str): Archive directory
+            batch_size (int): Responses per write, defaults to BRAWLSTARS_ARCHIVE_BATCH
+            max_delay (float): Seconds a response may wait for its batch, defaults to
+                BRAWLSTARS_ARCHIVE_SECONDS
+        """
+        self.root = root
+        self.batch_size = batch_size or int(os.getenv('BRAWLSTARS_ARCHIVE_BATCH', 500))
+        self.max_delay = max_delay or float(os.getenv('BRAWLSTARS_ARCHIVE_SECONDS', 60))
+        self.source = f'{socket.gethostname()}-{os.getpid()}'
+        self._lines = {}
+        self._count = 0
+        self._oldest = None
+        # One thread, so appends to a file never interleave
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archive')
+        self._writes = set()
+        self._task = None
+
+    @classmethod
+    def from_env(cls):
+        """Archive in BRAWLSTARS_ARCHIVE_DIR, None if archiving is off"""
+        root = os.getenv('BRAWLSTARS_ARCHIVE_DIR')
+        return cls(root) if root else None
+
+    def record(self, endpoint, tag, payload, fetched=None):
+        """Queue a response, must be called from the event loop
+
+        The payload is serialized right away, callers may change it afterwards.
+        """
+        fetched = fetched or datetime.utcnow()
+        line = json.dumps({'t': fetched.isoformat(), 'endpoint': endpoint, 'tag': tag, 'payload': payload},
+                          separators=(',', ':'), ensure_ascii=False)
+        self._lines.setdefault((fetched.date(), endpoint), []).append(line)
+        self._count += 1
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        if self._count >= self.batch_size or time.monotonic() - self._oldest >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        """Hand the queued responses to the writer thread"""
+        if not self._lines:
+            return
+        batches, self._lines = self._lines, {}
+        self._count = 0
+        self._oldest = None
+        write = asyncio.get_running_loop().run_in_executor(self._executor, self._write, batches)
+        self._writes.add(write)
+        write.add_done_callback(self._written)
+
+    def start(self):
+        """Flush in the background, so a quiet period does not hold responses back"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        while True:
+            delay = self.max_delay
+            if self._oldest is not None:
+                delay = self._oldest + self.max_delay - time.monotonic()
+                if delay <= 0:
+                    self.flush()
+                    delay = self.max_delay
+            await asyncio.sleep(max(delay, 0.1))
+
+    def _written(self, write):
+        self._writes.discard(write)
+        if not write.cancelled() and write.exception():
+            logger.error(f'Could not write to the response archive: {write.exception()}')
+
+    def path(self, day, endpoint):
+        return os.path.join(self.root, f'date={day:%Y-%m-%d}', f'{endpoint}-{self.source}.jsonl.gz')
+
+    def _write(self, batches):
+        for (day, endpoint), lines in batches.items():
+            path = self.path(day, endpoint)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with gzip.open(path, 'at', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+
+    async def close(self):
+        """Write everything queued and wait for the writer thread"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+
+def archive_files(root, since=None, until=None):
+    """Archive files of the days from since until the day before until, oldest day first"""
+    days = []
+    for name in os.listdir(root):
+        if not name.startswith('date='):
+            continue
+        day = datetime.strptime(name[len('date='):], '%Y-%m-%d')
+        if (since and day < since.replace(hour=0, minute=0, second=0, microsecond=0)) or (until and day >= until):
+            continue
+        days.append((day, name))
+    for day, name in sorted(days):
+        directory = os.path.join(root, name)
+        yield day, [os.path.join(directory, file) for file in sorted(os.listdir(directory))
+                    if file.endswith('.jsonl.gz')]
+
+
+def read_file(path):
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    record['t'] = datetime.fromisoformat(record['t'])
+                    yield record
+    except (EOFError, OSError) as e:
+        # A writer that was killed mid batch leaves a truncated last member
+        logger.warning(f'{path} ends early: {e}')
+
+
+def read_archive(root, since=None, until=None):
+    """Yield archived responses in the order they were fetched
+
+    Each file is in fetch order, the files of a day are merged on the fetch time.
+    """
+    for day, paths in archive_files(root, since, until):
+        for record in heapq.merge(*(read_file(path) for path in paths), key=lambda record: record['t']):
+            if (since and record['t'] < since) or (until and record['t'] >= until):
+                continue
+            yield record
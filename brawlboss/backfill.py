@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""backfill.py
+Rebuild the brawler_stats aggregates from the stored battle history.
+
+Ingestion only adds the battles it stores itself. Run this once for the history that was
+stored before, or after clubs were registered whose members already had battles stored.
+Weeks in the range are rebuilt from scratch. The current week is left alone by default,
+because the worker is still adding to it.
+
+    python brawlboss/backfill.py
+    python brawlboss/backfill.py --weeks 4 --include-current
+"""
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from pymongo import DeleteMany, ReplaceOne
+
+import database
+import helper
+
+logger = logging.getLogger('brawlboss')
+
+
+async def backfill(db, since_week=None, until_week=None, batch_size=1000):
+    """Recount the brawler stats of the weeks from since_week until until_week
+
+    Args:
+        db (database.BrawlBossDatabase): Database to rebuild
+        since_week (datetime): First week to rebuild, all history if None
+        until_week (datetime): Week to stop before, no limit if None
+        batch_size (int): Documents per bulk write
+
+    Returns:
+        tuple: (battles read, aggregate documents written)
+    """
+    tags = await db.refresh_member_tags()
+
+    time_range = {}
+    if since_week:
+        time_range['$gte'] = since_week
+    if until_week:
+        time_range['$lt'] = until_week
+    query = {'battleTime': time_range} if time_range else {}
+    projection = {'battleTime': 1, 'event': 1, 'battle.mode': 1, 'battle.result': 1, 'battle.rank': 1,
+                  'battle.duration': 1, 'battle.starPlayer.tag': 1, 'battle.teams': 1, 'battle.players': 1}
+
+    stats = {}
+    battles = 0
+    async for battle in db.db['battle'].find(query, projection):
+        battles += 1
+        for _id, fields, increments in database.battle_aggregates(battle, tags):
+            document = stats.get(_id)
+            if document is None:
+                document = stats[_id] = dict(fields, _id=_id, battles=0, victories=0, star_player=0, duration=0)
+            for field, value in increments.items():
+                document[field] += value
+
+    # Replace the weeks in the range, counts of players who left the clubs go as well
+    operations = [DeleteMany({'week': time_range} if time_range else {})]
+    operations.extend(ReplaceOne({'_id': _id}, document, upsert=True) for _id, document in stats.items())
+    for i in range(0, len(operations), batch_size):
+        await db.db['brawler_stats'].bulk_write(operations[i:i + batch_size], ordered=True)
+    return battles, len(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild brawler stats from the stored battles')
+    parser.add_argument('--weeks', type=int, help='Number of weeks to rebuild, all history by default')
+    parser.add_argument('--include-current', action='store_true', help='Also rebuild the current week')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s')
+    current_week = helper.week_start(datetime.utcnow())
+    since_week = current_week - timedelta(weeks=args.weeks) if args.weeks else None
+    until_week = None if args.include_current else current_week
+
+    async def run():
+        db = database.BrawlBossDatabase()
+        await db.ensure_indexes()
+        start = time.perf_counter()
+        battles, documents = await backfill(db, since_week, until_week)
+        logger.info(f'Rebuilt {documents} brawler stats from {battles} battles in '
+                    f'{time.perf_counter() - start:.1f} seconds')
+        db.client.close()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,20 @@ import logging
 import os
 import urllib.parse
 from pprint import pprint
-import aiohttp
-import requests
+import time
+
 import aiohttp
 import asyncio
 from dotenv import load_dotenv
-from requests import HTTPError
+
+import archive
+import metrics
 
 load_dotenv()
 
+# The battle log endpoint only returns this many of a player's latest battles
+BATTLE_LOG_SIZE = 25
+
 
 class BrawlApiEndpoint:
     base_url = 'https://api.brawlapi.com/v1'
@@ -25,10 +30,13 @@ class BrawlApiEndpoint:
 
 
 class BrawlStarsEndpoint:
-    base_url = 'https://api.brawlstars.com/v1'
-    brawlers = f'{base_url}/brawlers'
-    events = f'{base_url}/events/rotation'
-    definitions = f'{base_url}/#/definitions'
+    default_base_url = 'https://api.brawlstars.com/v1'
+
+    def __init__(self, base_url=None):
+        self.base_url = (base_url or os.getenv('BRAWLSTARS_API_URL') or self.default_base_url).rstrip('/')
+        self.brawlers = f'{self.base_url}/brawlers'
+        self.events = f'{self.base_url}/events/rotation'
+        self.definitions = f'{self.base_url}/#/definitions'
 
     def players(self, tag):
         return f'{self.base_url}/players/{urllib.parse.quote_plus(tag)}'
@@ -43,43 +51,244 @@ class BrawlStarsEndpoint:
         return f'{self.base_url}/clubs/{urllib.parse.quote_plus(tag)}/members'
 
 
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        """Token bucket that lets through rate requests per second on average
+
+        Args:
+            rate (float): Requests per second
+            burst (float): Bucket size, defaults to one second worth of requests
+        """
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def wait_time(self):
+        """Seconds until a request would be let through"""
+        tokens = min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate)
+        return max(1 - tokens, 0) / self.rate
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ApiKey:
+    def __init__(self, index, token, rate=None):
+        """Api token with its own request budget
+
+        Args:
+            index (int): Position in the pool, used as metric label instead of the token
+            token (str): Api token
+            rate (float): Requests per second budget of the token, unlimited if None
+        """
+        self.index = index
+        self.headers = {'Authorization': f'Bearer {token}'}
+        self.limiter = RateLimiter(rate) if rate else None
+        self.forbidden = 0
+        self.disabled_until = 0.0
+        self.backoff_until = 0.0
+        self.last_used = 0.0
+
+    def usable(self, now):
+        return now >= self.disabled_until
+
+    def wait_time(self, now):
+        """Seconds until the key may send its next request"""
+        wait = max(self.backoff_until - now, 0)
+        if self.limiter:
+            wait = max(wait, self.limiter.wait_time())
+        return wait
+
+
+class TokenPool:
+    def __init__(self, tokens=None, rate=None, max_forbidden=None, cooldown=None):
+        """Api tokens that requests are spread over
+
+        Each token has its own token bucket. Tokens are ip bound, a token that gets
+        max_forbidden 403 responses in a row is disabled for cooldown seconds. A token that
+        gets a 429 waits for its Retry-After while the others carry on.
+
+        Args:
+            tokens (list): Api tokens, defaults to the comma separated BRAWLSTARS_API_TOKENS
+                or BRAWLSTARS_API_TOKEN
+            rate (float): Requests per second budget of every token, defaults to
+                BRAWLSTARS_API_KEY_RATE or unlimited
+            max_forbidden (int): 403 responses in a row that disable a token,
+                defaults to BRAWLSTARS_API_KEY_MAX_FORBIDDEN
+            cooldown (float): Seconds a disabled token is left alone,
+                defaults to BRAWLSTARS_API_KEY_COOLDOWN
+        """
+        if tokens is None:
+            tokens = os.getenv('BRAWLSTARS_API_TOKENS') or os.getenv('BRAWLSTARS_API_TOKEN') or ''
+            tokens = [token.strip() for token in tokens.split(',') if token.strip()]
+        rate = rate or float(os.getenv('BRAWLSTARS_API_KEY_RATE', 0))
+        self.keys = [ApiKey(i, token, rate) for i, token in enumerate(tokens or [None])]
+        self.max_forbidden = max_forbidden or int(os.getenv('BRAWLSTARS_API_KEY_MAX_FORBIDDEN', 3))
+        self.cooldown = cooldown or float(os.getenv('BRAWLSTARS_API_KEY_COOLDOWN', 600))
+        metrics.API_KEYS_USABLE.set(len(self.keys))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def usable(self):
+        now = time.monotonic()
+        return [key for key in self.keys if key.usable(now)]
+
+    async def acquire(self):
+        """Wait for the key that can send a request soonest
+
+        Returns:
+            ApiKey: None if every key is disabled
+        """
+        while True:
+            now = time.monotonic()
+            keys = [key for key in self.keys if key.usable(now)]
+            metrics.API_KEYS_USABLE.set(len(keys))
+            if not keys:
+                return None
+            # Least recently used first among the keys that are ready
+            key = min(keys, key=lambda k: (k.wait_time(now), k.last_used))
+            wait = key.wait_time(now)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        if key.limiter:
+            await key.limiter.acquire()
+        key.last_used = time.monotonic()
+        metrics.API_KEY_REQUESTS.inc(key=key.index)
+        return key
+
+    def report(self, key, status, retry_after=None):
+        """Update the health of a key with the status of its response"""
+        if status == 403:
+            key.forbidden += 1
+            if key.forbidden >= self.max_forbidden:
+                key.forbidden = 0
+                key.disabled_until = time.monotonic() + self.cooldown
+                logging.error(f'Api token {key.index} got {self.max_forbidden} 403 responses in a row, '
+                              f'disabled for {self.cooldown:.0f} seconds')
+        elif status == 429:
+            delay = int(retry_after) if retry_after and retry_after.isdigit() else 1
+            key.backoff_until = time.monotonic() + delay
+        else:
+            key.forbidden = 0
+
+
 class BrawlStarsApiAsync:
-    def __init__(self):
-        self.headers = {
-            'Authorization': f'Bearer {os.getenv("BRAWLSTARS_API_TOKEN")}'
-        }
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, base_url=None, rate=None, tokens=None, key_rate=None):
+        """Brawl Stars api client, use as an async context manager
+
+        Args:
+            base_url (str): Api root, defaults to BRAWLSTARS_API_URL or the official api
+            rate (float): Requests per second budget, defaults to BRAWLSTARS_API_RATE or unlimited
+            tokens (list): Api tokens, see TokenPool
+            key_rate (float): Requests per second budget of every token, see TokenPool
+        """
+        self.endpoint = BrawlStarsEndpoint(base_url)
+        self.tokens = TokenPool(tokens, key_rate)
+        self.archive = None
+        self.max_retries = int(os.getenv('BRAWLSTARS_API_RETRIES', 2))
+        rate = rate or float(os.getenv('BRAWLSTARS_API_RATE', 0))
+        self.limiter = RateLimiter(rate) if rate else None
 
     async def __aenter__(self):
         self._session = aiohttp.ClientSession()
+        # Raw responses are kept when BRAWLSTARS_ARCHIVE_DIR is set
+        self.archive = archive.ResponseArchive.from_env()
+        if self.archive is not None:
+            self.archive.start()
         return self
 
     async def __aexit__(self, *err):
         await self._session.close()
         self._session = None
+        if self.archive is not None:
+            await self.archive.close()
+            self.archive = None
+
+    async def _get(self, url, endpoint='unknown', tag=None, with_status=False, **kwargs):
+        """GET an url from the api, retrying rate limited and failed requests
+
+        Args:
+            url (str): Full url to request
+            endpoint (str): Endpoint name used as metric label
+            tag (str): Player or club tag of the request, stored with archived responses
+            with_status (bool): Also return the status of the last response
 
-    async def _get(self, url, *args, **kwargs):
-        async with self._session.get(url, headers=self.headers, *args, **kwargs) as response:
-            if response.status == 200:
-                return await response.json()
-            else:
-                logging.warning(f'{response.status}: {response.reason}')
-                return {}
+        Returns:
+            dict: Json response or an empty dict on errors, (response, status) with with_status,
+                the status is None if no request could be sent
+        """
+        for attempt in range(self.max_retries + 1):
+            key = await self.tokens.acquire()
+            if key is None:
+                logging.error(f'Every api token is disabled, skipping {endpoint}')
+                return ({}, None) if with_status else {}
+            if self.limiter:
+                await self.limiter.acquire()
+            with metrics.API_LATENCY.time(endpoint=endpoint):
+                async with self._session.get(url, headers=key.headers, **kwargs) as response:
+                    metrics.API_RESPONSES.inc(endpoint=endpoint, status=response.status)
+                    retry_after = response.headers.get('Retry-After')
+                    self.tokens.report(key, response.status, retry_after)
+                    if response.status == 200:
+                        data = await response.json()
+                        if self.archive is not None:
+                            self.archive.record(endpoint, tag, data)
+                        return (data, response.status) if with_status else data
+
+            # A token that is forbidden or rate limited may not hold for the other tokens
+            other_key = response.status in (403, 429) and len(self.tokens) > 1 and self.tokens.usable()
+            if (response.status not in self.retry_statuses and not other_key) or attempt == self.max_retries:
+                break
+            metrics.API_RETRIES.inc(endpoint=endpoint)
+            if other_key:
+                logging.info(f'{response.status}: {response.reason}, retrying {endpoint} with another token')
+                continue
+            delay = int(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt
+            logging.info(f'{response.status}: {response.reason}, retrying {endpoint} in {delay} seconds')
+            await asyncio.sleep(delay)
+
+        logging.warning(f'{response.status}: {response.reason}')
+        return ({}, response.status) if with_status else {}
 
     async def get_events(self):
-        endpoint = BrawlStarsEndpoint.events
-        return await self._get(endpoint)
+        url = self.endpoint.events
+        return await self._get(url, endpoint='events')
 
     async def get_players(self, tag):
-        endpoint = BrawlStarsEndpoint().players(tag)
-        return await self._get(endpoint)
+        url = self.endpoint.players(tag)
+        return await self._get(url, endpoint='players', tag=tag)
+
+    async def find_player(self, tag):
+        """Get a player, telling a tag that does not exist apart from a failed request
+
+        Returns:
+            tuple: (player or an empty dict, True if the api says the player does not exist)
+        """
+        url = self.endpoint.players(tag)
+        data, status = await self._get(url, endpoint='players', tag=tag, with_status=True)
+        return data, status == 404
 
     async def get_players_battle_log(self, tag):
-        endpoint = BrawlStarsEndpoint().players_battle_log(tag)
-        return await self._get(endpoint)
+        url = self.endpoint.players_battle_log(tag)
+        return await self._get(url, endpoint='players_battle_log', tag=tag)
 
     async def get_club(self, tag):
-        endpoint = BrawlStarsEndpoint().clubs(tag)
-        return await self._get(endpoint)
+        url = self.endpoint.clubs(tag)
+        return await self._get(url, endpoint='clubs', tag=tag)
 
 
 async def main():
@@ -2,14 +2,22 @@
 """database.py
 Description of database.py.
 """
+import copy
+import hashlib
+import json
 import logging
 import os
+import re
 from datetime import datetime, timedelta, timezone
 from pprint import pprint
 
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import InsertOne, ReplaceOne, UpdateOne
 
 import helper
+import metrics
+import profiler
+import writebuffer
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -72,6 +80,16 @@ class MongoQueries:
         }
         return query
 
+    @staticmethod
+    def members_in_battle(tags: list):
+        """Battles with any of tags in a team or among the showdown players"""
+        return {
+            '$or': [
+                {'battle.teams': {'$elemMatch': {'$elemMatch': {'tag': {'$in': tags}}}}},
+                {'battle.players': {'$elemMatch': {'tag': {'$in': tags}}}},
+            ]
+        }
+
     @classmethod
     def star_player_battles(cls, tag):
         query = {
@@ -252,19 +270,235 @@ class MongoQueries:
         return pipeline
 
 
-class BrawlBossDatabase:
+def mongodb_uri():
+    """Connection string from MONGODB_URI or MONGODB_HOST and MONGODB_PORT"""
+    host = os.getenv('MONGODB_HOST', '0.0.0.0')
+    port = os.getenv('MONGODB_PORT', 27017)
+    return os.getenv('MONGODB_URI', f'mongodb://{host}:{port}/')
+
+
+def battle_document(data):
+    """Turn a battle log item into the document stored in the battle collection
+
+    The battle time is stored as a datetime and its timestamp is used as _id.
+
+    Args:
+        data (dict): Battle log item from the api, modified in place
+
+    Returns:
+        dict: The battle document
+    """
+    battle_time = data['battleTime']
+    if not isinstance(battle_time, datetime):
+        data['_id'] = helper.battle_time_to_timestamp(battle_time)
+        data['battleTime'] = helper.battle_time_to_datetime(battle_time)
+    return data
+
+
+def battle_aggregates(data, tags):
+    """Brawler stats one stored battle adds for each participant in tags
+
+    Stats are kept per (tag, brawler, mode, map, week) in the brawler_stats collection.
+
+    Args:
+        data (dict): Stored battle document
+        tags (Container): Players to keep stats for, the members of the stored clubs
+
+    Returns:
+        list: (_id, key fields, increments) for every participant in tags
+    """
+    battle = data.get('battle', {})
+    event = data.get('event', {})
+    mode = battle.get('mode') or event.get('mode')
+    map_name = event.get('map')
+    week = helper.week_start(data['battleTime'])
+    victory = helper.is_victory(data)
+    star_player = (battle.get('starPlayer') or {}).get('tag')
+
+    aggregates = []
+    for team, player in helper.battle_participants(data):
+        tag = player.get('tag')
+        if tag not in tags:
+            continue
+        brawler = helper.player_brawler(player).get('name')
+        fields = {'tag': tag, 'brawler': brawler, 'mode': mode, 'map': map_name, 'week': week}
+        increments = {'battles': 1, 'victories': int(victory), 'star_player': int(star_player == tag),
+                      'duration': battle.get('duration') or 0}
+        aggregates.append((f'{tag}/{brawler}/{mode}/{map_name}/{week:%Y-%m-%d}', fields, increments))
+    return aggregates
+
+
+def aggregate_update(aggregate):
+    """Upsert that adds one battle_aggregates entry to its brawler_stats document"""
+    _id, fields, increments = aggregate
+    return UpdateOne({'_id': _id}, {'$setOnInsert': fields, '$inc': increments}, upsert=True)
+
+
+def fingerprint(data):
+    """Stable hash of an api payload, _id and _fingerprint are left out"""
+    payload = {key: value for key, value in data.items() if key not in ('_id', '_fingerprint')}
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+def diff_members(club_tag, previous, members, now=None):
+    """Membership events between two rosters of a club
+
+    Args:
+        club_tag (str): Club of the rosters
+        previous (dict): Stored members by tag
+        members (list): Members from the api
+        now (datetime): Time of the events
+
+    Returns:
+        list: 'join', 'leave', 'role' and 'trophies' events, role and trophy changes have from and to
+    """
+    now = now or datetime.utcnow()
+    current = {member['tag']: member for member in members}
+    events = []
+
+    def event(kind, member, **fields):
+        events.append(dict({'club': club_tag, 'tag': member['tag'], 'name': member.get('name'), 'type': kind,
+                            'role': member.get('role'), 'trophies': member.get('trophies'), 'time': now},
+                           **fields))
+
+    for tag, member in current.items():
+        old = previous.get(tag)
+        if old is None:
+            event('join', member)
+            continue
+        if member.get('role') != old.get('role'):
+            event('role', member, **{'from': old.get('role'), 'to': member.get('role')})
+        if member.get('trophies') != old.get('trophies'):
+            event('trophies', member, **{'from': old.get('trophies'), 'to': member.get('trophies')})
+    for tag, member in previous.items():
+        if tag not in current:
+            event('leave', member)
+    return events
+
+
+def series_values(data):
+    """Numeric player fields kept in the player_history time series
+
+    Brawler trophies are nested under 'brawlers' by brawler id, field names with dots can not
+    be stored or updated before MongoDB 5.0.
+    """
+    values = {field: data[field] for field in ('trophies', 'highestTrophies', 'expPoints') if field in data}
+    brawlers = {str(brawler['id']): brawler.get('trophies') for brawler in data.get('brawlers', [])}
+    if brawlers:
+        values['brawlers'] = brawlers
+    return values
+
+
+def series_deltas(previous, values):
+    """Changed fields of values relative to previous, as differences, nested like values"""
+    deltas = {}
+    for field, value in values.items():
+        if isinstance(value, dict):
+            nested = series_deltas(previous.get(field) or {}, value)
+            if nested:
+                deltas[field] = nested
+        elif value is not None and value != previous.get(field):
+            deltas[field] = value - (previous.get(field) or 0)
+    return deltas
+
+
+def apply_deltas(values, deltas):
+    """Add series_deltas to values in place"""
+    for field, delta in deltas.items():
+        if isinstance(delta, dict):
+            apply_deltas(values.setdefault(field, {}), delta)
+        else:
+            values[field] = (values.get(field) or 0) + delta
+    return values
+
+
+def decode_history(buckets):
+    """Yield (time, values) for every point in player_history buckets, oldest first
+
+    The first point of every bucket is its base, the values before the bucket's first change.
+    """
+    for bucket in buckets:
+        values = copy.deepcopy(bucket['base'])
+        yield bucket['start'], copy.deepcopy(values)
+        for point in bucket.get('points', []):
+            apply_deltas(values, point['d'])
+            yield point['t'], copy.deepcopy(values)
+
+
+class DataVersions:
+    """In-process version counters, bumped whenever ingestion changes a document"""
+
     def __init__(self):
-        self.client = None
+        self._versions = {}
+        self._epoch = 0
+
+    def get(self, kind, key=None):
+        """Version of a single document, or of the whole kind when key is None"""
+        return self._epoch, self._versions.get((kind, key), 0)
+
+    def bump(self, kind, key=None):
+        self._versions[(kind, key)] = self._versions.get((kind, key), 0) + 1
+        if key is not None:
+            self._versions[(kind, None)] = self._versions.get((kind, None), 0) + 1
+
+    def invalidate_all(self):
+        """Change every version at once, for when changes may have been missed"""
+        self._epoch += 1
 
-        # Get server details
-        host = os.getenv('MONGODB_HOST', '0.0.0.0')
-        port = os.getenv('MONGODB_PORT', 27017)
+
+@metrics.instrument_methods(metrics.DB_LATENCY)
+class BrawlBossDatabase:
+    def __init__(self, database_name=None):
+        self.client = None
+        self.versions = DataVersions()
+        self.discord_tags = {}
+        # Players that get brawler stats, see battle_aggregates
+        self.member_tags = set()
+        # Latest player_history values per tag, the base of the next delta
+        self.series_last = {}
+        # Fingerprint of the last stored payload per (collection, _id), see _changed
+        self.fingerprints = {}
+        # Last stored members per club by tag, see club_roster
+        self.club_members = {}
+        # When each player profile was last fetched by this process, see profile_due
+        self.profile_fetched = {}
 
         # Client
-        database_name = 'brawlboss'
-        uri = os.getenv('MONGODB_URI', f'mongodb://{host}:{port}/')
-        self.client = AsyncIOMotorClient(uri)
-        self.db = self.client[database_name]
+        self.database_name = database_name or os.getenv('MONGODB_DATABASE', 'brawlboss')
+        self.client = AsyncIOMotorClient(mongodb_uri())
+        self.db = self.client[self.database_name]
+
+        # Opt-in slow query profiling
+        self.profiler = None
+        if os.getenv('BRAWLBOSS_PROFILE_QUERIES'):
+            self.profiler = profiler.QueryProfiler(self.db)
+            self.db = self.profiler.wrap(self.db)
+
+        # Ingestion queues its writes here when enabled
+        self.write_buffer = None
+        # Time of the snapshot being ingested, set by replay.py, now if None
+        self.clock = None
+
+    def now(self):
+        """Time that ingestion stamps snapshots with"""
+        return self.clock or datetime.utcnow()
+
+    def enable_write_buffer(self, **kwargs):
+        """Queue ingestion writes in a writebuffer.WriteBuffer and flush them in batches
+
+        Must be called from a running event loop. Call close_write_buffer before exiting so
+        nothing queued is lost.
+        """
+        self.write_buffer = writebuffer.WriteBuffer(self.db, self.versions, **kwargs)
+        self.write_buffer.start()
+        return self.write_buffer
+
+    async def close_write_buffer(self):
+        """Flush and stop the write buffer, writes go straight to the database afterwards"""
+        if self.write_buffer is not None:
+            write_buffer, self.write_buffer = self.write_buffer, None
+            await write_buffer.close()
 
     async def _upsert(self, collection: str, data: dict, _id=None, query=None):
         """
@@ -291,12 +525,63 @@ class BrawlBossDatabase:
         # Use the update_one() method to upsert the data into the collection.
         is_new = False if await coll.find_one(query) else True
         result = await coll.update_one(query, {'$set': data}, upsert=True)
-        # if result.modified_count >= 1:
-        #     is_new = False
+        if result.upserted_id is not None or result.modified_count:
+            self.versions.bump(collection, _id)
 
         # Find the document and return it.
         return await coll.find_one(query), is_new
 
+    async def _changed(self, collection: str, data: dict):
+        """Fingerprint an api payload and compare it with the stored document
+
+        Sets _id and _fingerprint on data. The stored fingerprint is read once per document,
+        afterwards the one remembered by _stored is compared.
+
+        Returns:
+            tuple: (is_new, changed)
+        """
+        data['_id'] = data['tag']
+        data['_fingerprint'] = fingerprint(data)
+        key = (collection, data['_id'])
+        if key in self.fingerprints:
+            stored, is_new = self.fingerprints[key], False
+        else:
+            document = await self.db[collection].find_one({'_id': data['_id']}, {'_fingerprint': 1})
+            stored, is_new = (document or {}).get('_fingerprint'), document is None
+        changed = stored != data['_fingerprint']
+        if not changed:
+            self.fingerprints[key] = stored
+            metrics.UNCHANGED_UPSERTS.inc(collection=collection)
+        return is_new, changed
+
+    def _stored(self, collection: str, data: dict):
+        """Remember the fingerprint of a payload that was written or queued"""
+        self.fingerprints[(collection, data['_id'])] = data['_fingerprint']
+
+    def _forget(self, collection: str, _id):
+        """Drop the fingerprint of a queued payload that was never written
+
+        The next payload compares with the stored fingerprint again, so it is written even if
+        it is identical to the lost one.
+        """
+        self.fingerprints.pop((collection, _id), None)
+
+    def _lost_write(self, collection: str, _id):
+        return lambda: self._forget(collection, _id)
+
+    async def _upsert_changed(self, collection: str, data: dict):
+        """Upsert an api payload unless it is identical to the stored document
+
+        Returns:
+            tuple: (document, is_new, changed)
+        """
+        is_new, changed = await self._changed(collection, data)
+        if changed:
+            await self.db[collection].update_one({'_id': data['_id']}, {'$set': data}, upsert=True)
+            self.versions.bump(collection, data['_id'])
+            self._stored(collection, data)
+        return data, is_new, changed
+
     async def _aggregate(self, collection: str, pipeline: list):
         """Aggregate documents"""
         coll = self.db[collection]
@@ -384,10 +669,14 @@ class BrawlBossDatabase:
             data (dict): A dictionary containing the Brawl Stars player data.
 
         Returns:
-            dict: The result of the upsert operation.
+            tuple: (document, is_new, changed), unchanged players are not written
         """
         collection_name = 'player'
-        return await self._upsert(collection_name, _id=data['tag'], data=data)
+        self.profile_fetched[data['tag']] = self.now()
+        document, is_new, changed = await self._upsert_changed(collection_name, data)
+        if changed:
+            await self.record_player_history(data)
+        return document, is_new, changed
 
     async def upsert_battle(self, data):
         """
@@ -399,13 +688,131 @@ class BrawlBossDatabase:
         Returns:
             dict: The result of the upsert operation.
         """
-        battle_time = data['battleTime']
-        timestamp = helper.battle_time_to_timestamp(battle_time)
-        data['battleTime'] = helper.battle_time_to_datetime(battle_time)
+        data = battle_document(data)
 
         # Upsert
         collection_name = 'battle'
-        return await self._upsert(collection_name, _id=timestamp, data=data)
+        battle, is_new = await self._upsert(collection_name, _id=data['_id'], data=data)
+
+        # Invalidate rendered responses of everyone who played in it
+        if is_new:
+            for tag in helper.battle_participant_tags(data):
+                self.versions.bump('player', tag)
+
+            # Only new battles are counted, so nothing is counted twice
+            updates = [aggregate_update(aggregate) for aggregate in battle_aggregates(data, self.member_tags)]
+            if updates:
+                await self.db['brawler_stats'].bulk_write(updates, ordered=False)
+        return battle, is_new
+
+    async def buffer_player(self, data):
+        """Queue a player upsert in the write buffer
+
+        Returns:
+            tuple: (document as it will be stored, is_new, changed), unchanged players are not queued
+        """
+        self.profile_fetched[data['tag']] = self.now()
+        is_new, changed = await self._changed('player', data)
+        if changed:
+            await self.record_player_history(data)
+            self._stored('player', data)
+            await self.write_buffer.add('player', UpdateOne({'_id': data['_id']}, {'$set': data}, upsert=True),
+                                        bumps=[('player', data['_id'])], lost=self._lost_write('player', data['_id']))
+        return data, is_new, changed
+
+    async def record_player_history(self, data, now=None):
+        """Append the changed trophies, exp and brawler trophies of a player snapshot to player_history
+
+        History is stored in one bucket per player and week. A bucket has the values at its
+        start and a point with the changed fields as deltas for every snapshot that changed
+        something. Unchanged snapshots are not written.
+        """
+        tag = data['tag']
+        now = now or self.now()
+        start = helper.week_start(now)
+        values = series_values(data)
+
+        previous = self.series_last.get(tag)
+        if previous is None:
+            cursor = self.db['player_history'].find({'tag': tag}, {'last': 1}).sort('start', -1).limit(1)
+            previous = next(iter(await cursor.to_list(length=1)), {}).get('last')
+        deltas = series_deltas(previous, values) if previous is not None else {}
+        if previous is not None and not deltas:
+            return False
+        self.series_last[tag] = values
+
+        update = {'$setOnInsert': {'tag': tag, 'start': start, 'base': previous or values}, '$set': {'last': values}}
+        if deltas:
+            update['$push'] = {'points': {'t': now, 'd': deltas}}
+        operation = UpdateOne({'_id': f'{tag}/{start:%Y-%m-%d}'}, update, upsert=True)
+        # A lost write leaves the stored series behind the cached values, reload them next time
+        forget = lambda: self.series_last.pop(tag, None)
+        if self.write_buffer is not None:
+            await self.write_buffer.add('player_history', operation, lost=forget)
+        else:
+            try:
+                await self.db['player_history'].bulk_write([operation])
+            except Exception:
+                forget()
+                raise
+        return True
+
+    async def player_history(self, tag, since_date: datetime, until_date: datetime = None):
+        """Return (time, values) points of a player's history from since_date on
+
+        The first point holds the values at since_date.
+        """
+        query = {'tag': tag, 'start': {'$gte': helper.week_start(since_date)}}
+        if until_date:
+            query['start']['$lt'] = until_date
+        buckets = await self.db['player_history'].find(query).sort('start', 1).to_list(length=None)
+        points = []
+        for point_time, values in decode_history(buckets):
+            if until_date and point_time >= until_date:
+                break
+            if point_time <= since_date and points:
+                points[0] = (since_date, values)
+            elif point_time <= since_date:
+                points.append((since_date, values))
+            else:
+                points.append((point_time, values))
+        return points
+
+    async def trophies_gained(self, tag, since_date: datetime, field='trophies'):
+        """Change of a history field since since_date, None without history"""
+        points = await self.player_history(tag, since_date)
+        if not points or field not in points[-1][1]:
+            return None
+        return points[-1][1][field] - points[0][1].get(field, points[-1][1][field])
+
+    async def buffer_battle(self, data):
+        """Queue a battle insert in the write buffer, battles that are already stored are left as is
+
+        Returns:
+            dict: The battle document as it will be stored
+        """
+        data = battle_document(data)
+        bumps = [('battle', data['_id'])] + [('player', tag) for tag in helper.battle_participant_tags(data)]
+        follow_ups = [('brawler_stats', aggregate_update(aggregate))
+                      for aggregate in battle_aggregates(data, self.member_tags)]
+        await self.write_buffer.add('battle', UpdateOne({'_id': data['_id']}, {'$setOnInsert': data}, upsert=True),
+                                    bumps=bumps, insert_only=True, follow_ups=follow_ups)
+        return data
+
+    async def buffer_club(self, data):
+        """Queue a club upsert in the write buffer
+
+        Returns:
+            tuple: (document as it will be stored, is_new, changed), unchanged clubs are not queued
+        """
+        self.member_tags.update(member['tag'] for member in data.get('members', []))
+        self.club_members[data['tag']] = {member['tag']: member for member in data.get('members', [])}
+        is_new, changed = await self._changed('club', data)
+        if changed:
+            self._stored('club', data)
+            await self.write_buffer.add('club', UpdateOne({'_id': data['_id']}, {'$set': data}, upsert=True),
+                                        bumps=[('club', data['_id'])], lost=self._lost_write('club', data['_id']))
+        return data, is_new, changed
 
     async def upsert_club(self, data):
         """
@@ -415,10 +822,57 @@ class BrawlBossDatabase:
             data (dict): A dictionary containing the Brawl Stars club data.
 
         Returns:
-            dict: The result of the upsert operation.
+            tuple: (document, is_new, changed), unchanged clubs are not written
         """
         collection_name = 'club'
-        return await self._upsert(collection_name, _id=data['tag'], data=data)
+        self.member_tags.update(member['tag'] for member in data.get('members', []))
+        self.club_members[data['tag']] = {member['tag']: member for member in data.get('members', [])}
+        return await self._upsert_changed(collection_name, data)
+
+    async def club_roster(self, club_tag):
+        """Members of the stored club by tag, None if the club is not stored"""
+        if club_tag not in self.club_members:
+            club = await self.db['club'].find_one({'_id': club_tag}, {'members': 1})
+            if club is None:
+                return None
+            self.club_members[club_tag] = {member['tag']: member for member in club.get('members', [])}
+        return self.club_members[club_tag]
+
+    async def insert_club_events(self, events):
+        """Store membership events, see diff_members"""
+        for event in events:
+            metrics.CLUB_EVENTS.inc(type=event['type'])
+        if not events:
+            return
+        if self.write_buffer is not None:
+            for event in events:
+                await self.write_buffer.add('club_event', InsertOne(event))
+        else:
+            await self.db['club_event'].insert_many(events)
+
+    async def club_events(self, club_tag, since_date: datetime = None, types=None, limit=50):
+        """Return the membership events of a club, newest first"""
+        query = {'club': club_tag}
+        if since_date:
+            query['time'] = {'$gte': since_date}
+        if types:
+            query['type'] = {'$in': list(types)}
+        cursor = self.db['club_event'].find(query, {'_id': 0}).sort('time', -1).limit(limit)
+        return await cursor.to_list(length=None)
+
+    def profile_due(self, tag, max_age: timedelta = None):
+        """Whether a player profile should be fetched again
+
+        Profiles are due when this process has not fetched them within max_age, defaults to
+        PLAYER_PROFILE_MAX_HOURS, or when mark_profiles_stale was called for them.
+        """
+        max_age = max_age or timedelta(hours=float(os.getenv('PLAYER_PROFILE_MAX_HOURS', 6)))
+        fetched = self.profile_fetched.get(tag)
+        return fetched is None or self.now() - fetched >= max_age
+
+    def mark_profiles_stale(self, tags):
+        for tag in tags:
+            self.profile_fetched.pop(tag, None)
 
     async def upsert_discord(self, data):
         """
@@ -428,18 +882,54 @@ class BrawlBossDatabase:
             data (dict): A dictionary containing the discord member.
 
         Returns:
-            dict: The result of the upsert operation.
+            dict: The stored document.
         """
-        return await self._upsert("discord", _id=data['_id'], data=data)
+        self.discord_tags[data['_id']] = data['tag']
+        result = await self.db['discord'].update_one({'_id': data['_id']}, {'$set': data}, upsert=True)
+        if result.upserted_id is not None or result.modified_count:
+            self.versions.bump('discord', data['_id'])
+        return data
+
+    async def player_exists(self, tag):
+        """Whether a player is stored"""
+        return await self.db['player'].find_one({'_id': tag}, {'_id': 1}) is not None
 
     async def player_from_discord_id(self, discord_id):
         player = None
         collection = self.db['discord']
         discord_doc = await collection.find_one({'_id': discord_id})
         if discord_doc:
+            self.discord_tags[discord_id] = discord_doc['tag']
             player = await self.db['player'].find_one({'_id': discord_doc['tag']})
         return player
 
+    async def profile_version(self, discord_id):
+        """Data version of the profile linked to a discord id, usable as a cache key
+
+        Derived from the stored player and its newest polled battle, so it also changes with
+        the writes of the ingestion worker when no change stream is followed.
+        """
+        tag = self.discord_tags.get(discord_id)
+        if tag is None:
+            link = await self.db['discord'].find_one({'_id': discord_id}, {'tag': 1})
+            if link is None:
+                return None, self.versions.get('discord', discord_id)
+            tag = self.discord_tags[discord_id] = link['tag']
+        player = await self.db['player'].find_one({'_id': tag}, {'_fingerprint': 1})
+        state = await self.db['ingest_state'].find_one({'_id': tag}, {'last_battle': 1})
+        return (tag, (player or {}).get('_fingerprint'), (state or {}).get('last_battle'),
+                self.versions.get('discord', discord_id), self.versions.get('player', tag))
+
+    async def rankings_version(self, club_tag):
+        """Data version of the club rankings, changes with the roster or any member's newest battle"""
+        club = await self.db['club'].find_one({'_id': club_tag}, {'_fingerprint': 1, 'members.tag': 1})
+        if club is None:
+            return None, self.versions.get('club', club_tag)
+        tags = [member['tag'] for member in club.get('members', [])]
+        cursor = self.db['ingest_state'].find({'_id': {'$in': tags}}, {'last_battle': 1}).sort('last_battle', -1)
+        newest = next(iter(await cursor.limit(1).to_list(length=1)), {}).get('last_battle')
+        return club.get('_fingerprint'), newest, self.versions.get('club', club_tag), self.versions.get('player')
+
     async def get_battles_since(self, tag, weeks=0, days=0, hours=0, minutes=0, seconds=0):
         # Battles since a certain date
         collection = self.db.battle
@@ -512,19 +1002,34 @@ class BrawlBossDatabase:
         durations = await self._aggregate('battle', pipeline)
         return durations[0]
 
-    async def player_of_the_week(self, club_tag):
-        # Battles since a certain date
-        since_date = datetime.utcnow() - timedelta(days=7)
+    async def player_of_the_week(self, club_tag, week_start: datetime = None):
+        """Return the stored player of the week award of a club, the latest one if week_start is None
 
-        club = await self.get_club(club_tag)
-        members = club['members']
-        # For each player in club
-        # Get win rate
-        # Get star player count
-        # Add to list
-        # Sort list by star player count*win rate
-        # Return top player
-        return players
+        Awards are computed once per week by the ingestion worker, see
+        analytics.player_of_the_week.
+        """
+        query = {'club': club_tag}
+        if week_start:
+            query['week_start'] = week_start
+        cursor = self.db['player_of_the_week'].find(query).sort('week_start', -1).limit(1)
+        for award in await cursor.to_list(length=1):
+            return award
+        return None
+
+    async def player_of_the_week_history(self, club_tag, limit=10):
+        """Return the latest player of the week awards of a club, newest first"""
+        cursor = self.db['player_of_the_week'].find({'club': club_tag}).sort('week_start', -1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def save_player_of_the_week(self, award):
+        await self.db['player_of_the_week'].replace_one({'_id': award['_id']}, award, upsert=True)
+
+    async def ensure_indexes(self):
+        """Create the indexes of the collections written by ingestion"""
+        await self.db['player_of_the_week'].create_index([('club', 1), ('week_start', -1)])
+        await self.db['brawler_stats'].create_index([('tag', 1), ('week', -1)])
+        await self.db['player_history'].create_index([('tag', 1), ('start', -1)])
+        await self.db['club_event'].create_index([('club', 1), ('time', -1)])
 
     async def get_club(self, club_tag):
         """
@@ -539,6 +1044,141 @@ class BrawlBossDatabase:
         club = await collection.find_one({'_id': club_tag})
         return club
 
+    async def register_club(self, club_tag):
+        """Add a club to the registry of clubs that ingestion workers keep up to date
+
+        Args:
+            club_tag: Club tag including the leading #
+
+        Returns:
+            bool: True if the club was not registered before
+        """
+        result = await self.db['club_registry'].update_one(
+            {'_id': club_tag},
+            {'$set': {'active': True}, '$setOnInsert': {'added': datetime.utcnow()}},
+            upsert=True)
+        return result.upserted_id is not None
+
+    async def unregister_club(self, club_tag):
+        """Stop tracking a club, its stored data is kept"""
+        await self.db['club_registry'].update_one({'_id': club_tag}, {'$set': {'active': False}})
+
+    async def registered_clubs(self):
+        """Return the tags of all active clubs in the registry"""
+        cursor = self.db['club_registry'].find({'active': True}, {'_id': 1})
+        return [document['_id'] for document in await cursor.to_list(length=None)]
+
+    async def get_ingest_states(self, tags):
+        """Return the stored refresh scheduling state of the given players"""
+        cursor = self.db['ingest_state'].find({'_id': {'$in': list(tags)}})
+        return await cursor.to_list(length=None)
+
+    async def save_ingest_state(self, state):
+        """Store the refresh scheduling state of a player"""
+        if self.write_buffer is not None:
+            await self.write_buffer.add('ingest_state', ReplaceOne({'_id': state['_id']}, dict(state), upsert=True))
+        else:
+            await self.db['ingest_state'].replace_one({'_id': state['_id']}, state, upsert=True)
+
+    async def changed_ingest_states(self, since_date: datetime):
+        """Return the ingest state of the players polled since since_date"""
+        cursor = self.db['ingest_state'].find({'last_poll': {'$gte': since_date}}, {'last_battle': 1})
+        return await cursor.to_list(length=None)
+
+    async def club_rosters(self):
+        """Return the member tags of every stored club"""
+        cursor = self.db['club'].find({}, {'members.tag': 1})
+        return {club['_id']: frozenset(member['tag'] for member in club.get('members', []))
+                for club in await cursor.to_list(length=None)}
+
+    async def refresh_member_tags(self):
+        """Load the members of every stored club, they are the players that get brawler stats"""
+        self.member_tags = set().union(*(await self.club_rosters()).values())
+        return self.member_tags
+
+    async def brawler_stats(self, tags, since_week: datetime, group_by, brawler=None, map_name=None):
+        """Sum the brawler stats of tags since since_week
+
+        Args:
+            tags (list): Players to include
+            since_week (datetime): First week to include
+            group_by (str): Field to group by, 'mode', 'map' or 'brawler'
+            brawler (str): Only this brawler, case insensitive
+            map_name (str): Only this map, case insensitive
+
+        Returns:
+            list: {'_id': group, 'battles', 'victories', 'star_player', 'duration'}, most battles first
+        """
+        match = {'tag': {'$in': list(tags)}, 'week': {'$gte': since_week}}
+        if brawler:
+            match['brawler'] = {'$regex': f'^{re.escape(brawler)}$', '$options': 'i'}
+        if map_name:
+            match['map'] = {'$regex': f'^{re.escape(map_name)}$', '$options': 'i'}
+        pipeline = [
+            {'$match': match},
+            {'$group': {'_id': f'${group_by}', 'battles': {'$sum': '$battles'},
+                        'victories': {'$sum': '$victories'}, 'star_player': {'$sum': '$star_player'},
+                        'duration': {'$sum': '$duration'}}},
+            {'$sort': {'battles': -1}},
+        ]
+        return await self._aggregate('brawler_stats', pipeline)
+
+    async def recent_battle_results(self, tag, since_date: datetime):
+        """Return the time and outcome of every battle of a player since since_date"""
+        query = MongoQueries.battle_count(tag, since_date)
+        cursor = self.db['battle'].find(query, {'battleTime': 1, 'battle.result': 1, 'battle.rank': 1})
+        return await cursor.to_list(length=None)
+
+    def watch(self, collections, resume_after=None):
+        """Open a change stream on collections of the database, needs a replica set
+
+        Returns:
+            motor.motor_asyncio.AsyncIOMotorChangeStream:
+        """
+        pipeline = [{'$match': {'ns.coll': {'$in': list(collections)}}}]
+        # Opened on the client so the profiler proxy is bypassed
+        return self.client[self.database_name].watch(pipeline, resume_after=resume_after)
+
+    async def insert_gap(self, gap):
+        """Record a stretch of a player's history that fell out of the battle log between polls"""
+        if self.write_buffer is not None:
+            await self.write_buffer.add('gaps', InsertOne(gap))
+        else:
+            await self.db['gaps'].insert_one(gap)
+
+    async def gaps(self, since_date: datetime = None, tag=None):
+        """Return recorded battle log gaps, newest first"""
+        query = {}
+        if since_date:
+            query['detected'] = {'$gte': since_date}
+        if tag:
+            query['tag'] = tag
+        cursor = self.db['gaps'].find(query).sort('detected', -1)
+        return await cursor.to_list(length=None)
+
+    async def member_battles(self, tags, since_date: datetime, until_date: datetime = None):
+        """Return the battles of any of tags, projected to what analytics.ClubStats needs"""
+        time_range = {'$gte': since_date}
+        if until_date:
+            time_range['$lt'] = until_date
+        query = {'$and': [MongoQueries.members_in_battle(list(tags)), {'battleTime': time_range}]}
+        projection = {'battleTime': 1, 'event.mode': 1, 'battle.mode': 1, 'battle.result': 1, 'battle.rank': 1,
+                      'battle.duration': 1, 'battle.starPlayer.tag': 1, 'battle.teams': 1,
+                      'battle.players.tag': 1}
+        cursor = self.db['battle'].find(query, projection)
+        return await cursor.to_list(length=None)
+
+    async def star_player_counts(self, tags):
+        """Return the all-time star player count of each of tags"""
+        pipeline = [
+            {'$match': {'battle.starPlayer.tag': {'$in': list(tags)}}},
+            {'$group': {'_id': '$battle.starPlayer.tag', 'count': {'$sum': 1}}},
+        ]
+        counts = {tag: 0 for tag in tags}
+        for document in await self._aggregate('battle', pipeline):
+            counts[document['_id']] = document['count']
+        return counts
+
     async def get_club_battles(self, club_tag):
         collection = self.db['battle']
         club = await self.get_club(club_tag)
@@ -548,22 +1188,20 @@ class BrawlBossDatabase:
             pprint(document)
 
     async def club_rankings(self, club_tag):
-        scores = []
-        rankings = {}
+        """Club members with their club score for the last seven days, best first
+
+        Every member is scored in one pass by analytics.ClubStats, with the same result as
+        club_score per member.
+        """
+        # Imported here so numpy does not slow down the bot's startup
+        import analytics
 
-        # Get members
         club = await self.get_club(club_tag)
-        if club:
-            # Get club score for each member
-            for member in club.get('members', []):
-                tag = member['tag']
-                score = await self.club_score(tag)
-                member['score'] = score
-                scores.append(member)
-        rankings = sorted(scores, key=lambda x: x['score'], reverse=True)
-
-        # Return dictionary with tag: club_score
-        return rankings
+        if not club:
+            return []
+        since_date = helper.get_since_date(weeks=1)
+        stats = await analytics.club_stats(self, club, since_date)
+        return stats.rankings(club.get('members', []), stats.scores(since_date))
 
     async def upsert_attribute_emoji(self, attribute, emoji):
         data = {'attribute': attribute,
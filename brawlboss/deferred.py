@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""deferred.py
+Acknowledge slow commands right away and compute their response in a background task.
+"""
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger('brawlboss')
+
+
+class ResultCache:
+    max_entries = 1024
+
+    def __init__(self, ttl=None):
+        """Time based cache for rendered command responses
+
+        Args:
+            ttl (float): Seconds a result stays fresh, defaults to BRAWLBOSS_RESPONSE_CACHE_SECONDS
+        """
+        self.ttl = ttl if ttl is not None else float(os.getenv('BRAWLBOSS_RESPONSE_CACHE_SECONDS', 900))
+        self._entries = {}
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        now = time.monotonic()
+        # Entries keyed by an outdated data version are never read again, drop them once in a while
+        if len(self._entries) >= self.max_entries:
+            self._entries = {k: v for k, v in self._entries.items() if v[1] >= now}
+        self._entries[key] = (value, now + (self.ttl if ttl is None else ttl))
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+
+class DeferredResponder:
+    timeout_message = 'Sorry, that took too long. Please try again in a little while.'
+    error_message = 'Sorry, something went wrong. Please try again in a little while.'
+
+    def __init__(self, cache=None):
+        self.cache = cache or ResultCache()
+        self._pending = {}
+
+    async def respond(self, ctx, key, compute, timeout=30.0):
+        """Send a cached response or defer the interaction and compute it in the background
+
+        Concurrent calls with the same key share one computation, which is cancelled
+        once every waiting command has timed out.
+
+        Args:
+            ctx (discord.ext.commands.Context): Command context
+            key (tuple): Cache key, e.g. (command, subject)
+            compute (Callable): Coroutine function returning the message to send
+            timeout (float): Seconds to wait for the computation
+        """
+        message = self.cache.get(key)
+        if message is not None:
+            await ctx.send(message)
+            return
+
+        # Acknowledge within the interaction window, the send below edits the deferred response
+        await ctx.defer()
+
+        pending = self._pending.get(key)
+        if pending is None:
+            task = asyncio.create_task(self._compute(key, compute))
+            pending = self._pending[key] = {'task': task, 'waiters': 0}
+        pending['waiters'] += 1
+
+        try:
+            message = await asyncio.wait_for(asyncio.shield(pending['task']), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f'{key[0]} timed out after {timeout} seconds')
+            await ctx.send(self.timeout_message)
+            return
+        except Exception as e:
+            # Failed results are not cached, the next call computes again
+            logger.error(f'{key[0]} failed: {e!r}')
+            await ctx.send(self.error_message)
+            return
+        finally:
+            pending['waiters'] -= 1
+            if pending['waiters'] == 0 and not pending['task'].done():
+                pending['task'].cancel()
+
+        await ctx.send(message)
+
+    async def _compute(self, key, compute):
+        try:
+            message = await compute()
+            self.cache.set(key, message)
+            return message
+        finally:
+            self._pending.pop(key, None)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""events.py
+In-memory cache of the event rotation.
+
+The rotation only changes when an event ends, so it is fetched once and served from memory
+until the earliest endTime. A background task fetches the next rotation as soon as it is
+published, so the health check on start and /events never wait for the api.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+import helper
+
+logger = logging.getLogger('brawlboss')
+
+
+class EventRotation:
+    def __init__(self, api, refresh_delay=None, retry_interval=None):
+        """Current event rotation, fetched when it changes
+
+        Args:
+            api (brawlstars.BrawlStarsApiAsync): Open api client
+            refresh_delay (float): Seconds after an event ends before the next rotation is
+                fetched, defaults to BRAWLBOSS_EVENTS_REFRESH_DELAY
+            retry_interval (float): Seconds between fetches while the api fails or still
+                serves the ended rotation, defaults to BRAWLBOSS_EVENTS_RETRY_SECONDS
+        """
+        self.api = api
+        self.refresh_delay = timedelta(seconds=refresh_delay or float(os.getenv('BRAWLBOSS_EVENTS_REFRESH_DELAY', 5)))
+        self.retry_interval = retry_interval or float(os.getenv('BRAWLBOSS_EVENTS_RETRY_SECONDS', 60))
+        self.events = None
+        self.expires = None
+        self.fetched = None
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    @staticmethod
+    def end_time(event):
+        return helper.battle_time_to_datetime(event['endTime'])
+
+    def is_fresh(self, now=None):
+        return self.events is not None and (now or datetime.utcnow()) < self.expires
+
+    async def get(self):
+        """The current rotation, fetched only if the cached one has ended
+
+        Returns:
+            list: Events of the rotation, an ended rotation if the api is failing, an empty
+                list if it never answered
+        """
+        if not self.is_fresh():
+            async with self._lock:
+                # Callers that waited for the lock get what the first one fetched
+                if not self.is_fresh():
+                    await self.fetch()
+        return self.events or []
+
+    async def fetch(self):
+        """Fetch the rotation, the cached one is kept when the api fails
+
+        Returns:
+            bool: True if a rotation that has not ended yet was fetched
+        """
+        data = await self.api.get_events()
+        now = datetime.utcnow()
+        if not data:
+            logger.warning('Could not get the event rotation from the api')
+            return False
+        try:
+            expires = min(self.end_time(event) for event in data)
+        except (KeyError, ValueError) as e:
+            logger.warning(f'Unexpected event rotation: {e}')
+            return False
+        self.events = data
+        self.fetched = now
+        # The api may still serve the ended rotation for a moment, check again soon
+        self.expires = expires if expires > now else now + timedelta(seconds=self.retry_interval)
+        return expires > now
+
+    def start(self):
+        """Keep the rotation fetched in the background"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _refresh(self):
+        while True:
+            try:
+                async with self._lock:
+                    fetched = await self.fetch() if not self.is_fresh() else True
+            except Exception as e:
+                logger.error(f'Could not refresh the event rotation: {e}')
+                fetched = False
+            if fetched:
+                # Right after the earliest event ends, when the next rotation is published
+                delay = (self.expires + self.refresh_delay - datetime.utcnow()).total_seconds()
+            else:
+                delay = self.retry_interval
+            await asyncio.sleep(max(delay, 1))
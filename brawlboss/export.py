@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""export.py
+Export the battle collection to Parquet for offline analysis.
+
+Every battle becomes one row per participant. Rows are written to one file per day under
+<out>/date=YYYY-MM-DD/battles.parquet, a layout pyarrow, pandas, polars and duckdb read as a
+partitioned dataset. Exports are incremental: only the days since the last export are
+rewritten, going back --lookback-days to pick up battles that were ingested late.
+
+    python brawlboss/export.py --out exports/battles
+    python brawlboss/export.py --out exports/battles --since 2023-05-01
+
+Result, rank and trophy change are stored once per battle by the api, from the point of view
+of the member whose battle log it came from. They are exported as stored, the same way the
+database queries count them.
+"""
+import argparse
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pymongo import MongoClient
+
+import database
+import helper
+
+logger = logging.getLogger('brawlboss')
+
+STATE_FILE = '_export_state.json'
+PARTITION_FILE = 'battles.parquet'
+
+SCHEMA = pa.schema([
+    ('battle_id', pa.float64()),
+    ('battle_time', pa.timestamp('ms')),
+    ('tag', pa.string()),
+    ('name', pa.string()),
+    ('team', pa.int8()),
+    ('brawler_id', pa.int32()),
+    ('brawler', pa.string()),
+    ('power', pa.int8()),
+    ('trophies', pa.int32()),
+    ('star_player', pa.bool_()),
+    ('result', pa.string()),
+    ('rank', pa.int16()),
+    ('trophy_change', pa.int32()),
+    ('mode', pa.string()),
+    ('type', pa.string()),
+    ('map', pa.string()),
+    ('event_id', pa.int64()),
+    ('duration', pa.int32()),
+])
+
+
+def battle_rows(document):
+    """Flatten a stored battle into one row per participant
+
+    Duel players have a list of brawlers, the first one is exported.
+    """
+    battle = document.get('battle', {})
+    event = document.get('event', {})
+    star_player = (battle.get('starPlayer') or {}).get('tag')
+    for team, player in helper.battle_participants(document):
+        brawler = helper.player_brawler(player)
+        yield {
+            'battle_id': document['_id'],
+            'battle_time': document['battleTime'],
+            'tag': player.get('tag'),
+            'name': player.get('name'),
+            'team': team,
+            'brawler_id': brawler.get('id'),
+            'brawler': brawler.get('name'),
+            'power': brawler.get('power'),
+            'trophies': brawler.get('trophies'),
+            'star_player': star_player is not None and star_player == player.get('tag'),
+            'result': battle.get('result'),
+            'rank': battle.get('rank'),
+            'trophy_change': battle.get('trophyChange'),
+            'mode': battle.get('mode') or event.get('mode'),
+            'type': battle.get('type'),
+            'map': event.get('map'),
+            'event_id': event.get('id'),
+            'duration': battle.get('duration'),
+        }
+
+
+class PartitionWriter:
+    def __init__(self, out, batch_size=50000):
+        """Write rows to one Parquet file per day
+
+        Files are written next to the partition and moved in place once the rows have moved
+        on to a later day, so readers never see a half written day.
+
+        Args:
+            out (str): Dataset directory
+            batch_size (int): Rows buffered per day before they are written as a row group
+        """
+        self.out = out
+        self.batch_size = batch_size
+        self._writers = {}
+        self._rows = {}
+        self._day = None
+        self._published = []
+        self.rows_written = 0
+
+    def partition_path(self, day):
+        return os.path.join(self.out, f'date={day:%Y-%m-%d}', PARTITION_FILE)
+
+    def add(self, row):
+        day = row['battle_time'].date()
+        if day != self._day:
+            # Rows arrive roughly in time order, publish the days left behind and keep only the
+            # previous day open, so at most two files are open however many days are exported
+            for open_day in sorted(set(self._rows) | set(self._writers)):
+                if open_day < day - timedelta(days=1):
+                    self._finish(open_day)
+                elif open_day != day:
+                    self._write(open_day)
+            self._day = day
+        if day in self._published:
+            logger.warning(f'Battle {row["battle_id"]} arrived after {day} was written, it is not exported')
+            return
+        rows = self._rows.setdefault(day, [])
+        rows.append(row)
+        if len(rows) >= self.batch_size:
+            self._write(day)
+
+    def _write(self, day):
+        rows = self._rows.pop(day, [])
+        if not rows:
+            return
+        writer = self._writers.get(day)
+        if writer is None:
+            path = self.partition_path(day)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            writer = self._writers[day] = pq.ParquetWriter(f'{path}.tmp', SCHEMA, compression='zstd')
+        writer.write_table(pa.Table.from_pylist(rows, schema=SCHEMA))
+        self.rows_written += len(rows)
+
+    def _finish(self, day):
+        """Write the buffered rows of a day and move its file in place"""
+        self._write(day)
+        writer = self._writers.pop(day, None)
+        if writer is None:
+            return
+        writer.close()
+        path = self.partition_path(day)
+        os.replace(f'{path}.tmp', path)
+        self._published.append(day)
+
+    def close(self):
+        """Write what is buffered and publish every day that got rows
+
+        Returns:
+            list: Days that were written
+        """
+        for day in sorted(set(self._rows) | set(self._writers)):
+            self._finish(day)
+        return sorted(self._published)
+
+
+def read_state(out):
+    try:
+        with open(os.path.join(out, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_state(out, state):
+    with open(os.path.join(out, STATE_FILE), 'w') as f:
+        json.dump(state, f, indent=2)
+
+
+def export(collection, out, since=None, until=None, batch_size=50000):
+    """Export the battles from the start of day since until the start of day until
+
+    Days without battles in the range keep their old file, if any.
+
+    Returns:
+        tuple: (rows written, days written)
+    """
+    time_range = {}
+    if since:
+        time_range['$gte'] = since
+    if until:
+        time_range['$lt'] = until
+    query = {'battleTime': time_range} if time_range else {}
+    if since:
+        # Also bound the _id index, a day of slack covers the local time zone of the timestamps
+        query['_id'] = {'$gte': since.timestamp() - 86400}
+    writer = PartitionWriter(out, batch_size)
+    # _id is the battle timestamp, its index gives time order without sorting in memory
+    cursor = collection.find(query, batch_size=2000).sort('_id', 1)
+    try:
+        for document in cursor:
+            if not isinstance(document.get('battleTime'), datetime):
+                continue
+            for row in battle_rows(document):
+                writer.add(row)
+    finally:
+        cursor.close()
+        days = writer.close()
+    return writer.rows_written, days
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export battles to a Parquet dataset partitioned by day')
+    parser.add_argument('--out', default='exports/battles', help='Dataset directory')
+    parser.add_argument('--since', type=datetime.fromisoformat,
+                        help='First day to export, defaults to where the last export left off')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='Day to stop before')
+    parser.add_argument('--lookback-days', type=int, default=2,
+                        help='Days before the last export to rewrite, for battles ingested late')
+    parser.add_argument('--full', action='store_true', help='Ignore the last export and rewrite everything')
+    parser.add_argument('--database', default=os.getenv('MONGODB_DATABASE', 'brawlboss'))
+    parser.add_argument('--batch-size', type=int, default=50000, help='Rows per Parquet row group')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s')
+    os.makedirs(args.out, exist_ok=True)
+
+    since = args.since
+    state = read_state(args.out)
+    if since is None and not args.full and state.get('last_day'):
+        since = datetime.fromisoformat(state['last_day']) - timedelta(days=args.lookback_days)
+    if since:
+        since = since.replace(hour=0, minute=0, second=0, microsecond=0)
+    until = args.until.replace(hour=0, minute=0, second=0, microsecond=0) if args.until else None
+
+    client = MongoClient(database.mongodb_uri())
+    try:
+        rows, days = export(client[args.database]['battle'], args.out, since, until, args.batch_size)
+    finally:
+        client.close()
+
+    if days:
+        last_day = max([days[-1].isoformat()] + ([state['last_day']] if state.get('last_day') else []))
+        write_state(args.out, {'last_day': last_day, 'exported': datetime.utcnow().isoformat()})
+    logger.info(f'Exported {rows} rows over {len(days)} days to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -10,10 +10,13 @@ import string
 from datetime import datetime, timedelta
 from pprint import pprint
 
-import requests
+import aiohttp
 
 
 def proton_sweden_ips():
+    # Only used from the command line, keep requests out of the bot's startup
+    import requests
+
     ips = []
     with requests.get('https://api.protonmail.ch/vpn/logicals') as response:
         json_data = response.json()
@@ -26,11 +29,13 @@ def proton_sweden_ips():
     return ips
 
 
-def public_ip():
+async def public_ip():
     ip = None
-    response = requests.get('https://checkip.amazonaws.com')
-    if response:
-        ip = response.text.strip()
+    timeout = aiohttp.ClientTimeout(total=10)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with session.get('https://checkip.amazonaws.com') as response:
+            if response.status == 200:
+                ip = (await response.text()).strip()
 
     return ip
 
@@ -52,6 +57,11 @@ def get_since_date(weeks=0, days=0, hours=0, minutes=0, seconds=0):
     return since_date
 
 
+def week_start(dt: datetime) -> datetime:
+    """Monday 00:00 of the week dt is in"""
+    return (dt - timedelta(days=dt.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
 def battle_log_id(battle_log):
     to_hash = f'{battle_log["battleTime"]}'
     for team in battle_log['battle']['teams']:
@@ -61,6 +71,37 @@ def battle_log_id(battle_log):
     return hashlib.md5(to_hash.encode('utf-8')).hexdigest()
 
 
+def battle_participants(battle_log):
+    """Yield (team index, player) for every player in a battle, team is None in solo modes"""
+    battle = battle_log.get('battle', {})
+    for i, team in enumerate(battle.get('teams', [])):
+        for player in team:
+            yield i, player
+    for player in battle.get('players', []):
+        yield None, player
+
+
+def player_brawler(player):
+    """Brawler a battle participant played, duel players have several and the first is used"""
+    return player.get('brawler') or (player.get('brawlers') or [{}])[0]
+
+
+def battle_participant_tags(battle_log):
+    """Return the tags of every player in a battle, for both team and showdown battles"""
+    battle = battle_log.get('battle', {})
+    tags = [p['tag'] for team in battle.get('teams', []) for p in team]
+    tags.extend(p['tag'] for p in battle.get('players', []))
+    return tags
+
+
+def is_victory(battle_log, rank=2):
+    """Same rule as MongoQueries.battle_victory, a won battle or a showdown rank of at most rank"""
+    battle = battle_log.get('battle', {})
+    if battle.get('result') == 'victory':
+        return True
+    return battle.get('rank') is not None and battle['rank'] <= rank
+
+
 def camel_case_to_snake_case(input_string):
     output_string = re.sub(r'(?<!^)(?=[A-Z])', '_', input_string).lower()
     return output_string
@@ -72,69 +113,57 @@ def camel_case_to_title_case(input_string):
 
 
 def player_to_profile_message(player, **kwargs):
-    message = f"**{player.get('name')}** ({player.get('tag')})"
+    parts = [f"**{player.get('name')}** ({player.get('tag')})\n"]
 
     # Add trophies
     trophies = player.get('trophies')
     highest_trophies = player.get('highestTrophies')
     if trophies == highest_trophies:
-        message = f"{message}\n" \
-                  f"🏆 **Trophies:** {trophies}\n"
+        parts.append(f"🏆 **Trophies:** {trophies}\n")
     else:
-        message = f"{message}\n" \
-                  f"🏆 **Trophies:** {trophies} ({highest_trophies})\n"
+        parts.append(f"🏆 **Trophies:** {trophies} ({highest_trophies})\n")
+    trophies_this_week = kwargs.get('trophiesThisWeek')
+    if trophies_this_week is not None:
+        parts.append(f"📈 **This week:** {trophies_this_week:+d}\n")
+
     # Experience
-    message = f"{message}\n" \
-              f"⬆️ **Exp Level:** {player.get('expLevel')} ({player.get('expPoints')} points)\n"
+    parts.append(f"\n⬆️ **Exp Level:** {player.get('expLevel')} ({player.get('expPoints')} points)\n")
 
     # Club
     club = player.get('club')
     if club:
-        club_name = club.get('name')
-        club_tag = club.get('tag')
-
-        message = f"{message}\n" \
-                  f"⚔️ **Club:** {club_name} ({club_tag})\n"
-
-        rank_msg = '🌺 **Club rank:** #12'
+        parts.append(f"\n⚔️ **Club:** {club.get('name')} ({club.get('tag')})\n")
 
     # Challenges
-    # message = f"{message}\n" \
     # f"**Challenges**\n" \
     # f"🤖 **Best Robo Rumble Time:** {player.get('bestRoboRumbleTime')}\n" \
     # f"🐘 **Best Time As Big Brawler:** {player.get('bestTimeAsBigBrawler')}\n"
 
     # Stats
-    message = f"{message}\n" \
-              f"**Stats**\n" \
-              f"*All time*\n" \
-              f"🤺 **Solo Victories:** {player.get('soloVictories')}\n" \
-              f"👯 **Duo Victories:** {player.get('duoVictories')}\n" \
-              f"👪 **3Vs3 Victories:** {player.get('3vs3Victories')}\n"
+    parts.append(f"\n**Stats**\n"
+                 f"*All time*\n"
+                 f"🤺 **Solo Victories:** {player.get('soloVictories')}\n"
+                 f"👯 **Duo Victories:** {player.get('duoVictories')}\n"
+                 f"👪 **3Vs3 Victories:** {player.get('3vs3Victories')}\n")
 
     # Win rate
     victories = kwargs.get('victories')
     defeats = kwargs.get('defeats')
     if victories and defeats:
         total = victories + defeats
-        message = f"{message}\n" \
-                  f"🏁 **Win rate:** {round((victories / total) * 100)}%\n"
+        parts.append(f"\n🏁 **Win rate:** {round((victories / total) * 100)}%\n")
 
-        # Win rate
+        # Star player rate
         star_player = kwargs.get('starPlayer')
         if star_player:
-            message = f"{message}" \
-                      f"⭐ **Star player rate:** {round((star_player / total) * 100)}%\n"
+            parts.append(f"⭐ **Star player rate:** {round((star_player / total) * 100)}%\n")
 
-    extra = f"*Last 7 days / last 30 days*" \
-            f"🏅 **Victories:** 15 / 52" \
-            f"💩 **Defeats:** 32 / 42"
-    return message
+    return ''.join(parts)
 
 
 def rankings_message(rankings):
     """Return a formatted list of club rankings"""
-    message = 'Club rankings for the past seven days:'
+    lines = ['Club rankings for the past seven days:']
     for i, player in enumerate(rankings, 1):
         if i == 1:
             i = '🥇'
@@ -149,9 +178,86 @@ def rankings_message(rankings):
 
         name_part = f'{i} **{player["name"]}** `{player["tag"]}`'
         score_part = f'Score: **{round(player["score"], 2)}**'
-        message = f'{message}\n' \
-                  f'{name_part} | {score_part}'
-    return message
+        lines.append(f'{name_part} | {score_part}')
+    return '\n'.join(lines)
+
+
+def player_of_the_week_message(award):
+    """Return a formatted player of the week announcement"""
+    week = f"{award['week_start']:%G} week {award['week_start']:%V}"
+    if not award.get('rankings'):
+        return f'No club member played in {week}'
+
+    winner = award['rankings'][0]
+    lines = [f"🏅 Player of the week ({week}): **{winner['name']}** `{winner['tag']}`",
+             f"{winner['victories']} wins in {winner['battles']} battles ({winner['win_rate']:.0%}), "
+             f"{winner['star_player']} times star player | Score: **{round(winner['score'], 2)}**"]
+    for i, player in enumerate(award['rankings'][1:], 2):
+        lines.append(f"{i}. **{player['name']}** `{player['tag']}` | Score: **{round(player['score'], 2)}**")
+    return '\n'.join(lines)
+
+
+def stats_line(row, total):
+    """Battles, win rate, usage and star player rate of a brawler_stats group"""
+    battles = row['battles']
+    return (f"{battles} battles | {row['victories'] / battles:.0%} wins | {battles / total:.0%} usage | "
+            f"{row['star_player'] / battles:.0%} star player")
+
+
+def brawler_stats_message(brawler, weeks, rows, mode_totals):
+    """Return a brawler's club stats per mode
+
+    Args:
+        brawler (str): Brawler name
+        weeks (int): Number of weeks the stats cover
+        rows (list): brawler_stats of the brawler grouped by mode
+        mode_totals (dict): Battles of every brawler per mode, for the usage
+    """
+    if not rows:
+        return f'No club member played {brawler} in the last {weeks} weeks'
+    lines = [f'**{brawler.upper()}** in the last {weeks} weeks:']
+    for row in rows:
+        name = camel_case_to_title_case(row['_id'] or 'unknown')
+        lines.append(f"{name}: {stats_line(row, mode_totals.get(row['_id']) or row['battles'])}")
+    return '\n'.join(lines)
+
+
+def map_stats_message(map_name, weeks, rows, limit=10):
+    """Return the club's most played brawlers on a map
+
+    Args:
+        map_name (str): Map name
+        weeks (int): Number of weeks the stats cover
+        rows (list): brawler_stats of the map grouped by brawler, most battles first
+        limit (int): Number of brawlers to list
+    """
+    if not rows:
+        return f'No club member played {map_name} in the last {weeks} weeks'
+    total = sum(row['battles'] for row in rows)
+    lines = [f'**{map_name}** in the last {weeks} weeks, {total} battles:']
+    for i, row in enumerate(rows[:limit], 1):
+        lines.append(f"{i}. {row['_id']}: {stats_line(row, total)}")
+    return '\n'.join(lines)
+
+
+def events_message(events, now=None):
+    """Return the current event rotation, soonest ending first
+
+    Args:
+        events (list): Events from the events/rotation endpoint
+        now (datetime): Reference time for the time left, defaults to now
+    """
+    if not events:
+        return 'The event rotation is not available right now'
+    now = now or datetime.utcnow()
+    lines = ['**Current events**']
+    for event in sorted(events, key=lambda x: x['endTime']):
+        details = event.get('event', {})
+        left = int(max((battle_time_to_datetime(event['endTime']) - now).total_seconds(), 0))
+        hours, minutes = divmod(left // 60, 60)
+        mode = camel_case_to_title_case(details.get('mode') or 'unknown')
+        lines.append(f"{mode}: {details.get('map')} (ends in {hours}h {minutes:02}m)")
+    return '\n'.join(lines)
 
 
 def random_slap(sender, receiver):
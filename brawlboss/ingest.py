@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""ingest.py
+Pull club, player and battle log data from the Brawl Stars API into the database.
+"""
+import logging
+import time
+from datetime import datetime
+
+import brawlstars
+import database
+import metrics
+from brawlstars import BATTLE_LOG_SIZE
+
+logger = logging.getLogger('brawlboss')
+
+
+async def club_to_database(db, club_tag, api):
+    """Store a club
+
+    Returns:
+        tuple: (club, is new, changed), None if the api returned nothing
+    """
+    data = await api.get_club(club_tag)
+
+    if data:
+        if db.write_buffer is not None:
+            return await db.buffer_club(data)
+        return await db.upsert_club(data)
+    else:
+        logger.warning(f'Could not get data from api')
+
+
+async def refresh_club(db, club_tag, api):
+    """Store a club and the membership events since its stored roster
+
+    Members who joined, changed role or changed trophies get their profile fetched on their
+    next poll, see BrawlBossDatabase.profile_due.
+
+    Returns:
+        tuple: (club, events), None if the api returned nothing
+    """
+    previous = await db.club_roster(club_tag)
+    result = await club_to_database(db, club_tag, api)
+    if not result:
+        return None
+    club, new_club, changed = result
+    events = []
+    if changed and previous is not None:
+        events = database.diff_members(club_tag, previous, club.get('members', []), db.now())
+        await db.insert_club_events(events)
+        db.mark_profiles_stale(event['tag'] for event in events if event['type'] != 'leave')
+    return club, events
+
+
+async def members_to_players(db, club, api):
+    members = club.get('members')
+    players = []
+    if members:
+        for i, member in enumerate(members):
+            logger.info(f'Getting more data for {member["name"]} ({member["tag"]}) | {i + 1}/{len(members)}')
+            result = await player_to_database(db, member['tag'], api)
+            if result:
+                players.append(result[0])
+    return players
+
+
+async def player_to_database(db, tag, api):
+    """Store a player profile
+
+    Returns:
+        tuple: (player, is new, changed), None if the api returned nothing
+    """
+    data = await api.get_players(tag)
+    if data:
+        if db.write_buffer is not None:
+            return await db.buffer_player(data)
+        return await db.upsert_player(data)
+    else:
+        logger.warning(f'Could not get player data from api')
+
+
+class BattleDedup:
+    """Battle log items already stored during the current refresh cycle
+
+    Club members who play together get the same battle in each of their logs, only the
+    first copy is written.
+    """
+
+    def __init__(self):
+        self.battles = {}
+        self.total = 0
+        self.skipped = 0
+
+    @staticmethod
+    def key(item):
+        return item['battleTime'], item.get('event', {}).get('id'), item.get('battle', {}).get('mode')
+
+    def get(self, key):
+        """Return (battle time, is new) of an already stored battle, None if it was not seen yet"""
+        self.total += 1
+        result = self.battles.get(key)
+        if result:
+            self.skipped += 1
+            metrics.DEDUPED_BATTLES.inc()
+        return result
+
+    def add(self, key, battle_time, is_new):
+        self.battles[key] = (battle_time, is_new)
+
+    @property
+    def new_battles(self):
+        """Number of distinct battles that were not stored before this cycle"""
+        return sum(is_new for battle_time, is_new in self.battles.values())
+
+    @property
+    def ratio(self):
+        return self.skipped / self.total if self.total else 0.0
+
+    def summary(self):
+        return f'{self.skipped}/{self.total} battle log items were duplicates ({self.ratio:.0%})'
+
+
+def find_gap(tag, battle_times, watermark, now=None):
+    """Detect a full battle log that does not reach back to the last stored battle
+
+    Args:
+        tag (str): Player tag
+        battle_times (list): Battle times in the fetched log
+        watermark (datetime): Time of the newest battle stored before this poll
+        now (datetime): Detection time, defaults to now
+
+    Returns:
+        dict: The gap with an estimate of the missed battles, None if the log overlaps
+    """
+    if not watermark or len(battle_times) < BATTLE_LOG_SIZE:
+        return None
+    oldest, newest = min(battle_times), max(battle_times)
+    if oldest <= watermark:
+        return None
+
+    # Assume the player kept the pace of the fetched log during the gap
+    span = (newest - oldest).total_seconds()
+    gap = (oldest - watermark).total_seconds()
+    estimated = max(round((len(battle_times) - 1) / span * gap), 1) if span > 0 else 1
+    return {'tag': tag, 'from': watermark, 'to': oldest, 'estimated_missed': estimated,
+            'detected': now or datetime.utcnow()}
+
+
+async def battles_to_database(db, player, api, watermark=None, dedup=None):
+    """Store the battle log of a player
+
+    Args:
+        watermark (datetime): Time of the newest stored battle of the player, used to detect gaps
+        dedup (BattleDedup): Battles already stored in this refresh cycle
+
+    Returns:
+        tuple: (number of new battles, battle times in the log), None if the api returned nothing
+    """
+    # Get battle logs from api
+    data = await api.get_players_battle_log(player['tag'])
+
+    # Add battles from log if returned any
+    if data:
+        new_battles = 0
+        battle_times = []
+        for i, battle in enumerate(data['items']):
+            key = dedup.key(battle) if dedup is not None else None
+            seen = dedup.get(key) if dedup is not None else None
+            if seen:
+                battle_time, is_new = seen
+            elif db.write_buffer is not None:
+                # Whether the battle is stored already is only known after the flush, anything
+                # newer than the last stored battle of the player is new
+                battle_time = (await db.buffer_battle(battle))['battleTime']
+                is_new = watermark is None or battle_time > watermark
+            else:
+                document, is_new = await db.upsert_battle(battle)
+                battle_time = document['battleTime']
+            if not seen and dedup is not None:
+                dedup.add(key, battle_time, is_new)
+            new_battles += is_new
+            battle_times.append(battle_time)
+
+        gap = find_gap(player['tag'], battle_times, watermark, db.now())
+        if gap:
+            metrics.BATTLE_LOG_GAPS.inc()
+            metrics.MISSED_BATTLES.inc(gap['estimated_missed'])
+            logger.warning(f'{player["tag"]} battle log gap from {gap["from"]} to {gap["to"]}, '
+                           f'about {gap["estimated_missed"]} battles missed')
+            await db.insert_gap(gap)
+        return new_battles, battle_times
+    else:
+        logger.warning(f'Could not get data from api')
+
+
+async def refresh_player(db, tag, api, watermark=None, dedup=None, profile=True):
+    """Refresh the profile and battle log of one player
+
+    Args:
+        profile (bool): Also fetch the profile, only the battle log is fetched otherwise
+
+    Returns:
+        tuple: (number of new battles, battle times in the log), None if the api returned nothing
+    """
+    if not profile:
+        metrics.SKIPPED_PROFILES.inc()
+        return await battles_to_database(db, {'tag': tag}, api, watermark, dedup)
+    result = await player_to_database(db, tag, api)
+    if not result:
+        return None
+    player, new_player, changed = result
+    return await battles_to_database(db, player, api, watermark, dedup)
+
+
+async def update(db, club_tag, api=None):
+    """Refresh a club, its members and their battle logs
+
+    Args:
+        db (database.BrawlBossDatabase): Database to write to
+        club_tag (str): Club to refresh
+        api (brawlstars.BrawlStarsApiAsync): Open api client to reuse, a new one is opened if not given
+    """
+    if api is None:
+        async with brawlstars.BrawlStarsApiAsync() as api:
+            return await update(db, club_tag, api)
+
+    start = time.perf_counter()
+    dedup = BattleDedup()
+    try:
+        # Get data from brawl stars and put in mongodb
+        result = await refresh_club(db, club_tag, api)
+        if not result:
+            return
+        club, events = result
+        members = club.get('members')
+
+        # Iterate over members, profiles are only fetched when due or changed in the club
+        if members:
+            for i, member in enumerate(members):
+                if db.profile_due(member['tag']):
+                    logger.info(f'Getting more data for {member["name"]} ({member["tag"]}) | {i + 1}/{len(members)}')
+                    result = await player_to_database(db, member['tag'], api)
+                    # A failed profile only skips this member, its battle log is polled next cycle
+                    player = result[0] if result else None
+                else:
+                    metrics.SKIPPED_PROFILES.inc()
+                    player = member
+                if player:
+                    logger.info(f'Getting logs for {player["name"]} ({player["tag"]}) | {i + 1}/{len(members)}')
+                    await battles_to_database(db, player, api, dedup=dedup)
+
+    except Exception as e:
+        metrics.REFRESH_ERRORS.inc()
+        logger.error(e)
+    finally:
+        if db.write_buffer is not None:
+            # Store everything the cycle queued, also when it was cancelled
+            await db.write_buffer.flush()
+        duration = time.perf_counter() - start
+        metrics.REFRESH_DURATION.observe(duration)
+        logger.info(f'Database refresh took {duration:.1f} seconds, {dedup.summary()}')
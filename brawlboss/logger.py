@@ -1,6 +1,8 @@
+import atexit
 import discord
 import logging
 import logging.handlers
+import queue
 
 # Loggers
 logger = logging.getLogger('brawlboss')
@@ -29,8 +31,13 @@ formatter = logging.Formatter('[{asctime}] [{levelname:<8}] {name}: {message}',
 file_handler.setFormatter(formatter)
 stream_handler.setFormatter(formatter)
 
+# Write records from a listener thread so file and console io never blocks the event loop
+log_queue = queue.SimpleQueue()
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler)
+queue_listener.start()
+atexit.register(queue_listener.stop)
+
 # Add handlers
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
-bot_logger.addHandler(file_handler)
-bot_logger.addHandler(stream_handler)
+logger.addHandler(queue_handler)
+bot_logger.addHandler(queue_handler)
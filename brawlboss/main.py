@@ -2,6 +2,12 @@
 """main.py
 Description of main.py.
 """
+import time
+
+# Taken before the heavy imports below so time-to-ready covers the whole startup
+startup_started = time.perf_counter()
+
+import asyncio
 import logging
 import os
 import socket
@@ -11,96 +17,53 @@ from discord import app_commands
 from discord.ext import commands, tasks
 from datetime import datetime, timedelta
 import database
+import deferred
+import events
 import helper
 import brawlstars
+import metrics
+import monitor
 from logger import logger
 
 club_tag = os.getenv('BRAWLSTARS_CLUB_TAG')
 guild_id = os.getenv('DISCORD_GUILD_ID')
 
-db = database.BrawlBossDatabase()
 guild = discord.Object(id=guild_id)
+responder = deferred.DeferredResponder()
 
+# Weeks covered by /brawler and /map
+stats_weeks = int(os.getenv('BRAWLBOSS_STATS_WEEKS', 4))
 
-async def club_to_database():
-    """Returns club members as Player"""
-    async with brawlstars.BrawlStarsApiAsync() as api:
-        data = await api.get_club(club_tag)
-
-    if data:
-        club = await db.upsert_club(data)
-        return club
-    else:
-        logger.warning(f'Could not get data from api')
+# Seconds a deferred command may spend computing its response
+command_timeouts = {
+    'profile': float(os.getenv('BRAWLBOSS_PROFILE_TIMEOUT', 30)),
+    'rankings': float(os.getenv('BRAWLBOSS_RANKINGS_TIMEOUT', 120)),
+}
 
 
-async def player_of_the_week():
-    """Get the player with the most wins in the last 7 days"""
-    pass
+# Tags the api said do not exist, so repeated typos do not cost an api request each
+missing_players = deferred.ResultCache(ttl=float(os.getenv('BRAWLBOSS_MISSING_PLAYER_SECONDS', 600)))
 
 
 async def player_exists(tag):
-    """Returns club members as Player"""
+    """Whether a player tag exists, checking the stored players before the api
+
+    Players fetched from the api are stored right away.
+    """
     if not tag.startswith('#'):
         tag = f'#{tag}'
-    async with brawlstars.BrawlStarsApiAsync() as api:
-        data = await api.get_players(tag)
-
-    return True if data else False
-
-
-async def members_to_players(club):
-    members = club.get('members')
-    players = []
-    if members:
-        for i, member in enumerate(members):
-            logger.info(f'Getting more data for {member["name"]} ({member["tag"]}) | {i + 1}/{len(members)}')
-            player, new_player = await player_to_database(member['tag'])
-            if player:
-                players.append(player)
-    return players
-
-
-async def player_to_database(tag):
-    async with brawlstars.BrawlStarsApiAsync() as api:
-        data = await api.get_players(tag)
-    if data:
-        player, new_player = await db.upsert_player(data)
-        return player, new_player
-    else:
-        logger.warning(f'Could not get player data from api')
-
-
-async def battles_to_database(player):
-    # Get battle logs from api
-    async with brawlstars.BrawlStarsApiAsync() as api:
-        data = await api.get_players_battle_log(player['tag'])
+    if await bot.db.player_exists(tag):
+        return True
+    if missing_players.get(tag):
+        return False
 
-    # Add battles from log if returned any
+    data, missing = await bot.api.find_player(tag)
     if data:
-        for i, battle in enumerate(data['items']):
-            await db.upsert_battle(battle)
-    else:
-        logger.warning(f'Could not get data from api')
-
-
-async def update():
-    try:
-        # Get data from brawl stars and put in mongodb
-        club, new_club = await club_to_database()
-        members = club.get('members')
-
-        # Iterate over members
-        if members:
-            for i, member in enumerate(members):
-                logger.info(f'Getting more data for {member["name"]} ({member["tag"]}) | {i + 1}/{len(members)}')
-                player, new_player = await player_to_database(member['tag'])
-                if player:
-                    logger.info(f'Getting logs for {player["name"]} ({player["tag"]}) | {i + 1}/{len(members)}')
-                    await battles_to_database(player)
-
-    except Exception as e:
-        logger.error(e)
+        await bot.db.upsert_player(data)
+        return True
+    if missing:
+        missing_players.set(tag, True)
+    return False
 
 
 class Bot(commands.Bot):
@@ -108,46 +71,120 @@ class Bot(commands.Bot):
         intents = discord.Intents.default()
         intents.message_content = True
         super().__init__(command_prefix='!', intents=intents)
+        self.db = None
+        self.api = None
+        self.events = None
+        self.ready_after = None
+        self.leaderboard = None
+        self.change_watcher = None
+        self.loop_monitor = None
+        self.metrics_runner = None
 
     async def setup_hook(self) -> None:
+        # Created here rather than at import so the bot starts connecting right away
+        self.db = database.BrawlBossDatabase()
+        # One api client and connection pool for every command
+        self.api = await brawlstars.BrawlStarsApiAsync().__aenter__()
+        # Event rotation served from memory, refetched when it changes
+        self.events = events.EventRotation(self.api)
+        self.events.start()
+
+        # Follow the ingestion worker's writes instead of waiting for cached responses to expire
+        if os.getenv('BRAWLBOSS_WATCH_CHANGES'):
+            # Imported here, bots that do not watch changes never load it
+            import watcher
+
+            self.leaderboard = watcher.Leaderboard(self.db)
+            self.change_watcher = watcher.ChangeWatcher(self.db, self.leaderboard)
+            self.change_watcher.start()
+
+        if os.getenv('BRAWLBOSS_LOG_PUBLIC_IP'):
+            asyncio.create_task(self.log_public_ip())
+
+        self.loop_monitor = monitor.LoopLagMonitor()
+        self.loop_monitor.start()
+
+        if os.getenv('METRICS_PORT', '9108'):
+            try:
+                self.metrics_runner = await metrics.start_server()
+            except OSError as e:
+                # A second bot on the host or a busy port must not keep the bot from starting
+                logger.warning(f'Could not serve metrics, set METRICS_PORT to another port or empty: {e}')
+
         # synced = await self.tree.sync()
         synced = await self.tree.sync(guild=guild)
         for s in synced:
             logger.debug(s)
         logger.info(f'Synced slash commands for {self.user}')
 
+    async def close(self):
+        if self.change_watcher is not None:
+            await self.change_watcher.stop()
+        if self.loop_monitor is not None:
+            self.loop_monitor.stop()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+            self.metrics_runner = None
+        if self.events is not None:
+            await self.events.stop()
+        if self.api is not None:
+            await self.api.__aexit__(None, None, None)
+            self.api = None
+        await super().close()
+
+    async def log_public_ip(self):
+        """Log the outgoing IP, which has to be whitelisted for the api token"""
+        try:
+            logger.info(f'Bot IP: {await helper.public_ip()}')
+        except Exception as e:
+            logger.warning(f'Could not look up public IP: {e}')
+
 
 bot = Bot()
 
 
-@tasks.loop(minutes=15)
-async def update_database():
-    logger.info(f'Updating database')
-    await update()
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+
 
-    next_update_dt = datetime.now() + timedelta(minutes=30)
-    logger.info(f'Next database update: {next_update_dt.strftime("%Y-%m-%d %H:%M:%S")}')
+@bot.after_invoke
+async def record_command_latency(ctx):
+    started_at = getattr(ctx, 'started_at', None)
+    if started_at is not None:
+        metrics.COMMAND_LATENCY.observe(time.perf_counter() - started_at, command=ctx.command.qualified_name)
+
+
+@tasks.loop(minutes=int(os.getenv('BRAWLBOSS_PROFILE_REPORT_MINUTES', 60)))
+async def query_profile_report():
+    if bot.db.profiler.stats:
+        logger.info(bot.db.profiler.report())
 
 
 @bot.event
 async def on_ready():
     print(f"I'm alive! {bot.user} (ID: {bot.user.id})")
-    # Test api connection
-    async with brawlstars.BrawlStarsApiAsync() as api:
-        data = await api.get_events()
-        if data:
-            logger.info('API connection successful')
-        else:
-            logger.warning(f'API returned {data}')
+    if bot.ready_after is None:
+        bot.ready_after = time.perf_counter() - startup_started
+        metrics.STARTUP_DURATION.set(bot.ready_after)
+        logger.info(f'Ready after {bot.ready_after:.2f} seconds')
+
+    # Test api connection, served from the cached rotation after the first fetch
+    data = await bot.events.get()
+    if data:
+        logger.info('API connection successful')
+    else:
+        logger.warning(f'API returned {data}')
     # Test database connection
-    db_conn = await db.test_connection()
+    db_conn = await bot.db.test_connection()
     if db_conn:
         logger.info('Database connection successful')
     else:
         logger.warning(f'Failed to connect to database')
 
-    # Update database from api
-    update_database.start()
+    # Report slow queries
+    if bot.db.profiler and not query_profile_report.is_running():
+        query_profile_report.start()
 
 
 @bot.hybrid_command(name='ping', description='Play some ping pong')
@@ -166,25 +203,106 @@ async def profile(ctx, member: discord.Member = None):
         user = member.id
     else:
         user = ctx.author.id
-    player = await db.player_from_discord_id(user)
-    message = f'Sorry, no player found for <@{user}>'
-    if player:
-        wins, losses, total = await db.battle_count(player['tag'])
-        star_player = await db.star_player_count(player['tag'])
-        message = helper.player_to_profile_message(player, victories=wins, defeats=losses, starPlayer=star_player)
 
-    await ctx.send(message)
+    async def compute():
+        player = await bot.db.player_from_discord_id(user)
+        if not player:
+            return f'Sorry, no player found for <@{user}>'
+        wins, losses, total = await bot.db.battle_count(player['tag'])
+        star_player = await bot.db.star_player_count(player['tag'])
+        trophies_this_week = await bot.db.trophies_gained(player['tag'], helper.week_start(datetime.utcnow()))
+        return helper.player_to_profile_message(player, victories=wins, defeats=losses, starPlayer=star_player,
+                                                trophiesThisWeek=trophies_this_week)
+
+    key = ('profile', user, await bot.db.profile_version(user))
+    await responder.respond(ctx, key, compute, timeout=command_timeouts['profile'])
 
 
 @bot.hybrid_command(name='rankings',
                     description='Get the club rankings for the last seven days')
+@app_commands.describe(club='#CLUBTAG of a tracked club, defaults to our club')
+@app_commands.guilds(guild)
+async def rankings(ctx, club: str = None):
+    tag = club or club_tag
+    if not tag.startswith('#'):
+        tag = f'#{tag}'
+
+    async def compute():
+        rankings_list = None
+        if bot.leaderboard:
+            if not bot.leaderboard.is_tracked(tag):
+                await bot.leaderboard.track(tag)
+            rankings_list = bot.leaderboard.rankings(tag)
+        if rankings_list is None:
+            rankings_list = await bot.db.club_rankings(tag)
+        return helper.rankings_message(rankings_list)
+
+    key = ('rankings', tag, await bot.db.rankings_version(tag))
+    await responder.respond(ctx, key, compute, timeout=command_timeouts['rankings'])
+
+
+@bot.hybrid_command(name='playeroftheweek',
+                    description='Get the player of the week of last week')
+@app_commands.describe(club='#CLUBTAG of a tracked club, defaults to our club')
 @app_commands.guilds(guild)
-async def rankings(ctx):
-    rankings_list = await db.club_rankings(club_tag)
-    message = helper.rankings_message(rankings_list)
+async def player_of_the_week(ctx, club: str = None):
+    tag = club or club_tag
+    if not tag.startswith('#'):
+        tag = f'#{tag}'
+
+    # Computed weekly by the ingestion worker, this is a single indexed lookup
+    award = await bot.db.player_of_the_week(tag)
+    if award:
+        message = helper.player_of_the_week_message(award)
+    else:
+        message = f'No player of the week has been awarded for `{tag}` yet'
     await ctx.send(message)
 
 
+async def club_member_tags(tag):
+    club = await bot.db.get_club(tag)
+    return [member['tag'] for member in club.get('members', [])] if club else []
+
+
+@bot.hybrid_command(name='brawler',
+                    description='Get how the club does with a brawler in each mode')
+@app_commands.describe(name='Brawler name', club='#CLUBTAG of a tracked club, defaults to our club')
+@app_commands.guilds(guild)
+async def brawler(ctx, name: str, club: str = None):
+    tag = club or club_tag
+    if not tag.startswith('#'):
+        tag = f'#{tag}'
+
+    # Reads the precomputed weekly brawler_stats, not the battles
+    tags = await club_member_tags(tag)
+    since_week = helper.week_start(datetime.utcnow()) - timedelta(weeks=stats_weeks - 1)
+    rows = await bot.db.brawler_stats(tags, since_week, 'mode', brawler=name)
+    mode_totals = {row['_id']: row['battles'] for row in await bot.db.brawler_stats(tags, since_week, 'mode')}
+    await ctx.send(helper.brawler_stats_message(name, stats_weeks, rows, mode_totals))
+
+
+@bot.hybrid_command(name='map',
+                    description='Get the brawlers the club plays on a map and how they do')
+@app_commands.describe(name='Map name', club='#CLUBTAG of a tracked club, defaults to our club')
+@app_commands.guilds(guild)
+async def map_stats(ctx, name: str, club: str = None):
+    tag = club or club_tag
+    if not tag.startswith('#'):
+        tag = f'#{tag}'
+
+    tags = await club_member_tags(tag)
+    since_week = helper.week_start(datetime.utcnow()) - timedelta(weeks=stats_weeks - 1)
+    rows = await bot.db.brawler_stats(tags, since_week, 'brawler', map_name=name)
+    await ctx.send(helper.map_stats_message(name, stats_weeks, rows))
+
+
+@bot.hybrid_command(name='events',
+                    description='Get the current event rotation')
+@app_commands.guilds(guild)
+async def current_events(ctx):
+    await ctx.send(helper.events_message(await bot.events.get()))
+
+
 @bot.hybrid_command(name='link',
                     description='Link your Discord profile with a Brawl Stars account',
                     with_app_command=True)
@@ -194,11 +312,12 @@ async def link(ctx, tag: str):
     user_id = ctx.author.id
     message = f'No Brawl Stars account exists for `{tag}`'
     # Check if account exists
+    tag = tag.strip().upper()
     if not tag.startswith('#'):
         tag = f'#{tag}'
     exists = await player_exists(tag)
     if exists:
-        doc = await db.upsert_discord({'_id': user_id, 'tag': tag})
+        doc = await bot.db.upsert_discord({'_id': user_id, 'tag': tag})
         if doc:
             message = f'Brawl Stars account `{tag}` was successfully linked to <@{user_id}>'
         else:
@@ -235,6 +354,4 @@ async def engage(ctx, member: discord.Member):
 
 
 if __name__ == '__main__':
-    logger.info(f'Bot IP: {helper.public_ip()}')
-    print(os.getenv('DISCORD_TOKEN'))
     bot.run(os.getenv('DISCORD_TOKEN'), log_handler=None)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""metrics.py
+Prometheus style counters and histograms, served as text on a local /metrics endpoint.
+"""
+import functools
+import inspect
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+    return f'{{{pairs}}}'
+
+
+class Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """Yield (suffix, labels, value) tuples for the exposition format"""
+        for key, value in self._values.items():
+            yield '', key, value
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.type_name}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(labels)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series['buckets'][i] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        series = self._values.get(self._key(labels))
+        return series['count'] if series else 0
+
+    def samples(self):
+        for key, series in self._values.items():
+            for bound, count in zip(self.buckets, series['buckets']):
+                yield '_bucket', key + (('le', bound),), count
+            yield '_bucket', key + (('le', '+Inf'),), series['count']
+            yield '_sum', key, series['sum']
+            yield '_count', key, series['count']
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def exposition(self):
+        """Return all metrics in the Prometheus text format"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Brawl Stars API
+API_LATENCY = REGISTRY.register(Histogram(
+    'brawlboss_api_request_duration_seconds', 'Brawl Stars API request latency', ['endpoint']))
+API_RESPONSES = REGISTRY.register(Counter(
+    'brawlboss_api_responses_total', 'Brawl Stars API responses by status code', ['endpoint', 'status']))
+API_RETRIES = REGISTRY.register(Counter(
+    'brawlboss_api_retries_total', 'Retried Brawl Stars API requests', ['endpoint']))
+API_KEY_REQUESTS = REGISTRY.register(Counter(
+    'brawlboss_api_key_requests_total', 'Brawl Stars API requests per token, by position in the pool', ['key']))
+API_KEYS_USABLE = REGISTRY.register(Gauge(
+    'brawlboss_api_keys_usable', 'Brawl Stars API tokens that are not disabled'))
+
+# Database
+DB_LATENCY = REGISTRY.register(Histogram(
+    'brawlboss_db_method_duration_seconds', 'BrawlBossDatabase method latency', ['method']))
+
+# Ingestion
+REFRESH_DURATION = REGISTRY.register(Histogram(
+    'brawlboss_refresh_duration_seconds', 'Duration of a full database refresh cycle'))
+REFRESH_ERRORS = REGISTRY.register(Counter(
+    'brawlboss_refresh_errors_total', 'Refresh cycles or polling rounds that hit an exception'))
+
+BATTLE_LOG_GAPS = REGISTRY.register(Counter(
+    'brawlboss_battle_log_gaps_total', 'Battle logs that did not reach back to the last stored battle'))
+MISSED_BATTLES = REGISTRY.register(Counter(
+    'brawlboss_missed_battles_total', 'Estimated battles lost in battle log gaps'))
+
+DEDUPED_BATTLES = REGISTRY.register(Counter(
+    'brawlboss_deduplicated_battles_total', 'Battle log items skipped because another member had the same battle'))
+
+UNCHANGED_UPSERTS = REGISTRY.register(Counter(
+    'brawlboss_unchanged_upserts_total', 'Player and club upserts skipped because the payload did not change',
+    ['collection']))
+
+CLUB_EVENTS = REGISTRY.register(Counter(
+    'brawlboss_club_events_total', 'Club membership events found by diffing rosters', ['type']))
+SKIPPED_PROFILES = REGISTRY.register(Counter(
+    'brawlboss_skipped_profiles_total', 'Player polls that reused the stored profile'))
+
+WRITE_BUFFER_PENDING = REGISTRY.register(Gauge(
+    'brawlboss_write_buffer_pending', 'Writes queued in the write-behind buffer'))
+WRITE_BUFFER_WRITES = REGISTRY.register(Counter(
+    'brawlboss_write_buffer_writes_total', 'Buffered writes sent to the database', ['collection']))
+WRITE_BUFFER_ERRORS = REGISTRY.register(Counter(
+    'brawlboss_write_buffer_errors_total', 'Buffered writes that failed', ['collection']))
+WRITE_BUFFER_FLUSH = REGISTRY.register(Histogram(
+    'brawlboss_write_buffer_flush_seconds', 'Duration of a bulk write from the write-behind buffer', ['collection']))
+
+# Event loop
+LOOP_LAG = REGISTRY.register(Histogram(
+    'brawlboss_event_loop_lag_seconds', 'Event loop scheduling delay',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)))
+LOOP_BLOCKED = REGISTRY.register(Counter(
+    'brawlboss_event_loop_blocked_total', 'Samples where the event loop lagged past the blocking threshold'))
+
+# Discord
+STARTUP_DURATION = REGISTRY.register(Gauge(
+    'brawlboss_startup_seconds', 'Seconds from process start until the bot was ready'))
+COMMAND_LATENCY = REGISTRY.register(Histogram(
+    'brawlboss_command_duration_seconds', 'Slash and prefix command latency', ['command']))
+
+
+def instrument_methods(histogram, label='method'):
+    """Class decorator that times every coroutine method with the given histogram
+
+    Args:
+        histogram (Histogram): Histogram with a single label
+        label (str): Name of the label that receives the method name
+
+    Returns:
+        Callable: The class decorator
+    """
+
+    def wrap(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**{label: func.__name__}):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    def decorator(cls):
+        for name, member in list(vars(cls).items()):
+            if name.startswith('__') or not inspect.iscoroutinefunction(member):
+                continue
+            setattr(cls, name, wrap(member))
+        return cls
+
+    return decorator
+
+
+async def _handle_metrics(request):
+    return web.Response(text=REGISTRY.exposition(), content_type='text/plain', charset='utf-8')
+
+
+async def start_server(host=None, port=None):
+    """Serve /metrics from the running event loop
+
+    Args:
+        host (str): Interface to bind, defaults to METRICS_HOST or 127.0.0.1
+        port (int): Port to bind, defaults to METRICS_PORT or 9108
+
+    Returns:
+        aiohttp.web.AppRunner: The runner, call cleanup() to stop the server
+
+    Raises:
+        OSError: The port could not be bound
+    """
+    host = host or os.getenv('METRICS_HOST', '127.0.0.1')
+    port = int(port or os.getenv('METRICS_PORT', 9108))
+
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    try:
+        await site.start()
+    except OSError:
+        await runner.cleanup()
+        raise
+    logging.getLogger('brawlboss').info(f'Serving metrics on http://{host}:{port}/metrics')
+    return runner
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""monitor.py
+Event loop lag sampler and blocking call detector.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+logger = logging.getLogger('brawlboss')
+
+
+class LoopLagMonitor:
+    def __init__(self, interval=None, threshold=None, debug=None):
+        """Sample event loop scheduling delay and report callbacks that block the loop
+
+        Args:
+            interval (float): Seconds between samples, defaults to BRAWLBOSS_LOOP_LAG_INTERVAL
+            threshold (float): Seconds the loop may be held before it counts as blocked,
+                defaults to BRAWLBOSS_LOOP_BLOCK_MS
+            debug (bool): Log the stack of blocking callbacks, defaults to BRAWLBOSS_DEBUG_LOOP
+        """
+        self.interval = interval or float(os.getenv('BRAWLBOSS_LOOP_LAG_INTERVAL', 0.5))
+        self.threshold = threshold or float(os.getenv('BRAWLBOSS_LOOP_BLOCK_MS', 100)) / 1000
+        self.debug = bool(os.getenv('BRAWLBOSS_DEBUG_LOOP')) if debug is None else debug
+
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        self._loop_thread_id = None
+        self._last_tick = time.monotonic()
+
+    def start(self):
+        """Start sampling on the running loop"""
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stopped.clear()
+        self._task = loop.create_task(self._sample())
+
+        if self.debug:
+            self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+            self._watchdog.start()
+        logger.info(f'Monitoring event loop lag every {self.interval}s (blocking threshold '
+                    f'{self.threshold * 1000:.0f} ms{", stack dumps enabled" if self.debug else ""})')
+
+    def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _sample(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+            self._last_tick = time.monotonic()
+            metrics.LOOP_LAG.observe(lag)
+            if lag >= self.threshold:
+                metrics.LOOP_BLOCKED.inc()
+                logger.debug(f'Event loop lagged {lag * 1000:.0f} ms')
+
+    def _watch(self):
+        """Runs in a thread and dumps the loop thread's stack while it is blocked"""
+        reported = False
+        while not self._stopped.wait(self.threshold / 2):
+            blocked_for = time.monotonic() - self._last_tick - self.interval
+            if blocked_for < self.threshold:
+                reported = False
+                continue
+            if reported:
+                continue
+
+            reported = True
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = ''.join(traceback.format_stack(frame))
+            logger.warning(f'Event loop blocked for at least {blocked_for * 1000:.0f} ms, '
+                           f'loop thread is at:\n{stack}')
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""profiler.py
+Opt-in slow query profiler for the motor collections used by BrawlBossDatabase.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger('brawlboss')
+
+
+def query_shape(value):
+    """Strip the values from a query or pipeline, keeping keys and operators
+
+    Args:
+        value: Query document, pipeline or value
+
+    Returns:
+        The query with every leaf value replaced by '?'
+    """
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = []
+        for item in value:
+            shape = query_shape(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return '?'
+
+
+def explain_summary(explain):
+    """Pull docs examined, docs returned and the winning plan stages out of an explain document
+
+    Args:
+        explain (dict): Output of the explain command with executionStats verbosity
+
+    Returns:
+        dict: docs_examined, returned, stages and indexes
+    """
+    summary = {'docs_examined': None, 'returned': None, 'stages': [], 'indexes': []}
+
+    def walk(node, in_plan=False):
+        if isinstance(node, dict):
+            if 'executionStats' in node and summary['docs_examined'] is None:
+                stats = node['executionStats']
+                summary['docs_examined'] = stats.get('totalDocsExamined')
+                summary['returned'] = stats.get('nReturned')
+            if in_plan:
+                stage = node.get('stage')
+                if stage and stage not in summary['stages']:
+                    summary['stages'].append(stage)
+                index = node.get('indexName')
+                if index and index not in summary['indexes']:
+                    summary['indexes'].append(index)
+            for key, child in node.items():
+                walk(child, in_plan or key == 'winningPlan')
+        elif isinstance(node, list):
+            for child in node:
+                walk(child, in_plan)
+
+    walk(explain)
+    return summary
+
+
+class QueryStats:
+    def __init__(self, collection, operation, shape):
+        self.collection = collection
+        self.operation = operation
+        self.shape = shape
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.explain = None
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class QueryProfiler:
+    def __init__(self, database, threshold=None, top=None):
+        """Record query shapes and durations, explaining anything slower than the threshold
+
+        Args:
+            database (motor.motor_asyncio.AsyncIOMotorDatabase): Unwrapped database used to run explain
+            threshold (float): Slow query threshold in seconds, defaults to BRAWLBOSS_SLOW_QUERY_MS
+            top (int): Number of shapes in the report, defaults to BRAWLBOSS_PROFILE_TOP
+        """
+        self.database = database
+        self.threshold = threshold if threshold is not None else \
+            float(os.getenv('BRAWLBOSS_SLOW_QUERY_MS', 100)) / 1000
+        self.top = top or int(os.getenv('BRAWLBOSS_PROFILE_TOP', 10))
+        self.stats = {}
+        self._explains = set()
+
+    def wrap(self, database):
+        return ProfiledDatabase(database, self)
+
+    def record(self, collection, operation, query, duration, command):
+        shape = query_shape(query)
+        key = (collection, operation, json.dumps(shape, sort_keys=True, default=str))
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = QueryStats(collection, operation, shape)
+        stats.count += 1
+        stats.total += duration
+        stats.max = max(stats.max, duration)
+
+        if duration >= self.threshold:
+            stats.slow += 1
+            logger.debug(f'Slow {operation} on {collection} took {duration * 1000:.0f} ms: {key[2]}')
+            if key not in self._explains:
+                self._explains.add(key)
+                asyncio.ensure_future(self._explain(stats, command))
+
+    async def _explain(self, stats, command):
+        try:
+            explain = await self.database.command({'explain': command, 'verbosity': 'executionStats'})
+            stats.explain = explain_summary(explain)
+        except Exception as e:
+            logger.warning(f'Could not explain {stats.operation} on {stats.collection}: {e}')
+
+    def report(self, limit=None):
+        """Return the worst query shapes ranked by total time"""
+        ranked = sorted(self.stats.values(), key=lambda s: s.total, reverse=True)[:limit or self.top]
+        lines = [f'Query profile, top {len(ranked)} of {len(self.stats)} shapes by total time:']
+        for i, stats in enumerate(ranked, 1):
+            line = f'{i}. {stats.operation} {stats.collection} | ' \
+                   f'count {stats.count} | total {stats.total:.2f}s | ' \
+                   f'mean {stats.mean * 1000:.0f}ms | max {stats.max * 1000:.0f}ms | slow {stats.slow}'
+            if stats.explain:
+                explain = stats.explain
+                line = f'{line}\n   examined {explain["docs_examined"]} returned {explain["returned"]} | ' \
+                       f'plan {" > ".join(explain["stages"])} | index {", ".join(explain["indexes"]) or "none"}'
+            line = f'{line}\n   {json.dumps(stats.shape, default=str)}'
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def reset(self):
+        self.stats = {}
+        self._explains = set()
+
+
+class ProfiledDatabase:
+    """Stand-in for AsyncIOMotorDatabase that hands out profiled collections"""
+
+    def __init__(self, database, profiler):
+        self._database = database
+        self._profiler = profiler
+
+    def __getitem__(self, name):
+        return ProfiledCollection(self._database[name], self._profiler)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            return getattr(self._database, name)
+        return ProfiledCollection(self._database[name], self._profiler)
+
+    def command(self, *args, **kwargs):
+        return self._database.command(*args, **kwargs)
+
+
+class ProfiledCollection:
+    def __init__(self, collection, profiler):
+        self._collection = collection
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    async def count_documents(self, filter, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await self._collection.count_documents(filter, *args, **kwargs)
+        finally:
+            self._profiler.record(self._collection.name, 'count', filter, time.perf_counter() - start,
+                                  {'count': self._collection.name, 'query': filter})
+
+    def find(self, filter=None, *args, **kwargs):
+        return ProfiledCursor(self._collection.find(filter, *args, **kwargs), self._collection.name,
+                              filter or {}, self._profiler)
+
+    def aggregate(self, pipeline, *args, **kwargs):
+        return ProfiledAggregate(self._collection.aggregate(pipeline, *args, **kwargs), self._collection.name,
+                                 pipeline, self._profiler)
+
+
+class ProfiledCursor:
+    def __init__(self, cursor, collection, filter, profiler):
+        self._cursor = cursor
+        self._collection = collection
+        self._filter = filter
+        self._profiler = profiler
+        self._command = {'find': collection, 'filter': filter}
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __aiter__(self):
+        return self._cursor.__aiter__()
+
+    def sort(self, key, direction=1):
+        self._cursor.sort(key, direction)
+        self._command['sort'] = {key: direction} if isinstance(key, str) else dict(key)
+        return self
+
+    def limit(self, limit):
+        self._cursor.limit(limit)
+        self._command['limit'] = limit
+        return self
+
+    def skip(self, skip):
+        self._cursor.skip(skip)
+        self._command['skip'] = skip
+        return self
+
+    async def to_list(self, length=None):
+        start = time.perf_counter()
+        try:
+            return await self._cursor.to_list(length=length)
+        finally:
+            query = {'filter': self._filter, **{k: v for k, v in self._command.items() if k in ('sort', 'limit')}}
+            self._profiler.record(self._collection, 'find', query, time.perf_counter() - start, self._command)
+
+
+class ProfiledAggregate:
+    def __init__(self, cursor, collection, pipeline, profiler):
+        self._cursor = cursor
+        self._collection = collection
+        self._pipeline = pipeline
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __aiter__(self):
+        return self._cursor.__aiter__()
+
+    async def to_list(self, length=None):
+        start = time.perf_counter()
+        try:
+            return await self._cursor.to_list(length=length)
+        finally:
+            self._profiler.record(self._collection, 'aggregate', self._pipeline, time.perf_counter() - start,
+                                  {'aggregate': self._collection, 'pipeline': self._pipeline, 'cursor': {}})
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""replay.py
+Feed an archive of raw api responses back through ingestion.
+
+Responses are replayed in the order they were fetched, through the same functions the worker
+uses, so a changed storage format or a new aggregate can be rebuilt from real history. The
+database clock is set to the fetch time of every response, snapshots keep their original
+times. Writes go through the write buffer and nothing waits for the network, so this also
+measures ingestion against recorded traffic.
+
+    python brawlboss/replay.py --archive archive --database brawlboss_replay
+    python brawlboss/replay.py --archive archive --database brawlboss_replay --since 2023-05-01
+"""
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+import archive
+import database
+import ingest
+
+logger = logging.getLogger('brawlboss')
+
+
+class RecordedApi:
+    """Stands in for brawlstars.BrawlStarsApiAsync, every request returns the current recorded payload"""
+
+    def __init__(self):
+        self.payload = None
+
+    async def _get(self, *args):
+        return self.payload
+
+    get_club = get_players = get_players_battle_log = get_events = _get
+
+
+async def replay(db, records, progress_every=10000):
+    """Ingest archived responses
+
+    Args:
+        db (database.BrawlBossDatabase): Database to write to
+        records (Iterable): Archived responses, see archive.read_archive
+
+    Returns:
+        dict: Replayed responses per endpoint
+    """
+    api = RecordedApi()
+    counts = {}
+    dedup = ingest.BattleDedup()
+    day = None
+    start = time.perf_counter()
+    for record in records:
+        endpoint, tag = record['endpoint'], record['tag']
+        if record['t'].date() != day:
+            # Members share battles within a day, a per-day dedup keeps memory bounded
+            day = record['t'].date()
+            dedup = ingest.BattleDedup()
+        db.clock = record['t']
+        api.payload = record['payload']
+        if endpoint == 'clubs':
+            await ingest.refresh_club(db, tag, api)
+        elif endpoint == 'players':
+            await ingest.player_to_database(db, tag, api)
+        elif endpoint == 'players_battle_log':
+            await ingest.battles_to_database(db, {'tag': tag}, api, dedup=dedup)
+        else:
+            continue
+        counts[endpoint] = counts.get(endpoint, 0) + 1
+        total = sum(counts.values())
+        if progress_every and total % progress_every == 0:
+            logger.info(f'Replayed {total} responses up to {record["t"]:%Y-%m-%d %H:%M}, '
+                        f'{total / (time.perf_counter() - start):.0f} per second')
+    db.clock = None
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay archived api responses into a database')
+    parser.add_argument('--archive', required=True, help='Archive directory, see BRAWLSTARS_ARCHIVE_DIR')
+    parser.add_argument('--database', required=True,
+                        help='Database to replay into, use a fresh one to rebuild from scratch')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='First fetch time to replay')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='Fetch time to stop before')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s')
+
+    async def run():
+        db = database.BrawlBossDatabase(args.database)
+        await db.ensure_indexes()
+        await db.refresh_member_tags()
+        db.enable_write_buffer()
+        start = time.perf_counter()
+        try:
+            counts = await replay(db, archive.read_archive(args.archive, args.since, args.until))
+        finally:
+            await db.close_write_buffer()
+        duration = time.perf_counter() - start
+        total = sum(counts.values())
+        logger.info(f'Replayed {total} responses in {duration:.1f} seconds '
+                    f'({total / max(duration, 1e-9):.0f} per second): '
+                    + ', '.join(f'{count} {endpoint}' for endpoint, count in sorted(counts.items())))
+        db.client.close()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
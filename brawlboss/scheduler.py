@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""scheduler.py
+Adaptive per-player refresh scheduling.
+
+The battle log endpoint only returns a player's last 25 battles. Each player's battle rate
+is estimated from what earlier polls found, and the next poll is scheduled so that it lands
+before the log window can fill up. Players who stopped playing back off to hourly and then
+daily polls.
+"""
+import heapq
+import logging
+import os
+from datetime import datetime, timedelta
+
+from brawlstars import BATTLE_LOG_SIZE
+
+logger = logging.getLogger('brawlboss')
+
+
+class RefreshScheduler:
+    def __init__(self, db, min_interval=None, max_interval=None, safety=None, smoothing=0.3):
+        """Priority queue of players ordered by when their battle log is due
+
+        Args:
+            db (database.BrawlBossDatabase): Holds the per-player ingest state between restarts
+            min_interval (timedelta): Shortest time between two polls of a player,
+                defaults to SCHEDULER_MIN_MINUTES
+            max_interval (timedelta): Longest time between two polls of a player,
+                defaults to SCHEDULER_MAX_HOURS
+            safety (float): Share of the battle log window that may fill up between polls,
+                defaults to SCHEDULER_SAFETY
+            smoothing (float): Weight of the latest observation in the battle rate estimate
+        """
+        self.db = db
+        self.min_interval = min_interval or timedelta(minutes=float(os.getenv('SCHEDULER_MIN_MINUTES', 5)))
+        self.max_interval = max_interval or timedelta(hours=float(os.getenv('SCHEDULER_MAX_HOURS', 24)))
+        self.safety = safety or float(os.getenv('SCHEDULER_SAFETY', 0.5))
+        self.smoothing = smoothing
+        self.states = {}
+        self._heap = []
+
+    async def sync_members(self, club_tag, member_tags):
+        """Track the current members of a club, new members are due right away"""
+        member_tags = set(member_tags)
+        unknown = [tag for tag in member_tags if tag not in self.states]
+        if unknown:
+            stored = {state['_id']: state for state in await self.db.get_ingest_states(unknown)}
+            for tag in unknown:
+                state = stored.get(tag) or {'_id': tag, 'rate': None, 'last_poll': None, 'last_battle': None,
+                                            'next_due': datetime.utcnow()}
+                self._schedule(state)
+
+        for tag in [tag for tag, state in self.states.items() if state.get('club') == club_tag]:
+            if tag not in member_tags:
+                self.states.pop(tag)
+        for tag in member_tags:
+            self.states[tag]['club'] = club_tag
+
+    def mark_due(self, tags, now=None):
+        """Poll players early, but not before the shortest interval since their last poll"""
+        now = now or datetime.utcnow()
+        for tag in tags:
+            state = self.states.get(tag)
+            if state is None:
+                continue
+            due = max(now, state['last_poll'] + self.min_interval) if state['last_poll'] else now
+            if due < state['next_due']:
+                state['next_due'] = due
+                self._schedule(state)
+
+    def _schedule(self, state):
+        self.states[state['_id']] = state
+        heapq.heappush(self._heap, (state['next_due'], state['_id']))
+
+    def next_due(self):
+        """Time the next player is due, None when nothing is scheduled"""
+        while self._heap:
+            due, tag = self._heap[0]
+            state = self.states.get(tag)
+            if state and state['next_due'] == due:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now=None):
+        """Remove and return the tags of every player that is due"""
+        now = now or datetime.utcnow()
+        due_tags = []
+        while self.next_due() is not None and self._heap[0][0] <= now:
+            due, tag = heapq.heappop(self._heap)
+            due_tags.append(tag)
+        return due_tags
+
+    def estimate_rate(self, state, new_battles, battle_times, now):
+        """Battles per second, smoothed over the polls of a player"""
+        if state['last_poll'] is None:
+            # First poll, use the span of the log itself
+            if len(battle_times) < 2:
+                return 0.0
+            span = (now - min(battle_times)).total_seconds()
+            return len(battle_times) / span if span > 0 else 0.0
+
+        elapsed = (now - state['last_poll']).total_seconds()
+        observed = new_battles / elapsed if elapsed > 0 else 0.0
+        if new_battles >= BATTLE_LOG_SIZE:
+            # The log was full, the real rate is higher than what we could see
+            observed *= 2
+        previous = state['rate'] or 0.0
+        return self.smoothing * observed + (1 - self.smoothing) * previous
+
+    def interval(self, rate, last_battle, now):
+        """Time until the next poll of a player"""
+        if rate > 0:
+            interval = timedelta(seconds=self.safety * BATTLE_LOG_SIZE / rate)
+        else:
+            interval = self.max_interval
+
+        # Cold players back off to hourly and then daily polls
+        idle = now - last_battle if last_battle else self.max_interval
+        if idle > timedelta(days=7):
+            interval = max(interval, timedelta(days=1))
+        elif idle > timedelta(days=1):
+            interval = max(interval, timedelta(hours=1))
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    async def observe(self, tag, result, now=None):
+        """Update the battle rate of a player after a poll and schedule the next one
+
+        Args:
+            tag (str): Player tag
+            result (tuple): (new battle count, battle times in the log) from ingest.refresh_player,
+                None if the poll failed
+            now (datetime): Time of the poll
+
+        Returns:
+            datetime: When the player is due next
+        """
+        now = now or datetime.utcnow()
+        state = self.states.get(tag)
+        if state is None:
+            return None
+
+        if result is None:
+            # Failed polls keep the estimate and retry after the shortest interval
+            state['next_due'] = now + self.min_interval
+        else:
+            new_battles, battle_times = result
+            state['rate'] = self.estimate_rate(state, new_battles, battle_times, now)
+            state['last_poll'] = now
+            if battle_times:
+                state['last_battle'] = max(battle_times + ([state['last_battle']] if state['last_battle'] else []))
+            state['next_due'] = now + self.interval(state['rate'], state['last_battle'], now)
+            logger.debug(f'{tag}: {new_battles} new battles, {state["rate"] * 3600:.1f} battles/h, '
+                         f'next poll {state["next_due"]:%H:%M:%S}')
+
+        self._schedule(state)
+        await self.db.save_ingest_state(state)
+        return state['next_due']
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""watcher.py
+Follow the writes of the ingestion worker from the bot process.
+
+ChangeWatcher tails a MongoDB change stream on the player, club, battle and discord
+collections and bumps the bot's data versions, so cached responses go stale as soon as new
+data lands. Standalone mongod has no change streams, the watcher then polls the ingest state
+of the players every BRAWLBOSS_WATCH_POLL_SECONDS instead. Leaderboard keeps the club scores
+of /rankings up to date from the same events instead of recounting every member's battles.
+"""
+import asyncio
+import bisect
+import logging
+import os
+from datetime import datetime, timedelta
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+import helper
+
+logger = logging.getLogger('brawlboss')
+
+WATCHED_COLLECTIONS = ('player', 'club', 'battle', 'discord')
+
+# Error codes of servers that can not open a change stream
+CHANGE_STREAMS_UNSUPPORTED = (40573, 40324, 20)
+
+# Error code of a resume token that fell out of the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+class Leaderboard:
+    def __init__(self, db, window=timedelta(weeks=1)):
+        """Club scores of tracked clubs, updated battle by battle
+
+        The score is the same as BrawlBossDatabase.club_score, the win rate over the window
+        times the all-time star player count, at least 1.
+
+        Args:
+            db (database.BrawlBossDatabase): Used to load rosters and seed new members
+            window (timedelta): Period of the win rate
+        """
+        self.db = db
+        self.window = window
+        self.clubs = {}
+        self.members = {}
+        # Battles added while a member loads, replayed on the loaded member
+        self._loading = {}
+        self._lock = asyncio.Lock()
+
+    def is_tracked(self, club_tag):
+        return club_tag in self.clubs
+
+    async def track(self, club_tag):
+        """Load a club and the recent battles of its members, True if the club exists"""
+        async with self._lock:
+            return await self._load_club(club_tag)
+
+    async def _load_club(self, club_tag):
+        club = await self.db.get_club(club_tag)
+        if not club:
+            return False
+        self.clubs[club_tag] = club.get('members', [])
+        tracked = {member['tag'] for members in self.clubs.values() for member in members}
+        for tag in tracked - set(self.members):
+            await self._load_member(tag)
+        for tag in set(self.members) - tracked:
+            self.members.pop(tag)
+        return True
+
+    async def _load_member(self, tag):
+        since = datetime.utcnow() - self.window
+        pending = self._loading[tag] = []
+        try:
+            star_player = await self.db.star_player_count(tag)
+            battles = await self.db.recent_battle_results(tag, since)
+        finally:
+            del self._loading[tag]
+        times = sorted((battle['battleTime'], battle['_id']) for battle in battles)
+        self.members[tag] = {
+            'times': times,
+            'victories': {battle['_id'] for battle in battles if helper.is_victory(battle)},
+            'star_player': star_player,
+        }
+        # Battles that landed during the queries, the ones they returned already are skipped
+        for battle_log in pending:
+            self._add_member_battle(tag, battle_log)
+
+    async def club_changed(self, club_tag):
+        """Reload the roster of a tracked club"""
+        if self.is_tracked(club_tag):
+            async with self._lock:
+                await self._load_club(club_tag)
+
+    async def player_changed(self, tag):
+        """Reload the battles of a tracked member, used when only polling is available"""
+        if tag in self.members:
+            async with self._lock:
+                await self._load_member(tag)
+
+    def add_battle(self, battle_log):
+        """Count a newly stored battle for every tracked member who played in it"""
+        for tag in helper.battle_participant_tags(battle_log):
+            if tag in self._loading:
+                self._loading[tag].append(battle_log)
+            self._add_member_battle(tag, battle_log)
+
+    def _add_member_battle(self, tag, battle_log):
+        member = self.members.get(tag)
+        if member is None:
+            return
+        entry = (battle_log['battleTime'], battle_log['_id'])
+        i = bisect.bisect_left(member['times'], entry)
+        if i < len(member['times']) and member['times'][i] == entry:
+            # Already loaded with the member
+            return
+        member['times'].insert(i, entry)
+        if helper.is_victory(battle_log):
+            member['victories'].add(battle_log['_id'])
+        if (battle_log.get('battle', {}).get('starPlayer') or {}).get('tag') == tag:
+            member['star_player'] += 1
+
+    def score(self, tag, now=None):
+        member = self.members.get(tag)
+        if not member:
+            return 0
+        since = (now or datetime.utcnow()) - self.window
+
+        # Battles that left the window are dropped for good
+        start = bisect.bisect_left(member['times'], (since,))
+        for battle_time, _id in member['times'][:start]:
+            member['victories'].discard(_id)
+        del member['times'][:start]
+
+        total = len(member['times'])
+        win_rate = len(member['victories']) / total if total else 0
+        return win_rate * max(member['star_player'], 1)
+
+    def rankings(self, club_tag):
+        """Members of a tracked club with their score, best first, None if the club is not tracked"""
+        if not self.is_tracked(club_tag):
+            return None
+        now = datetime.utcnow()
+        scores = [dict(member, score=self.score(member['tag'], now)) for member in self.clubs[club_tag]]
+        return sorted(scores, key=lambda x: x['score'], reverse=True)
+
+
+class ChangeWatcher:
+    def __init__(self, db, leaderboard=None, poll_interval=None):
+        """Push database changes made by other processes into the bot's caches
+
+        Args:
+            db (database.BrawlBossDatabase): Database whose data versions are bumped
+            leaderboard (Leaderboard): Updated with every stored battle and roster change
+            poll_interval (float): Seconds between polls when change streams are not available,
+                defaults to BRAWLBOSS_WATCH_POLL_SECONDS
+        """
+        self.db = db
+        self.leaderboard = leaderboard
+        self.poll_interval = poll_interval or float(os.getenv('BRAWLBOSS_WATCH_POLL_SECONDS', 10))
+        self.mode = None
+        self._resume_token = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                self.mode = 'change stream'
+                await self._watch()
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAMS_UNSUPPORTED:
+                    logger.info(f'Change streams are not available ({e}), '
+                                f'polling every {self.poll_interval:.0f} seconds')
+                    self.mode = 'polling'
+                    await self._poll()
+                    return
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    # Changes were missed, everything cached may be stale
+                    logger.warning('Change stream history lost, invalidating all cached data')
+                    self._resume_token = None
+                    await self._invalidate_all()
+                else:
+                    logger.error(f'Change stream failed: {e}')
+            except PyMongoError as e:
+                logger.error(f'Change stream failed: {e}')
+            await asyncio.sleep(self.poll_interval)
+
+    async def _watch(self):
+        async with self.db.watch(WATCHED_COLLECTIONS, resume_after=self._resume_token) as stream:
+            logger.info(f'Watching {", ".join(WATCHED_COLLECTIONS)} for changes')
+            async for change in stream:
+                self._resume_token = stream.resume_token
+                try:
+                    await self.handle(change)
+                except Exception as e:
+                    logger.error(f'Could not handle {change.get("operationType")} on '
+                                 f'{change.get("ns", {}).get("coll")}: {e}')
+
+    async def handle(self, change):
+        """Apply one change stream event"""
+        collection = change['ns']['coll']
+        key = change.get('documentKey', {}).get('_id')
+        versions = self.db.versions
+
+        if collection == 'battle':
+            versions.bump('battle', key)
+            document = change.get('fullDocument')
+            if change['operationType'] == 'insert' and document:
+                for tag in helper.battle_participant_tags(document):
+                    versions.bump('player', tag)
+                if self.leaderboard:
+                    self.leaderboard.add_battle(document)
+        elif collection == 'player':
+            versions.bump('player', key)
+        elif collection == 'club':
+            versions.bump('club', key)
+            if self.leaderboard:
+                await self.leaderboard.club_changed(key)
+        elif collection == 'discord':
+            self.db.discord_tags.pop(key, None)
+            versions.bump('discord', key)
+
+    async def _poll(self):
+        """Fallback without change streams, follow the per-player ingest state the worker keeps"""
+        since = datetime.utcnow()
+        last_battles = {}
+        rosters = {}
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                polled_at = datetime.utcnow()
+                for state in await self.db.changed_ingest_states(since):
+                    tag = state['_id']
+                    if state.get('last_battle') != last_battles.get(tag):
+                        last_battles[tag] = state.get('last_battle')
+                        self.db.versions.bump('player', tag)
+                        if self.leaderboard:
+                            await self.leaderboard.player_changed(tag)
+                since = polled_at
+
+                for club_tag, member_tags in (await self.db.club_rosters()).items():
+                    if rosters.get(club_tag) != member_tags:
+                        if club_tag in rosters:
+                            self.db.versions.bump('club', club_tag)
+                            if self.leaderboard:
+                                await self.leaderboard.club_changed(club_tag)
+                        rosters[club_tag] = member_tags
+            except PyMongoError as e:
+                logger.error(f'Polling for changes failed: {e}')
+
+    async def _invalidate_all(self):
+        self.db.versions.invalidate_all()
+        self.db.discord_tags.clear()
+        if self.leaderboard:
+            async with self.leaderboard._lock:
+                for club_tag in list(self.leaderboard.clubs):
+                    await self.leaderboard._load_club(club_tag)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""worker.py
+Standalone ingestion worker, keeps every club in the registry up to date.
+
+Club rosters are refreshed on a fixed interval, the members' profiles and battle logs are
+polled adaptively by scheduler.RefreshScheduler. Clubs are spread over worker processes with
+a consistent hash ring, so changing the number of processes only moves a small share of the
+clubs. Every process has its own api client, connection pool and share of the request budget.
+The Discord bot only reads the database.
+Once a week every shard also stores the player of the week of its clubs.
+
+    python brawlboss/worker.py --processes 4 --register '#2YLLVJ0Q'
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from datetime import datetime, timedelta
+
+import analytics
+import brawlstars
+import database
+import helper
+import ingest
+import metrics
+import scheduler
+
+logger = logging.getLogger('brawlboss')
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=100):
+        """Consistent hash ring
+
+        Args:
+            nodes (Iterable): Node names
+            replicas (int): Virtual points per node, more points give a more even spread
+        """
+        self._points = sorted((self._hash(f'{node}:{i}'), node) for node in nodes for i in range(replicas))
+        self._keys = [point for point, node in self._points]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+    def node_for(self, key):
+        """Return the node that owns key"""
+        if not self._points:
+            return None
+        i = bisect.bisect(self._keys, self._hash(key)) % len(self._points)
+        return self._points[i][1]
+
+
+def shard_name(index):
+    return f'shard-{index}'
+
+
+async def refresh_clubs(db, api, ring, index, refresh_scheduler):
+    """Refresh the clubs owned by a shard and hand their members to the scheduler"""
+    clubs = [tag for tag in await db.registered_clubs() if ring.node_for(tag) == shard_name(index)]
+    logger.info(f'Shard {index} refreshing {len(clubs)} clubs')
+    # Members of clubs on other shards get brawler stats from battles this shard stores too
+    await db.refresh_member_tags()
+    for club_tag in clubs:
+        result = await ingest.refresh_club(db, club_tag, api)
+        if result:
+            club, events = result
+            await refresh_scheduler.sync_members(club_tag, [member['tag'] for member in club.get('members', [])])
+            # Members whose trophies or role changed have been playing, poll them now
+            refresh_scheduler.mark_due(event['tag'] for event in events if event['type'] in ('trophies', 'role'))
+
+
+def award_week(now, grace):
+    """Start of the last week that ended at least grace ago, and when the next one is due"""
+    current = helper.week_start(now - grace)
+    return current - timedelta(weeks=1), current + timedelta(weeks=1) + grace
+
+
+async def award_player_of_the_week(db, ring, index, week_start):
+    """Store the player of the week of the clubs owned by a shard, weeks already awarded are skipped
+
+    Returns:
+        bool: False if any club failed
+    """
+    succeeded = True
+    for club_tag in [tag for tag in await db.registered_clubs() if ring.node_for(tag) == shard_name(index)]:
+        try:
+            if await db.player_of_the_week(club_tag, week_start):
+                continue
+            club = await db.get_club(club_tag)
+            if not club:
+                continue
+            award = await analytics.player_of_the_week(db, club, week_start)
+            await db.save_player_of_the_week(award)
+            winner = award['rankings'][0]['tag'] if award['rankings'] else None
+            logger.info(f'Player of the week {week_start:%G-W%V} of {club_tag}: {winner}')
+        except Exception as e:
+            logger.error(f'Could not award player of the week of {club_tag}: {e}')
+            succeeded = False
+    return succeeded
+
+
+async def refresh_players(db, api, refresh_scheduler):
+    """Poll every player that is due"""
+    due = refresh_scheduler.pop_due()
+    if not due:
+        return
+
+    start = time.perf_counter()
+    dedup = ingest.BattleDedup()
+    failed = 0
+    try:
+        for tag in due:
+            try:
+                watermark = refresh_scheduler.states.get(tag, {}).get('last_battle')
+                result = await ingest.refresh_player(db, tag, api, watermark, dedup, profile=db.profile_due(tag))
+            except Exception as e:
+                failed += 1
+                logger.error(f'{tag}: {e}')
+                result = None
+            await refresh_scheduler.observe(tag, result)
+    finally:
+        if db.write_buffer is not None:
+            await db.write_buffer.flush()
+        # Counted once per round, like the refresh cycles of ingest.update
+        if failed:
+            metrics.REFRESH_ERRORS.inc()
+
+    duration = time.perf_counter() - start
+    metrics.REFRESH_DURATION.observe(duration)
+    logger.info(f'Polled {len(due)} players in {duration:.1f} seconds, {failed} failed, '
+                f'{dedup.new_battles} new battles, {dedup.summary()}')
+
+
+async def run_shard(index, processes, interval, rate=None, key_rate=None):
+    """Refresh the clubs owned by one shard and poll their members when they are due
+
+    Args:
+        index (int): Shard number
+        processes (int): Total number of shards
+        interval (float): Minutes between club refreshes
+        rate (float): Requests per second budget of this shard
+        key_rate (float): Requests per second budget of this shard per api token
+    """
+    metrics_port = os.getenv('WORKER_METRICS_PORT')
+    if metrics_port:
+        try:
+            await metrics.start_server(port=int(metrics_port) + index)
+        except OSError as e:
+            logger.warning(f'Shard {index} could not serve metrics: {e}')
+
+    ring = HashRing(shard_name(i) for i in range(processes))
+    db = database.BrawlBossDatabase()
+    db.enable_write_buffer()
+    await db.ensure_indexes()
+    refresh_scheduler = scheduler.RefreshScheduler(db)
+    next_club_refresh = datetime.utcnow()
+    # Late battles of the last day of the week are ingested before the award is computed
+    award_grace = timedelta(hours=float(os.getenv('PLAYER_OF_THE_WEEK_GRACE_HOURS', 2)))
+    next_award = datetime.utcnow()
+    try:
+        async with brawlstars.BrawlStarsApiAsync(rate=rate, key_rate=key_rate) as api:
+            while True:
+                try:
+                    if datetime.utcnow() >= next_club_refresh:
+                        next_club_refresh = datetime.utcnow() + timedelta(minutes=interval)
+                        await refresh_clubs(db, api, ring, index, refresh_scheduler)
+                    await refresh_players(db, api, refresh_scheduler)
+                    if datetime.utcnow() >= next_award:
+                        week_start, next_award = award_week(datetime.utcnow(), award_grace)
+                        if not await award_player_of_the_week(db, ring, index, week_start):
+                            next_award = min(next_award, datetime.utcnow() + timedelta(hours=1))
+                except Exception as e:
+                    logger.error(e)
+
+                next_due = min(filter(None, [refresh_scheduler.next_due(), next_club_refresh, next_award]))
+                logger.info(f'Shard {index} next update: {next_due:%Y-%m-%d %H:%M:%S} UTC')
+                await asyncio.sleep(max((next_due - datetime.utcnow()).total_seconds(), 0))
+    finally:
+        # Shutdown and cancellation land here, nothing queued is lost
+        await db.close_write_buffer()
+        logger.info(f'Shard {index} stopped')
+
+
+async def run_until_terminated(index, processes, interval, rate, key_rate=None):
+    """Run a shard and cancel it on SIGTERM, so it can flush its write buffer"""
+    task = asyncio.current_task()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    except NotImplementedError:
+        # Windows
+        pass
+    try:
+        await run_shard(index, processes, interval, rate, key_rate)
+    except asyncio.CancelledError:
+        pass
+
+
+def shard_process(index, processes, interval, rate, key_rate=None):
+    logging.basicConfig(level=logging.INFO,
+                        format=f'[%(asctime)s] [%(levelname)-8s] shard-{index} %(name)s: %(message)s')
+    asyncio.run(run_until_terminated(index, processes, interval, rate, key_rate))
+
+
+async def register(tags):
+    db = database.BrawlBossDatabase()
+    for tag in tags:
+        if await db.register_club(tag):
+            logger.info(f'Registered club {tag}')
+    db.client.close()
+
+
+def stop_workers(workers, timeout=30, kill=False):
+    """Wait for shards that were asked to stop, and stop the ones that do not in time
+
+    Args:
+        workers (list): Shard processes
+        timeout (float): Seconds to wait for each shard
+        kill (bool): SIGKILL shards that are still running, they already got SIGTERM
+    """
+    for worker in workers:
+        worker.join(timeout)
+        if worker.is_alive():
+            logger.warning(f'{worker.name} did not stop within {timeout} seconds')
+            if kill:
+                worker.kill()
+            else:
+                worker.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingest Brawl Stars data for every registered club')
+    parser.add_argument('--processes', type=int, default=int(os.getenv('WORKER_PROCESSES', 1)))
+    parser.add_argument('--interval', type=float, default=float(os.getenv('WORKER_INTERVAL_MINUTES', 15)),
+                        help='Minutes between club roster refreshes')
+    parser.add_argument('--rate', type=float, default=float(os.getenv('BRAWLSTARS_API_RATE', 0)),
+                        help='Total api requests per second, split evenly over the processes')
+    parser.add_argument('--key-rate', type=float, default=float(os.getenv('BRAWLSTARS_API_KEY_RATE', 0)),
+                        help='Api requests per second per token, split evenly over the processes')
+    parser.add_argument('--register', nargs='*', default=[], help='Club tags to add to the registry')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s')
+
+    # The club of the bot is always tracked
+    tags = list(args.register)
+    if os.getenv('BRAWLSTARS_CLUB_TAG'):
+        tags.append(os.getenv('BRAWLSTARS_CLUB_TAG'))
+    asyncio.run(register(tags))
+
+    rate = args.rate / args.processes if args.rate else None
+    # Every process uses every token, each gets its share of a token's budget
+    key_rate = args.key_rate / args.processes if args.key_rate else None
+    if args.processes == 1:
+        asyncio.run(run_until_terminated(0, 1, args.interval, rate, key_rate))
+        return
+
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=shard_process, args=(i, args.processes, args.interval, rate, key_rate),
+                               name=shard_name(i)) for i in range(args.processes)]
+    for worker in workers:
+        worker.start()
+
+    def terminate(signum, frame):
+        # Only the parent gets SIGTERM from docker stop, pass it on so the shards flush their buffers
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        stop_workers(workers, kill=True)
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # The shards got the interrupt too, give them time to flush their write buffers
+        stop_workers(workers)
+
+
+if __name__ == '__main__':
+    main()
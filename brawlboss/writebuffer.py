@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""writebuffer.py
+Write-behind buffer for ingestion writes.
+
+Upserts are queued per collection and written with one unordered bulk_write when a
+collection reaches WRITE_BUFFER_SIZE operations or every WRITE_BUFFER_SECONDS. Writers wait
+for a flush once WRITE_BUFFER_MAX operations are queued, so a slow database slows
+ingestion down instead of growing the buffer without bound.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from pymongo.errors import BulkWriteError
+
+import metrics
+
+logger = logging.getLogger('brawlboss')
+
+DUPLICATE_KEY = 11000
+
+
+class WriteBuffer:
+    def __init__(self, db, versions=None, max_size=None, interval=None, max_pending=None):
+        """Queue of pending writes per collection
+
+        Args:
+            db (motor.motor_asyncio.AsyncIOMotorDatabase): Database to write to
+            versions (database.DataVersions): Bumped for the documents a flush changed
+            max_size (int): Operations per collection that trigger a flush, defaults to WRITE_BUFFER_SIZE
+            interval (float): Seconds between timed flushes, defaults to WRITE_BUFFER_SECONDS
+            max_pending (int): Queued operations at which writers wait for a flush,
+                defaults to WRITE_BUFFER_MAX
+        """
+        self.db = db
+        self.versions = versions
+        self.max_size = max_size or int(os.getenv('WRITE_BUFFER_SIZE', 500))
+        self.interval = interval or float(os.getenv('WRITE_BUFFER_SECONDS', 5))
+        self.max_pending = max_pending or int(os.getenv('WRITE_BUFFER_MAX', self.max_size * 4))
+        self._operations = {}
+        self._pending = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def __len__(self):
+        return self._pending
+
+    def start(self):
+        """Start the timed flushes"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        """Stop the timed flushes and write everything that is still queued"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f'Timed write buffer flush failed: {e}')
+
+    async def add(self, collection, operation, bumps=(), insert_only=False, follow_ups=(), lost=None):
+        """Queue a write
+
+        Args:
+            collection (str): Collection name
+            operation: pymongo write operation, e.g. UpdateOne
+            bumps (Iterable): (kind, key) data versions to bump once the write is stored
+            insert_only (bool): Only bump the versions if the operation inserted a document
+            follow_ups (Iterable): (collection, operation) writes to queue if the operation
+                inserted a document
+            lost (Callable): Called without arguments if the operation could not be written,
+                e.g. to forget state that assumed it was
+        """
+        # Backpressure, wait for the queued writes to be stored before adding more
+        while self._pending >= self.max_pending:
+            await self.flush()
+
+        queue = self._queue(collection, (operation, tuple(bumps), insert_only, tuple(follow_ups), lost))
+        if len(queue) >= self.max_size:
+            await self.flush(collection)
+
+    def _queue(self, collection, entry):
+        queue = self._operations.setdefault(collection, [])
+        queue.append(entry)
+        self._pending += 1
+        metrics.WRITE_BUFFER_PENDING.set(self._pending)
+        return queue
+
+    async def flush(self, collection=None):
+        """Write the queued operations of one collection, or of all collections
+
+        Follow-up writes queued by the flush of all collections are written by it as well.
+        """
+        async with self._lock:
+            while True:
+                names = [collection] if collection else list(self._operations)
+                for name in names:
+                    queue = self._operations.pop(name, None)
+                    if not queue:
+                        continue
+                    self._pending -= len(queue)
+                    metrics.WRITE_BUFFER_PENDING.set(self._pending)
+                    await self._write(name, queue)
+                if collection or not self._operations:
+                    break
+
+    async def _write(self, collection, queue):
+        start = time.perf_counter()
+        try:
+            result = await self.db[collection].bulk_write([entry[0] for entry in queue], ordered=False)
+            upserted = set(result.upserted_ids)
+            failed = set()
+        except BulkWriteError as e:
+            # Unordered, everything but the failed operations was written
+            errors = [error for error in e.details.get('writeErrors', []) if error.get('code') != DUPLICATE_KEY]
+            if errors:
+                metrics.WRITE_BUFFER_ERRORS.inc(len(errors), collection=collection)
+                logger.error(f'{len(errors)} of {len(queue)} buffered {collection} writes failed: '
+                             f'{errors[0].get("errmsg")}')
+            upserted = {item['index'] for item in e.details.get('upserted', [])}
+            failed = {error['index'] for error in errors}
+        except Exception as e:
+            metrics.WRITE_BUFFER_ERRORS.inc(len(queue), collection=collection)
+            logger.error(f'Lost {len(queue)} buffered {collection} writes: {e}')
+            self._lost(queue)
+            return
+        finally:
+            metrics.WRITE_BUFFER_FLUSH.observe(time.perf_counter() - start, collection=collection)
+
+        metrics.WRITE_BUFFER_WRITES.inc(len(queue), collection=collection)
+        self._lost(entry for i, entry in enumerate(queue) if i in failed)
+        for i, (operation, bumps, insert_only, follow_ups, lost) in enumerate(queue):
+            if i in failed or (insert_only and i not in upserted):
+                continue
+            if self.versions is not None:
+                for kind, key in bumps:
+                    self.versions.bump(kind, key)
+            if i in upserted:
+                for follow_up_collection, follow_up in follow_ups:
+                    self._queue(follow_up_collection, (follow_up, (), False, (), None))
+
+    @staticmethod
+    def _lost(entries):
+        for operation, bumps, insert_only, follow_ups, lost in entries:
+            if lost is not None:
+                try:
+                    lost()
+                except Exception as e:
+                    logger.error(f'Lost write callback failed: {e}')
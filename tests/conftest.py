@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+# The bot's modules import each other by name, like when they are run from brawlboss/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'brawlboss'))
+
+import database  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """BrawlBossDatabase on an in-memory mongomock database"""
+    import mongomock.collection
+    import mongomock_motor
+
+    # pymongo 4.9 passes sort to every bulk operation, mongomock does not know it yet
+    for name in ('add_update', 'add_replace'):
+        add = getattr(mongomock.collection.BulkOperationBuilder, name)
+        monkeypatch.setattr(mongomock.collection.BulkOperationBuilder, name,
+                            lambda self, *args, sort=None, _add=add, **kwargs: _add(self, *args, **kwargs))
+    monkeypatch.setattr(database, 'AsyncIOMotorClient', lambda *args, **kwargs: mongomock_motor.AsyncMongoMockClient())
+    return database.BrawlBossDatabase('brawlboss_test')
@@ -0,0 +1,50 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import analytics
+
+MEMBERS = ['#AAA', '#BBB', '#CCC', '#DDD']
+
+
+def team_battle(minutes_ago, result, star, teams):
+    time = datetime.utcnow() - timedelta(minutes=minutes_ago)
+    return {'_id': time.timestamp(), 'battleTime': time, 'event': {'mode': 'gemGrab'},
+            'battle': {'mode': 'gemGrab', 'result': result, 'duration': 120,
+                       'starPlayer': {'tag': star} if star else None,
+                       'teams': [[{'tag': tag} for tag in team] for team in teams]}}
+
+
+def showdown_battle(minutes_ago, rank, players):
+    time = datetime.utcnow() - timedelta(minutes=minutes_ago)
+    return {'_id': time.timestamp(), 'battleTime': time, 'event': {'mode': 'soloShowdown'},
+            'battle': {'mode': 'soloShowdown', 'rank': rank, 'players': [{'tag': tag} for tag in players]}}
+
+
+BATTLES = [
+    team_battle(10, 'victory', '#AAA', [['#AAA', '#BBB', '#X1'], ['#Y1', '#Y2', '#Y3']]),
+    team_battle(20, 'defeat', '#Y1', [['#AAA', '#X1', '#X2'], ['#Y1', '#Y2', '#Y3']]),
+    team_battle(30, 'victory', None, [['#BBB', '#CCC', '#X1'], ['#Y1', '#Y2', '#Y3']]),
+    team_battle(40, 'victory', '#CCC', [['#CCC', '#X1', '#X2'], ['#Y1', '#Y2', '#Y3']]),
+    showdown_battle(50, 1, ['#AAA', '#Y1', '#Y2']),
+    showdown_battle(60, 5, ['#BBB', '#Y1', '#Y2']),
+    # Older than the week, only counts for the all-time star player count
+    team_battle(60 * 24 * 10, 'victory', '#BBB', [['#BBB', '#X1', '#X2'], ['#Y1', '#Y2', '#Y3']]),
+    team_battle(60 * 24 * 10, 'victory', '#BBB', [['#BBB', '#X1', '#X2'], ['#Y1', '#Y2', '#Y3']]),
+]
+
+
+def test_club_stats_scores_match_club_score(db):
+    async def run():
+        # Distinct _ids, the two old battles share a battle time
+        await db.db.battle.insert_many([dict(battle, _id=i) for i, battle in enumerate(BATTLES)])
+        club = {'members': [{'tag': tag} for tag in MEMBERS]}
+        since = datetime.utcnow() - timedelta(weeks=1)
+        stats = await analytics.club_stats(db, club, since)
+        return stats.scores(since).tolist(), [await db.club_score(tag) for tag in MEMBERS]
+
+    scores, expected = asyncio.run(run())
+    assert scores == pytest.approx(expected)
+    # Two of three won and one star; two of three won and two stars last week; both won; no battles
+    assert scores == pytest.approx([2 / 3, 4 / 3, 1.0, 0.0])
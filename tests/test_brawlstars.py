@@ -0,0 +1,40 @@
+import time
+
+from brawlstars import TokenPool
+
+
+def make_pool():
+    return TokenPool(['first', 'second'], max_forbidden=3, cooldown=600)
+
+
+def test_report_disables_key_after_repeated_forbidden():
+    pool = make_pool()
+    key = pool.keys[0]
+    for _ in range(2):
+        pool.report(key, 403)
+    assert pool.usable() == pool.keys
+    pool.report(key, 403)
+    assert pool.usable() == [pool.keys[1]]
+    assert key.disabled_until > time.monotonic() + 590
+    assert key.forbidden == 0
+
+
+def test_report_success_resets_forbidden_count():
+    pool = make_pool()
+    key = pool.keys[0]
+    pool.report(key, 403)
+    pool.report(key, 403)
+    pool.report(key, 200)
+    pool.report(key, 403)
+    assert key.forbidden == 1
+    assert key in pool.usable()
+
+
+def test_report_rate_limited_key_waits_for_retry_after():
+    pool = make_pool()
+    key = pool.keys[0]
+    pool.report(key, 429, retry_after='30')
+    assert 29 < key.wait_time(time.monotonic()) <= 30
+    assert key in pool.usable()
+    pool.report(pool.keys[1], 429, retry_after=None)
+    assert 0 < pool.keys[1].wait_time(time.monotonic()) <= 1
@@ -0,0 +1,201 @@
+import asyncio
+from datetime import datetime
+
+import database
+import writebuffer
+
+NOW = datetime(2024, 1, 1, 12)
+
+
+def member(tag, role='member', trophies=1000):
+    return {'tag': tag, 'name': f'Player {tag}', 'role': role, 'trophies': trophies}
+
+
+def test_diff_members_unchanged_roster():
+    previous = {'#A': member('#A'), '#B': member('#B')}
+    assert database.diff_members('#CLUB', previous, [member('#A'), member('#B')], NOW) == []
+
+
+def test_diff_members_events():
+    previous = {'#A': member('#A'), '#B': member('#B'), '#C': member('#C')}
+    members = [member('#A', role='senior'), member('#B', trophies=1020), member('#D')]
+    events = database.diff_members('#CLUB', previous, members, NOW)
+
+    by_type = {(event['type'], event['tag']): event for event in events}
+    assert set(by_type) == {('role', '#A'), ('trophies', '#B'), ('join', '#D'), ('leave', '#C')}
+    assert (by_type['role', '#A']['from'], by_type['role', '#A']['to']) == ('member', 'senior')
+    assert (by_type['trophies', '#B']['from'], by_type['trophies', '#B']['to']) == (1000, 1020)
+    assert all(event['club'] == '#CLUB' and event['time'] == NOW for event in events)
+
+
+def test_diff_members_role_and_trophies_change_together():
+    events = database.diff_members('#CLUB', {'#A': member('#A')}, [member('#A', role='vicePresident', trophies=900)])
+    assert sorted(event['type'] for event in events) == ['role', 'trophies']
+
+
+def player(trophies=1000):
+    return {'tag': '#P', 'name': 'Player', 'trophies': trophies, 'highestTrophies': 1200, 'expPoints': 50,
+            'brawlers': [{'id': 1, 'name': 'SHELLY', 'trophies': 300}]}
+
+
+def count_writes(db, monkeypatch):
+    writes = []
+    collection = type(db.db['player'])
+    update_one = collection.update_one
+
+    def counted(self, *args, **kwargs):
+        writes.append(args[0])
+        return update_one(self, *args, **kwargs)
+
+    monkeypatch.setattr(collection, 'update_one', counted)
+    return writes
+
+
+def test_unchanged_player_is_not_written(db, monkeypatch):
+    writes = count_writes(db, monkeypatch)
+
+    async def run():
+        first = await db.upsert_player(player())
+        version = db.versions.get('player', '#P')
+        second = await db.upsert_player(player())
+        return first, second, version
+
+    (document, is_new, changed), second, version = asyncio.run(run())
+    assert (is_new, changed) == (True, True)
+    assert document['_fingerprint'] == database.fingerprint(player())
+    assert second[1:] == (False, False)
+    assert len(writes) == 1
+    assert db.versions.get('player', '#P') == version
+
+
+def test_stored_fingerprint_is_compared_after_a_restart(db):
+    async def run():
+        await db.upsert_player(player())
+        # A new process has no fingerprints cached and reads the stored one
+        db.fingerprints.clear()
+        return await db._changed('player', player()), await db._changed('player', player(1001))
+
+    unchanged, changed = asyncio.run(run())
+    assert unchanged == (False, False)
+    assert changed == (False, True)
+
+
+def test_changed_player_is_written(db, monkeypatch):
+    writes = count_writes(db, monkeypatch)
+
+    async def run():
+        await db.upsert_player(player())
+        version = db.versions.get('player', '#P')
+        result = await db.upsert_player(player(1010))
+        stored = await db.db['player'].find_one({'_id': '#P'})
+        return result, version, stored
+
+    (document, is_new, changed), version, stored = asyncio.run(run())
+    assert (is_new, changed) == (False, True)
+    assert len(writes) == 2
+    assert stored['trophies'] == 1010 and stored['_fingerprint'] == database.fingerprint(player(1010))
+    assert db.versions.get('player', '#P') > version
+
+
+class FailingCollection:
+    async def bulk_write(self, operations, ordered=True):
+        raise ConnectionError('gone')
+
+
+class FailingDatabase:
+    def __getitem__(self, name):
+        return FailingCollection()
+
+
+def test_lost_buffered_write_is_written_again(db):
+    async def run():
+        await db.upsert_player(player())
+        db.write_buffer = writebuffer.WriteBuffer(FailingDatabase(), db.versions)
+        queued = await db.buffer_player(player(1010))
+        await db.write_buffer.flush()
+        db.write_buffer = None
+        # The lost payload and its history values are not taken for the stored ones
+        forgotten = ('player', '#P') not in db.fingerprints and '#P' not in db.series_last
+        return queued, forgotten, await db.upsert_player(player(1010))
+
+    queued, forgotten, (document, is_new, changed) = asyncio.run(run())
+    assert queued[1:] == (False, True)
+    assert forgotten
+    assert changed
+
+
+def snapshot(trophies, shelly, colt=None):
+    brawlers = [{'id': 16000000, 'name': 'SHELLY', 'trophies': shelly}]
+    if colt is not None:
+        brawlers.append({'id': 16000001, 'name': 'COLT', 'trophies': colt})
+    return {'tag': '#P', 'trophies': trophies, 'highestTrophies': 1200, 'expPoints': 50, 'brawlers': brawlers}
+
+
+def test_series_values_nest_brawlers_without_dots():
+    values = database.series_values(snapshot(1000, 300, 40))
+    assert values['brawlers'] == {'16000000': 300, '16000001': 40}
+    assert not any('.' in field for field in values)
+
+
+def test_series_deltas_keep_only_changes():
+    previous = database.series_values(snapshot(1000, 300))
+    values = database.series_values(snapshot(1008, 308, 0))
+    assert database.series_deltas(previous, values) == {'trophies': 8, 'brawlers': {'16000000': 8, '16000001': 0}}
+    assert database.series_deltas(values, values) == {}
+
+
+def test_player_history_round_trip(db):
+    # Four polls over two weekly buckets, the third one changed nothing
+    polls = [(datetime(2024, 1, 3, 12), snapshot(1000, 300)),
+             (datetime(2024, 1, 5, 12), snapshot(1010, 310)),
+             (datetime(2024, 1, 6, 12), snapshot(1010, 310)),
+             (datetime(2024, 1, 9, 12), snapshot(990, 310, 20))]
+
+    async def run():
+        written = [await db.record_player_history(data, now) for now, data in polls]
+        buckets = await db.db['player_history'].find({}).sort('start', 1).to_list(length=None)
+        return written, buckets, await db.player_history('#P', datetime(2024, 1, 3, 12))
+
+    written, buckets, points = asyncio.run(run())
+    assert written == [True, True, False, True]
+    assert len(buckets) == 2
+    # Every bucket starts with the values carried over from the week before
+    expected = [(now, database.series_values(data)) for now, data in polls if now != datetime(2024, 1, 6, 12)]
+    expected.insert(2, (datetime(2024, 1, 8), database.series_values(polls[1][1])))
+    assert points == expected
+    assert list(database.decode_history(buckets))[-1][1] == database.series_values(polls[-1][1])
+
+
+def test_profile_version_follows_stored_data(db):
+    async def run():
+        unlinked = await db.profile_version(1)
+        await db.db['discord'].insert_one({'_id': 1, 'tag': '#P'})
+        await db.db['player'].insert_one({'_id': '#P', '_fingerprint': 'a'})
+        # The tag is resolved on the first call, not only after a command filled in the link
+        first = await db.profile_version(1)
+        # Written by the worker, no version is bumped in this process
+        await db.db['player'].update_one({'_id': '#P'}, {'$set': {'_fingerprint': 'b'}})
+        profile_changed = await db.profile_version(1)
+        await db.db['ingest_state'].insert_one({'_id': '#P', 'last_battle': datetime(2024, 1, 1)})
+        battle_added = await db.profile_version(1)
+        return unlinked, first, profile_changed, battle_added, await db.profile_version(1)
+
+    unlinked, first, profile_changed, battle_added, unchanged = asyncio.run(run())
+    assert unlinked[0] is None
+    assert first[0] == '#P'
+    assert len({unlinked, first, profile_changed, battle_added}) == 4
+    assert unchanged == battle_added
+
+
+def test_rankings_version_follows_stored_data(db):
+    async def run():
+        await db.db['club'].insert_one({'_id': '#C', '_fingerprint': 'a', 'members': [{'tag': '#P'}, {'tag': '#Q'}]})
+        await db.db['ingest_state'].insert_many([{'_id': '#P', 'last_battle': datetime(2024, 1, 1)},
+                                                 {'_id': '#Q', 'last_battle': datetime(2024, 1, 2)}])
+        first = await db.rankings_version('#C')
+        await db.db['ingest_state'].update_one({'_id': '#P'}, {'$set': {'last_battle': datetime(2024, 1, 3)}})
+        return first, await db.rankings_version('#C')
+
+    first, battle_added = asyncio.run(run())
+    assert first[:2] == ('a', datetime(2024, 1, 2))
+    assert battle_added[:2] == ('a', datetime(2024, 1, 3))
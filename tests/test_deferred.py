@@ -0,0 +1,119 @@
+import asyncio
+
+from deferred import DeferredResponder, ResultCache
+
+
+class StubContext:
+    """Records the defer and send calls of a command"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def defer(self):
+        self.calls.append(('defer',))
+
+    async def send(self, message):
+        self.calls.append(('send', message))
+
+
+def test_cached_response_is_sent_without_deferring():
+    async def run():
+        responder = DeferredResponder(ResultCache(ttl=60))
+        responder.cache.set(('profile', 1), 'cached')
+        ctx = StubContext()
+        await responder.respond(ctx, ('profile', 1), compute=None)
+        return ctx.calls
+
+    assert asyncio.run(run()) == [('send', 'cached')]
+
+
+def test_concurrent_commands_share_one_computation():
+    computed = []
+
+    async def compute():
+        computed.append(1)
+        await asyncio.sleep(0.01)
+        return 'rankings'
+
+    async def run():
+        responder = DeferredResponder(ResultCache(ttl=60))
+        contexts = [StubContext() for _ in range(3)]
+        await asyncio.gather(*(responder.respond(ctx, ('rankings', '#C'), compute) for ctx in contexts))
+        # Served from the cache afterwards
+        cached = StubContext()
+        await responder.respond(cached, ('rankings', '#C'), compute)
+        return contexts, cached, responder
+
+    contexts, cached, responder = asyncio.run(run())
+    assert computed == [1]
+    assert all(ctx.calls == [('defer',), ('send', 'rankings')] for ctx in contexts)
+    assert cached.calls == [('send', 'rankings')]
+    assert responder._pending == {}
+
+
+def test_timeout_cancels_the_computation_nobody_waits_for():
+    cancelled = []
+
+    async def compute():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def run():
+        responder = DeferredResponder(ResultCache(ttl=60))
+        ctx = StubContext()
+        await responder.respond(ctx, ('profile', 1), compute, timeout=0.01)
+        await asyncio.sleep(0)
+        return ctx, responder
+
+    ctx, responder = asyncio.run(run())
+    assert ctx.calls == [('defer',), ('send', DeferredResponder.timeout_message)]
+    assert cancelled == [1]
+    assert responder._pending == {}
+    assert responder.cache.get(('profile', 1)) is None
+
+
+def test_computation_keeps_running_for_a_waiting_command():
+    async def compute():
+        await asyncio.sleep(0.05)
+        return 'profile'
+
+    async def run():
+        responder = DeferredResponder(ResultCache(ttl=60))
+        impatient, patient = StubContext(), StubContext()
+        await asyncio.gather(responder.respond(impatient, ('profile', 1), compute, timeout=0.01),
+                             responder.respond(patient, ('profile', 1), compute, timeout=1))
+        return impatient, patient, responder
+
+    impatient, patient, responder = asyncio.run(run())
+    assert impatient.calls[-1] == ('send', DeferredResponder.timeout_message)
+    assert patient.calls[-1] == ('send', 'profile')
+    assert responder.cache.get(('profile', 1)) == 'profile'
+
+
+def test_failed_computation_sends_an_error_and_is_not_cached():
+    async def compute():
+        raise ValueError('no data')
+
+    async def run():
+        responder = DeferredResponder(ResultCache(ttl=60))
+        ctx = StubContext()
+        await responder.respond(ctx, ('profile', 1), compute)
+        return ctx, responder
+
+    ctx, responder = asyncio.run(run())
+    assert ctx.calls == [('defer',), ('send', DeferredResponder.error_message)]
+    assert responder.cache.get(('profile', 1)) is None
+    assert responder._pending == {}
+
+
+def test_result_cache_expires_entries():
+    cache = ResultCache(ttl=60)
+    cache.set('fresh', 1)
+    cache.set('stale', 2, ttl=-1)
+    assert cache.get('fresh') == 1
+    assert cache.get('stale') is None
+    cache.invalidate('fresh')
+    assert cache.get('fresh') is None
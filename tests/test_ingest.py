@@ -0,0 +1,75 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import ingest
+import metrics
+from brawlstars import BATTLE_LOG_SIZE
+
+NOW = datetime(2024, 1, 1, 12)
+
+
+def battle_times(newest, count=BATTLE_LOG_SIZE, every=timedelta(minutes=4)):
+    return [newest - i * every for i in range(count)]
+
+
+def test_find_gap_without_watermark():
+    assert ingest.find_gap('#A', battle_times(NOW), None, NOW) is None
+
+
+def test_find_gap_log_not_full():
+    times = battle_times(NOW, count=BATTLE_LOG_SIZE - 1)
+    assert ingest.find_gap('#A', times, NOW - timedelta(days=1), NOW) is None
+
+
+def test_find_gap_log_overlaps_watermark():
+    times = battle_times(NOW)
+    assert ingest.find_gap('#A', times, min(times), NOW) is None
+
+
+def test_find_gap_estimates_missed_battles():
+    times = battle_times(NOW)
+    oldest = min(times)
+    # The log has one battle every 4 minutes, 40 minutes before it were not seen
+    gap = ingest.find_gap('#A', times, oldest - timedelta(minutes=40), NOW)
+    assert gap == {'tag': '#A', 'from': oldest - timedelta(minutes=40), 'to': oldest, 'estimated_missed': 10,
+                   'detected': NOW}
+
+
+def test_find_gap_estimates_at_least_one_battle():
+    times = [NOW] * BATTLE_LOG_SIZE
+    gap = ingest.find_gap('#A', times, NOW - timedelta(hours=1), NOW)
+    assert gap['estimated_missed'] == 1
+
+
+class StubApi:
+    """Club of four members, the profile of the first one fails"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def get_club(self, tag):
+        return {'tag': tag, 'name': 'Club', 'members': [{'tag': f'#M{i}', 'name': f'Member {i}', 'role': 'member',
+                                                         'trophies': 1000} for i in range(4)]}
+
+    async def get_players(self, tag):
+        self.calls.append(('player', tag))
+        return None if tag == '#M0' else {'tag': tag, 'name': tag, 'trophies': 1000}
+
+    async def get_players_battle_log(self, tag):
+        self.calls.append(('battle_log', tag))
+        return {'items': []}
+
+
+def test_update_skips_only_the_failed_member(db):
+    api = StubApi()
+    errors = metrics.REFRESH_ERRORS.value()
+    asyncio.run(ingest.update(db, '#CLUB', api))
+    assert api.calls == [('player', '#M0')] + [(call, f'#M{i}') for i in range(1, 4)
+                                               for call in ('player', 'battle_log')]
+    assert metrics.REFRESH_ERRORS.value() == errors
+
+
+def test_members_to_players_skips_failed_profiles(db):
+    api = StubApi()
+    players = asyncio.run(ingest.members_to_players(db, asyncio.run(api.get_club('#CLUB')), api))
+    assert [player['tag'] for player in players] == ['#M1', '#M2', '#M3']
@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta
+
+from brawlstars import BATTLE_LOG_SIZE
+from scheduler import RefreshScheduler
+
+NOW = datetime(2024, 1, 1, 12)
+
+
+def make_scheduler():
+    return RefreshScheduler(None, min_interval=timedelta(minutes=5), max_interval=timedelta(hours=24), safety=0.5)
+
+
+def test_interval_from_battle_rate():
+    # One battle a minute fills half the log in 12.5 minutes
+    interval = make_scheduler().interval(1 / 60, NOW - timedelta(minutes=1), NOW)
+    assert interval == timedelta(seconds=0.5 * BATTLE_LOG_SIZE * 60)
+
+
+def test_interval_is_clamped():
+    scheduler = make_scheduler()
+    assert scheduler.interval(10.0, NOW, NOW) == timedelta(minutes=5)
+    assert scheduler.interval(1e-9, NOW, NOW) == timedelta(hours=24)
+
+
+def test_interval_without_rate():
+    assert make_scheduler().interval(0.0, NOW, NOW) == timedelta(hours=24)
+
+
+def test_interval_backs_off_idle_players():
+    scheduler = make_scheduler()
+    rate = 1 / 60
+    assert scheduler.interval(rate, NOW - timedelta(days=2), NOW) == timedelta(hours=1)
+    assert scheduler.interval(rate, NOW - timedelta(days=8), NOW) == timedelta(days=1)
@@ -0,0 +1,112 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from database import DataVersions
+from watcher import ChangeWatcher, Leaderboard
+
+
+def battle(_id, minutes_ago, result, tags, star=None):
+    return {'_id': _id, 'battleTime': datetime.utcnow() - timedelta(minutes=minutes_ago),
+            'battle': {'result': result, 'starPlayer': {'tag': star} if star else None,
+                       'teams': [[{'tag': tag} for tag in tags], [{'tag': '#OTHER'}]]}}
+
+
+class StubDatabase:
+    """Serves a club and stored battles, recent_battle_results waits for release when blocked"""
+
+    def __init__(self, battles, members=('#A', '#B')):
+        self.battles = list(battles)
+        self.club = {'_id': '#C', 'members': [{'tag': tag, 'name': tag} for tag in members]}
+        self.versions = DataVersions()
+        self.discord_tags = {}
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def get_club(self, club_tag):
+        return self.club if club_tag == self.club['_id'] else None
+
+    async def star_player_count(self, tag):
+        return sum((battle['battle']['starPlayer'] or {}).get('tag') == tag for battle in self.battles)
+
+    async def recent_battle_results(self, tag, since_date):
+        await self.release.wait()
+        return [battle for battle in self.battles if battle['battleTime'] >= since_date
+                and any(player['tag'] == tag for team in battle['battle']['teams'] for player in team)]
+
+
+STORED = [battle(1.0, 60, 'victory', ['#A', '#B'], star='#A'),
+          battle(2.0, 50, 'defeat', ['#A']),
+          battle(3.0, 60 * 24 * 8, 'victory', ['#B'], star='#B')]
+
+
+def test_leaderboard_scores_like_club_score():
+    async def run():
+        leaderboard = Leaderboard(StubDatabase(STORED))
+        assert await leaderboard.track('#C')
+        return leaderboard.rankings('#C')
+
+    rankings = asyncio.run(run())
+    # #B won its only battle of the week and was star player once before it
+    assert [(member['tag'], member['score']) for member in rankings] == [('#B', 1.0), ('#A', 0.5)]
+
+
+def test_add_battle_counts_new_battles_once():
+    async def run():
+        leaderboard = Leaderboard(StubDatabase(STORED))
+        await leaderboard.track('#C')
+        new = battle(4.0, 1, 'victory', ['#A'], star='#A')
+        leaderboard.add_battle(new)
+        leaderboard.add_battle(new)
+        leaderboard.add_battle(STORED[0])
+        return leaderboard.members['#A'], leaderboard.score('#A')
+
+    member, score = asyncio.run(run())
+    assert len(member['times']) == 3
+    assert member['star_player'] == 2
+    assert score == 2 / 3 * 2
+
+
+def test_battles_added_while_a_member_loads_are_kept():
+    async def run():
+        db = StubDatabase(STORED)
+        leaderboard = Leaderboard(db)
+        await leaderboard.track('#C')
+        db.release.clear()
+        reload = asyncio.create_task(leaderboard.player_changed('#A'))
+        await asyncio.sleep(0)
+        # Stored and streamed while the reload waits for its query, which does not return it
+        leaderboard.add_battle(battle(4.0, 1, 'victory', ['#A']))
+        db.release.set()
+        await reload
+        return leaderboard.members['#A']
+
+    member = asyncio.run(run())
+    assert [_id for battle_time, _id in member['times']] == [1.0, 2.0, 4.0]
+    assert member['victories'] == {1.0, 4.0}
+
+
+def test_handle_bumps_versions_and_updates_the_leaderboard():
+    async def run():
+        db = StubDatabase(STORED)
+        db.discord_tags[7] = '#A'
+        leaderboard = Leaderboard(db)
+        await leaderboard.track('#C')
+        watcher = ChangeWatcher(db, leaderboard, poll_interval=1)
+        new = battle(4.0, 1, 'victory', ['#A', '#B'])
+        await watcher.handle({'operationType': 'insert', 'ns': {'coll': 'battle'}, 'documentKey': {'_id': 4.0},
+                              'fullDocument': new})
+        await watcher.handle({'operationType': 'update', 'ns': {'coll': 'player'}, 'documentKey': {'_id': '#A'}})
+        await watcher.handle({'operationType': 'update', 'ns': {'coll': 'discord'}, 'documentKey': {'_id': 7}})
+        # #B left the club
+        db.club['members'] = db.club['members'][:1]
+        await watcher.handle({'operationType': 'update', 'ns': {'coll': 'club'}, 'documentKey': {'_id': '#C'}})
+        return db, leaderboard
+
+    db, leaderboard = asyncio.run(run())
+    assert db.versions.get('battle', 4.0)[1] == 1
+    assert db.versions.get('player', '#A')[1] == 2
+    assert db.versions.get('player', '#B')[1] == 1
+    assert db.versions.get('discord', 7)[1] == 1 and 7 not in db.discord_tags
+    assert db.versions.get('club', '#C')[1] == 1
+    assert set(leaderboard.members) == {'#A'}
+    assert len(leaderboard.members['#A']['times']) == 3
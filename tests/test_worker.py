@@ -0,0 +1,69 @@
+import asyncio
+
+import ingest
+import metrics
+import worker
+from worker import HashRing, shard_name
+
+TAGS = [f'#TAG{i}' for i in range(2000)]
+
+
+def test_hash_ring_is_deterministic():
+    nodes = [shard_name(i) for i in range(4)]
+    first, second = HashRing(nodes), HashRing(reversed(nodes))
+    assert [first.node_for(tag) for tag in TAGS] == [second.node_for(tag) for tag in TAGS]
+
+
+def test_hash_ring_spreads_keys():
+    ring = HashRing(shard_name(i) for i in range(4))
+    counts = {}
+    for tag in TAGS:
+        counts[ring.node_for(tag)] = counts.get(ring.node_for(tag), 0) + 1
+    assert set(counts) == {shard_name(i) for i in range(4)}
+    assert min(counts.values()) > len(TAGS) / 4 / 2
+
+
+def test_hash_ring_adding_a_node_only_moves_keys_to_it():
+    before = HashRing(shard_name(i) for i in range(3))
+    after = HashRing(shard_name(i) for i in range(4))
+    moved = [tag for tag in TAGS if before.node_for(tag) != after.node_for(tag)]
+    assert moved
+    assert all(after.node_for(tag) == shard_name(3) for tag in moved)
+
+
+def test_hash_ring_without_nodes():
+    assert HashRing([]).node_for('#TAG') is None
+
+
+class StubScheduler:
+    def __init__(self, due):
+        self.due = due
+        self.states = {}
+        self.observed = []
+
+    def pop_due(self):
+        return self.due
+
+    async def observe(self, tag, result):
+        self.observed.append((tag, result))
+
+
+class StubDatabase:
+    write_buffer = None
+
+    def profile_due(self, tag):
+        return True
+
+
+def test_refresh_players_counts_a_failed_round_once(monkeypatch):
+    async def refresh_player(db, tag, api, watermark, dedup, profile):
+        if tag != '#OK':
+            raise ConnectionError('reset')
+        return 0, []
+
+    monkeypatch.setattr(ingest, 'refresh_player', refresh_player)
+    scheduler = StubScheduler(['#BAD1', '#OK', '#BAD2'])
+    errors = metrics.REFRESH_ERRORS.value()
+    asyncio.run(worker.refresh_players(StubDatabase(), None, scheduler))
+    assert metrics.REFRESH_ERRORS.value() == errors + 1
+    assert scheduler.observed == [('#BAD1', None), ('#OK', (0, [])), ('#BAD2', None)]
@@ -0,0 +1,131 @@
+import asyncio
+
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+import metrics
+from database import DataVersions
+from writebuffer import DUPLICATE_KEY, WriteBuffer
+
+
+class BulkResult:
+    def __init__(self, upserted_ids):
+        self.upserted_ids = upserted_ids
+
+
+class FakeCollection:
+    def __init__(self, name, calls, outcomes):
+        self.name = name
+        self.calls = calls
+        self.outcomes = outcomes
+
+    async def bulk_write(self, operations, ordered=True):
+        assert not ordered
+        self.calls.append((self.name, list(operations)))
+        outcome = self.outcomes.get(self.name)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return BulkResult(outcome or {})
+
+
+class FakeDatabase:
+    """Records every bulk_write, outcomes holds the upserted_ids or the exception per collection"""
+
+    def __init__(self, outcomes=None):
+        self.calls = []
+        self.outcomes = outcomes or {}
+
+    def __getitem__(self, name):
+        return FakeCollection(name, self.calls, self.outcomes)
+
+
+def update(key):
+    return UpdateOne({'_id': key}, {'$set': {'value': key}}, upsert=True)
+
+
+def test_partial_failure_keeps_the_written_operations():
+    lost = []
+    error = BulkWriteError({'writeErrors': [{'index': 1, 'code': 121, 'errmsg': 'validation failed'},
+                                            {'index': 2, 'code': DUPLICATE_KEY, 'errmsg': 'duplicate key'}],
+                            'upserted': [{'index': 0, '_id': 'a'}]})
+    versions = DataVersions()
+    buffer = WriteBuffer(FakeDatabase({'player': error}), versions, max_size=10)
+    errors = metrics.WRITE_BUFFER_ERRORS.value(collection='player')
+
+    async def run():
+        for key in ('a', 'b', 'c'):
+            await buffer.add('player', update(key), bumps=[('player', key)], lost=lambda key=key: lost.append(key))
+        await buffer.flush()
+
+    asyncio.run(run())
+    # A duplicate key means the document is there already, only the validation error is lost
+    assert lost == ['b']
+    assert metrics.WRITE_BUFFER_ERRORS.value(collection='player') == errors + 1
+    assert [versions.get('player', key)[1] for key in ('a', 'b', 'c')] == [1, 0, 1]
+    assert len(buffer) == 0
+
+
+def test_failed_bulk_write_loses_every_operation():
+    lost = []
+    versions = DataVersions()
+    buffer = WriteBuffer(FakeDatabase({'player': ConnectionError('gone')}), versions, max_size=10)
+
+    async def run():
+        for key in ('a', 'b'):
+            await buffer.add('player', update(key), bumps=[('player', key)], lost=lambda key=key: lost.append(key))
+        await buffer.add('player', update('c'), bumps=[('player', 'c')], lost=lambda: 1 / 0)
+        await buffer.flush()
+
+    # A failing callback is logged and does not keep the others from running
+    asyncio.run(run())
+    assert lost == ['a', 'b']
+    assert versions.get('player')[1] == 0
+
+
+def test_insert_only_bumps_and_follow_ups_need_an_upsert():
+    versions = DataVersions()
+    db = FakeDatabase({'battle': {0: 1.0}})
+    buffer = WriteBuffer(db, versions, max_size=10)
+
+    async def run():
+        for key in (1.0, 2.0):
+            await buffer.add('battle', update(key), bumps=[('battle', key)], insert_only=True,
+                             follow_ups=[('brawler_stats', InsertOne({'battle': key}))])
+        await buffer.flush()
+
+    asyncio.run(run())
+    assert versions.get('battle', 1.0)[1] == 1
+    assert versions.get('battle', 2.0)[1] == 0
+    # The follow-up of the inserted battle is written by the same flush
+    assert [name for name, operations in db.calls] == ['battle', 'brawler_stats']
+    assert db.calls[1][1] == [InsertOne({'battle': 1.0})]
+    assert len(buffer) == 0
+
+
+def test_full_collection_is_flushed():
+    db = FakeDatabase()
+    buffer = WriteBuffer(db, max_size=2)
+
+    async def run():
+        await buffer.add('player', update('a'))
+        assert db.calls == []
+        await buffer.add('player', update('b'))
+
+    asyncio.run(run())
+    assert [len(operations) for name, operations in db.calls] == [2]
+
+
+def test_writers_wait_for_a_flush_at_max_pending():
+    db = FakeDatabase()
+    buffer = WriteBuffer(db, max_size=10, max_pending=3)
+
+    async def run():
+        await buffer.add('player', update('a'))
+        await buffer.add('club', update('b'))
+        await buffer.add('battle', update('c'))
+        assert db.calls == []
+        await buffer.add('player', update('d'))
+
+    asyncio.run(run())
+    assert sorted(name for name, operations in db.calls) == ['battle', 'club', 'player']
+    assert len(buffer) == 1